@@ -28,7 +28,6 @@ import os
 import csv
 import shutil
 from collections import Counter, defaultdict
-import multiprocessing as mp
 try:
     from rich import print
 except ImportError:
@@ -36,7 +35,7 @@ except ImportError:
 from ..tools import tree, stride, trees_msa, dendroblast
 from ..gene_tree_inference import trees2ologs_dlcpar, trees2ologs_of, infer_trees
 
-from ..utils import util, files
+from ..utils import util, files, ortholog_pairs
 from ..orthogroups import orthogroups_set
 from . import stats
 
@@ -175,11 +174,11 @@ def TwoAndThreeGeneHOGs(ogSet, st_rooted_labelled, hog_writer):
         if n < 2 or n > 3: continue
         og_name = "OG%07d" % iog
         sp_present = set([str(g.iSp) for g in og])
-        stNode = trees2ologs_of.MRCA_node(st_rooted_labelled, sp_present)
+        stNode = hog_writer.species_tree_lca.MRCA(sp_present)
         hogs_to_write = hog_writer.get_skipped_nodes(stNode, None)  
         if len(sp_present) > 1:
             # We don't create files for 'species specific HOGs'
-            st_node = trees2ologs_of.MRCA_node(st_rooted_labelled, sp_present)
+            st_node = hog_writer.species_tree_lca.MRCA(sp_present)
             hogs_to_write = hogs_to_write + [st_node.name]
         genes = [g.ToString() for g in og] # Inefficient as will convert back again, but trivial cost I think
         hog_writer.write_hog_genes(genes, hogs_to_write, og_name)
@@ -190,8 +189,13 @@ def TwoAndThreeGeneOrthogroups(
         save_space, 
         fewer_open_files,
         write_hog_tree=False,
-        fix_files=False
+        fix_files=False,
+        pairs_writer=None,
     ):
+    """
+    pairs_writer - ortholog_pairs.OrthologPairsWriter to write the orthologs to 
+    instead of the pairwise ortholog files, or None
+    """
     speciesDict = ogSet.SpeciesDict()
     sequenceDict = ogSet.SequenceDict()
     ogs = ogSet.OGsAll()
@@ -241,6 +245,12 @@ def TwoAndThreeGeneOrthogroups(
         all_orthologues.append((iog, orthologues))
     nspecies = len(ogSet.speciesToUse)
     sp_to_index = {str(sp):i for i, sp in enumerate(ogSet.speciesToUse)}
+    if pairs_writer is not None:
+        olog_rows = []
+        nOrthologues_SpPair += trees2ologs_of.GetLinesForOlogFiles(all_orthologues, speciesDict, ogSet.speciesToUse, sequenceDict, 
+                                                                   False, None, None, fewer_open_files=fewer_open_files, olog_rows=olog_rows)
+        pairs_writer.Write(ortholog_pairs.GetPairsArray(olog_rows, nspecies))
+        return nOrthologues_SpPair
     with trees2ologs_of.OrthologsFiles(resultsDir, speciesDict, ogSet.speciesToUse, nspecies,
                                        sp_to_index, save_space, fewer_open_files) as (olog_files_handles, suspect_genes_file_handles):
         olog_lines_tot = [["" for j in range(nspecies)] for i in range(nspecies)]
@@ -248,13 +258,11 @@ def TwoAndThreeGeneOrthogroups(
         nOrthologues_SpPair += trees2ologs_of.GetLinesForOlogFiles(all_orthologues, speciesDict, ogSet.speciesToUse, sequenceDict, 
                                                                    False, olog_lines_tot, olog_sus_lines_tot, fewer_open_files=fewer_open_files)
         # olog_sus_lines_tot will be empty
-        lock_dummy = mp.Lock()
         for i in range(nspecies):
             for j in range(nspecies):
                 trees2ologs_of.WriteOlogLinesToFile(
                     olog_files_handles[i][j], 
                     olog_lines_tot[i][j], 
-                    lock_dummy,
                     write_hog_tree=write_hog_tree,
                     fix_files=fix_files
                 )
@@ -275,6 +283,7 @@ def ReconciliationAndOrthologues(
         exist_msa=True,
         write_hog_tree=True,
         fix_files=True,
+        q_ortholog_pairs=False,
     ):
     """
     ogSet - info about the orthogroups, species etc.
@@ -282,6 +291,7 @@ def ReconciliationAndOrthologues(
     reconTreesRenamedDir - where to put the reconcilled trees that use the gene accessions
     iSpeciesTree - which of the potential roots of the species tree is this
     method - can be dlcpar, dlcpar_deep, of_recon
+    q_ortholog_pairs - write the orthologs as gene ID pairs rather than TSV files, only for of_recon without fix_files
     """
     speciesTree_ids_fn = files.FileHandler.GetSpeciesTreeIDsRootedFN()
     labeled_tree_fn = files.FileHandler.GetSpeciesTreeResultsNodeLabelsFN()
@@ -289,6 +299,7 @@ def ReconciliationAndOrthologues(
     workingDir = files.FileHandler.GetWorkingDirectory_Write()    # workingDir - Orthologues working dir
     resultsDir_ologs = files.FileHandler.GetOrthologuesDirectory()
     reconTreesRenamedDir = files.FileHandler.GetOGsReconTreeDir(True)
+    pairs_writer = None
 
     if "dlcpar" in recon_method:
         qDeepSearch = (recon_method == "dlcpar_convergedsearch")
@@ -345,6 +356,8 @@ def ReconciliationAndOrthologues(
             speciesDict, 
             ogSet.speciesToUse,
         )
+        if q_ortholog_pairs and (not write_hog_tree or not fix_files):
+            pairs_writer = ortholog_pairs.OrthologPairsWriter(resultsDir_ologs, ogSet.speciesToUse)
         nOrthologues_SpPair = \
             trees2ologs_of.DoOrthologuesForOrthoFinder(
                 ogSet, 
@@ -362,6 +375,7 @@ def ReconciliationAndOrthologues(
                 exist_msa=exist_msa,
                 write_hog_tree=write_hog_tree,
                 fix_files=fix_files,
+                pairs_writer=pairs_writer,
         )
         if print_info:
             util.PrintTime("Done of orthologues")
@@ -375,20 +389,12 @@ def ReconciliationAndOrthologues(
             save_space, 
             fewer_open_files,
             write_hog_tree=write_hog_tree,
-            fix_files=fix_files
+            fix_files=fix_files,
+            pairs_writer=pairs_writer,
         )
+        if pairs_writer is not None:
+            pairs_writer.Finalise(ogSet.SpeciesDict(), ogSet.SequenceDict())
     
-    if nLowParallel > 1 and "phyldog" != recon_method and "dlcpar" not in recon_method:
-        trees2ologs_of.SortParallelFiles(
-            nLowParallel, 
-            ogSet.speciesToUse, 
-            speciesDict, 
-            fewer_open_files,
-            write_hog_tree,
-            fix_files,
-            old_version,
-        )
-
     if not write_hog_tree or not fix_files:
         # print("%fs for orthologs etc" % (stop-start))
         WriteOrthologuesStats(ogSet, nOrthologues_SpPair)
@@ -408,7 +414,8 @@ def OrthologuesFromTrees(
         old_version=False,
         exist_msa=True,
         write_hog_tree=True,
-        fix_files=True
+        fix_files=True,
+        q_ortholog_pairs=False,
     ):
     """
     userSpeciesTree_fn - None if not supplied otherwise rooted tree using user species names (not orthofinder IDs)
@@ -444,7 +451,8 @@ def OrthologuesFromTrees(
         old_version=old_version,
         exist_msa=exist_msa,
         write_hog_tree=write_hog_tree,
-        fix_files=fix_files
+        fix_files=fix_files,
+        q_ortholog_pairs=q_ortholog_pairs,
     )
     util.PrintUnderline("Writing results files")
     util.PrintTime("Writing results files")
@@ -574,7 +582,8 @@ def OrthologuesWorkflow(
         old_version=old_version,
         exist_msa=options.qMSATrees,
         write_hog_tree=write_hog_tree,
-        fix_files=options.fix_files
+        fix_files=options.fix_files,
+        q_ortholog_pairs=options.ortholog_pairs,
     )
 
     if options.fix_files:
@@ -617,7 +626,8 @@ def OrthologuesWorkflow(
             print_info=False,
             exist_msa=options.qMSATrees,
             write_hog_tree=False,
-            fix_files=options.fix_files
+            fix_files=options.fix_files,
+            q_ortholog_pairs=options.ortholog_pairs,
         )
 
     fastaWriter = trees_msa.FastaWriter(files.FileHandler.GetSpeciesSeqsDir(), speciesToUse)
@@ -764,7 +774,8 @@ def InferOrthologs(
         print_info=True,
         exist_msa=True,
         write_hog_tree=True,
-        fix_files=True
+        fix_files=True,
+        q_ortholog_pairs=False,
     ):
     """ C. Gene tree rooting & orthologs"""
 
@@ -800,7 +811,8 @@ def InferOrthologs(
         print_info=print_info,
         exist_msa=exist_msa,
         write_hog_tree=write_hog_tree,
-        fix_files=fix_files
+        fix_files=fix_files,
+        q_ortholog_pairs=q_ortholog_pairs,
     )
     # util.PrintTime("Done Recon")
 
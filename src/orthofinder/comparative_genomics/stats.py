@@ -14,42 +14,43 @@ from rich.table import Table
 from rich.console import Console
 
 from ..utils import util, files
-
-
-def OrthogroupsMatrix(iSpecies, properOGs):
-    speciesIndexDict = {iSp: iCol for iCol, iSp in enumerate(iSpecies)}
-    nSpecies = len(iSpecies)
-    nGroups = len(properOGs)
-    # (i, j)-th entry of ogMatrix gives the number of genes from i in orthogroup j
-    ogMatrix = np.zeros((nGroups, nSpecies))
-    for i_og, og in enumerate(properOGs):
-        for species, _ in og:
-            ogMatrix[i_og, speciesIndexDict[species]] += 1
-    return ogMatrix
+from ..orthogroups.orthogroup_array import OrthogroupArray
 
 
 def Stats_SpeciesOverlaps(fn, speciesNamesDict, iSpecies, speciesPresence):
-    """ Number of orthogroups in which each species-pair is present. Called by Stats"""
+    """ Number of orthogroups in which each species-pair is present. Called by Stats
+    Args:
+        speciesPresence - (nOGs x nSpecies) CSR matrix, 1 for the species present in each orthogroup, columns as iSpecies
+    """
+    overlaps = (speciesPresence.T @ speciesPresence).toarray()
     with open(fn, util.csv_write_mode) as outfile:
         writer = csv.writer(outfile, delimiter="\t")
         writer.writerow([""] + [speciesNamesDict[index] for index in iSpecies])
-        for iSp in iSpecies:
-            overlap = [len([1 for og in speciesPresence if (iSp in og and jSp in og)]) for jSp in iSpecies]
+        for iSp, overlap in zip(iSpecies, overlaps.tolist()):
             writer.writerow([speciesNamesDict[iSp]] + overlap)
 
 
-def Stats_SizeTable(writer_sum, writer_sp, properOGs, allGenesCounter, iSpecies, speciesPresence):
-    """ Overall and per-species histogram tables of orthogroup sizes. Called by Stats"""
+def Stats_SizeTable(writer_sum, writer_sp, speciesCounts, allGenesCounter, iSpecies, nSpeciesPerOG):
+    """ Overall and per-species histogram tables of orthogroup sizes. Called by Stats
+    Args:
+        speciesCounts - (nOGs x nSpecies) CSR matrix of the number of genes from each species in each orthogroup, columns as iSpecies
+        nSpeciesPerOG - array of the number of species (of all species) present in each orthogroup
+    """
     bins = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 16, 21, 51, 101, 151, 201, 501, 1001, 9e99]
     writer_sum.writerow([])
     writer_sp.writerow([])
-    nGenesPerOG = [len(og) for og in properOGs]
-    nGenesPerOGPerSpecies = [[len([1 for g in og if g[0] == iSp]) for og in properOGs] for iSp in iSpecies]
-    counters_GenesPerOGPerSpecies = [Counter(spCount) for spCount in nGenesPerOGPerSpecies]
+    nGenesPerOG = np.asarray(speciesCounts.sum(axis=1)).ravel().tolist()
+    nOGs = speciesCounts.shape[0]
+    counters_GenesPerOGPerSpecies = []
+    speciesCounts_csc = speciesCounts.tocsc()
+    for start, end in zip(speciesCounts_csc.indptr[:-1].tolist(), speciesCounts_csc.indptr[1:].tolist()):
+        c = Counter(speciesCounts_csc.data[start:end].tolist())
+        if end - start < nOGs:
+            c[0] = nOGs - (end - start)
+        counters_GenesPerOGPerSpecies.append(c)
     counters_GenesPerOG = Counter(nGenesPerOG)
     nSp = len(iSpecies)
-    nOGs = len(properOGs)
-    nGenesTotal = sum([len(og) for og in properOGs])
+    nGenesTotal = sum(nGenesPerOG)
     percentFormat = "%0.1f"
     writer_sum.writerow(
         ["Average number of genes per-species in orthogroup", "Number of orthogroups", "Percentage of orthogroups",
@@ -93,7 +94,7 @@ def Stats_SizeTable(writer_sum, writer_sp, properOGs, allGenesCounter, iSpecies,
     for r in table_PG: writer_sp.writerow(r)
 
     # Species presence
-    n = list(map(len, speciesPresence))
+    n = nSpeciesPerOG.tolist()
     writer_sum.writerow([])
     writer_sum.writerow(["Number of species in orthogroup", "Number of orthogroups"])
     for i in range(1, nSp + 1):
@@ -102,10 +103,16 @@ def Stats_SizeTable(writer_sum, writer_sp, properOGs, allGenesCounter, iSpecies,
 
 def Stats(ogs, speciesNamesDict, iSpecies, iResultsVersion, fastaWriter, ids_dict, q_fast_add=False):
     """ Top-level method for calculation of stats for the orthogroups"""
-    allOgs = [[list(map(int, g.split("_"))) for g in og] for og in ogs]
-    properOGs = [og for og in allOgs if len(og) > 1]
-    iogs_properOGs = [iog for iog, og in enumerate(allOgs) if len(og) > 1]
-    allGenes = [g for og in allOgs for g in og]
+    if not isinstance(ogs, OrthogroupArray):
+        ogs = OrthogroupArray.FromStrings(ogs)
+    sizes = ogs.Sizes()
+    iogs_properOGs = np.flatnonzero(sizes > 1)
+    properOGs = ogs.Subset(iogs_properOGs)
+    iogs_properOGs = iogs_properOGs.tolist()
+    # (i, j)-th entry gives the number of genes from species j in proper orthogroup i
+    speciesCounts_all = properOGs.SpeciesCounts()
+    speciesCounts = properOGs.SpeciesCounts(iSpecies)
+    speciesPresence = (speciesCounts > 0).astype(np.int64)
     ogStatsResultsDir = files.FileHandler.GetOGsStatsResultsDirectory()
     filename_sp = ogStatsResultsDir + "Statistics_PerSpecies" + (
         "" if iResultsVersion == 0 else "_%d" % iResultsVersion) + ".tsv"
@@ -123,15 +130,15 @@ def Stats(ogs, speciesNamesDict, iSpecies, iResultsVersion, fastaWriter, ids_dic
         writer_sp.writerow([""] + [speciesNamesDict[index] for index in iSpecies])
 
         # Number of genes
-        allGenesCounter = Counter([g[0] for g in allGenes])
-        nGenes = sum(allGenesCounter.values())
+        allGenesCounter = Counter(dict(enumerate(np.bincount(ogs.species).tolist())))
+        nGenes = len(ogs.species)
         writer_sum.writerow(["Number of species", len(iSpecies)])
         writer_sp.writerow(["Number of genes"] + [allGenesCounter[iSp] for iSp in iSpecies])
         writer_sum.writerow(["Number of genes", nGenes])
 
         # Number of assigned/unassigned genes
-        assignedGenesCounter = Counter([g[0] for og in properOGs for g in og])
-        nAssigned = sum(assignedGenesCounter.values())
+        assignedGenesCounter = Counter(dict(enumerate(np.asarray(speciesCounts_all.sum(axis=0)).ravel().tolist())))
+        nAssigned = len(properOGs.species)
         writer_sp.writerow(["Number of genes in orthogroups"] + [assignedGenesCounter[iSp] for iSp in iSpecies])
         writer_sum.writerow(["Number of genes in orthogroups"] + [nAssigned])
         writer_sp.writerow(
@@ -149,27 +156,23 @@ def Stats(ogs, speciesNamesDict, iSpecies, iResultsVersion, fastaWriter, ids_dic
             ["Percentage of unassigned genes", percentFormat % (100 * (1. - (float(nAssigned) / nGenes)))])
 
         # Number of Orthogroups
-        speciesPresence = [set([g[0] for g in og]) for og in properOGs]
         nOgs = len(properOGs)
+        nOGsContainingSpecies = speciesCounts.getnnz(axis=0).tolist()
         writer_sum.writerow(["Number of orthogroups", nOgs])
-        writer_sp.writerow(
-            ["Number of orthogroups containing species"] + [sum([iSp in og_sp for og_sp in speciesPresence]) for iSp in
-                                                            iSpecies])
+        writer_sp.writerow(["Number of orthogroups containing species"] + nOGsContainingSpecies)
         writer_sp.writerow(["Percentage of orthogroups containing species"] + [percentFormat % (
-            (100. * sum([iSp in og_sp for og_sp in speciesPresence]) / len(properOGs)) if len(properOGs) > 0 else 0.)
-                                                                               for iSp in iSpecies])
+            (100. * n_sp / nOgs) if nOgs > 0 else 0.) for n_sp in nOGsContainingSpecies])
 
         # Species specific orthogroups - orthogroups-based
-        speciesSpecificOGsCounter = Counter([next(iter(og_sp)) for og_sp in speciesPresence if len(og_sp) == 1])
+        nSpeciesPerOG = speciesCounts_all.getnnz(axis=1)
+        i_speciesSpecific = np.flatnonzero(nSpeciesPerOG == 1)
+        speciesSpecificOGsCounter = Counter(dict(enumerate(speciesCounts_all[i_speciesSpecific].getnnz(axis=0).tolist())))
         writer_sp.writerow(
             ["Number of species-specific orthogroups"] + [speciesSpecificOGsCounter[iSp] for iSp in iSpecies])
         writer_sum.writerow(["Number of species-specific orthogroups", sum(speciesSpecificOGsCounter.values())])
 
         # Species specific orthogroups - gene-based
-        iSpeciesSpecificOGs = [i for i, og_sp in enumerate(speciesPresence) if len(og_sp) == 1]
-        iSpSpecificOGsGeneCounts = [
-            sum([len(properOGs[iog]) for iog in iSpeciesSpecificOGs if properOGs[iog][0][0] == iSp]) for iSp in
-            iSpecies]
+        iSpSpecificOGsGeneCounts = np.asarray(speciesCounts[i_speciesSpecific].sum(axis=0)).ravel().tolist()
         writer_sp.writerow(["Number of genes in species-specific orthogroups"] + iSpSpecificOGsGeneCounts)
         writer_sum.writerow(["Number of genes in species-specific orthogroups", sum(iSpSpecificOGsGeneCounts)])
         writer_sp.writerow(["Percentage of genes in species-specific orthogroups"] + [
@@ -179,13 +182,13 @@ def Stats(ogs, speciesNamesDict, iSpecies, iResultsVersion, fastaWriter, ids_dic
                              percentFormat % (100. * sum(iSpSpecificOGsGeneCounts) / nGenes)])
 
         # 'averages'
-        l = list(sorted(list(map(len, properOGs))))
+        l = sorted(sizes[sizes > 1].tolist())
         writer_sum.writerow(["Mean orthogroup size", "%0.1f" % np.mean(l)])
         writer_sum.writerow(["Median orthogroup size", np.median(l)])
         L = np.cumsum(l)
         j, _ = next((i, x) for i, x in enumerate(L) if x > nAssigned / 2)
         writer_sum.writerow(["G50 (assigned genes)", l[j]])
-        l2 = list(reversed(list(map(len, ogs))))
+        l2 = list(reversed(sizes.tolist()))
         L2 = np.cumsum(l2)
         j2, _ = next((i, x) for i, x in enumerate(L2) if x > nGenes / 2)
         G50 = l2[j2]
@@ -195,11 +198,10 @@ def Stats(ogs, speciesNamesDict, iSpecies, iResultsVersion, fastaWriter, ids_dic
         writer_sum.writerow(["O50 (all genes)", O50])
 
         # Single-copy orthogroups
-        ogMatrix = OrthogroupsMatrix(iSpecies, properOGs)  # use iogs_properOGs for indexing
         nSpecies = len(iSpecies)
-        nPresent = (ogMatrix > np.zeros((1, nSpecies))).sum(1)
-        nCompleteOGs = list(nPresent).count(nSpecies)
-        singleCopyOGs = (ogMatrix == np.ones((1, nSpecies))).all(1).nonzero()[0]
+        nPresent = speciesCounts.getnnz(axis=1)
+        nCompleteOGs = int(np.count_nonzero(nPresent == nSpecies))
+        singleCopyOGs = np.flatnonzero((speciesCounts == 1).getnnz(axis=1) == nSpecies)  # use iogs_properOGs for indexing
         nSingleCopy = len(singleCopyOGs)
         writer_sum.writerow(["Number of orthogroups with all species present", nCompleteOGs])
         writer_sum.writerow(["Number of single-copy orthogroups", nSingleCopy])
@@ -212,7 +214,7 @@ def Stats(ogs, speciesNamesDict, iSpecies, iResultsVersion, fastaWriter, ids_dic
 
         for i in singleCopyOGs:
             out_fn = g_fmt % iogs_properOGs[i]
-            og = ["%d_%d" % tuple(g) for g in properOGs[i]]
+            og = properOGs[i]
             fastaWriter.WriteSeqsToFasta_withNewAccessions(og, out_fn, ids_dict)
 
         # Results filenames
@@ -226,7 +228,7 @@ def Stats(ogs, speciesNamesDict, iSpecies, iResultsVersion, fastaWriter, ids_dic
         writer_sum.writerow(["Orthogroups shared between species", os.path.split(filename_overlap)[1]])
 
         # Sizes
-        Stats_SizeTable(writer_sum, writer_sp, properOGs, allGenesCounter, iSpecies, speciesPresence)
+        Stats_SizeTable(writer_sum, writer_sp, speciesCounts, allGenesCounter, iSpecies, nSpeciesPerOG)
         Stats_SpeciesOverlaps(filename_overlap, speciesNamesDict, iSpecies, speciesPresence)
     
     util.PrintTime("Done writing files")
@@ -9,10 +9,14 @@ Perform directed 'reconciliation' first and then apply EggNOG method
 1 - root gene trees on outgroup: unique one this time
 2 - infer orthologues
 """
+import io
 import os
 import sys
 import csv
 import glob
+import heapq
+import shutil
+import tempfile
 import argparse
 import operator
 import itertools
@@ -20,13 +24,20 @@ import traceback
 import multiprocessing as mp
 from collections import defaultdict
 import warnings
+try:
+    import cPickle as pic
+except ImportError:
+    import pickle as pic
 try:
     from rich import print
 except ImportError:
     ...
+from .. import nThreadsDefault
 from ..tools import tree as tree_lib
+from ..tools import newick
+from ..tools import tree_lca
 from . import resolve
-from ..utils import util, files, parallel_task_manager
+from ..utils import util, files, parallel_task_manager, ortholog_pairs
 
 
 PY2 = sys.version_info <= (3,)
@@ -125,8 +136,7 @@ HOGs
 -------------------------------------------------------------------------------
 """ 
 
-def MRCA_node(t_rooted, taxa):
-    return (t_rooted & next(taxon for taxon in taxa)) if len(taxa) == 1 else t_rooted.get_common_ancestor(taxa)
+hogBufferSize = 2**22   # characters of HOG rows held by HogWriter before they are written
 
 class HogWriter(object):
     def __init__(
@@ -143,6 +153,8 @@ class HogWriter(object):
         seq_ids - dict of sequence ids
         sp_ids - dict of species ids
         species_to_use - list of ints
+        The HOG rows are numbered and written by the parent process only, see 
+        WriteCachedHOGs. They are buffered per level and written in batches.
         """
         self.sp_ids = sp_ids
         self.seq_ids = seq_ids
@@ -153,8 +165,10 @@ class HogWriter(object):
         self.iSps = list(map(str, sorted(species_to_use)))   # list of strings
         self.i_sp_to_index = {int(isp):i_col for i_col, isp in enumerate(self.iSps)}
         self.iHOG = defaultdict(int)
-        self.lock_iHOG = mp.Lock()
+        self.buffers = defaultdict(list)    # HOG level -> list of text for the file
+        self.n_buffered = 0
         self.species_tree = species_tree
+        self.species_tree_lca = tree_lca.TreeLCA(species_tree)
         species_names = [sp_ids[i] for i in self.iSps]
         for name in species_tree_node_names + ["N0.ids"]:
             q_results = not name.endswith(".ids")
@@ -167,13 +181,30 @@ class HogWriter(object):
         for n in species_tree.traverse():
             desc = n.get_descendants()
             self.hog_contents[n.name] = set([int(nn.name) if nn.is_leaf() else nn.name for nn in desc])
-        self.comp_nodes = get_comparable_nodes(self.species_tree)
+        self.comp_nodes = self.species_tree_lca.ComparableNodes()
 
-    def get_hog_index(self, hog_name):
-        with self.lock_iHOG:
-            i = self.iHOG[hog_name]
-            self.iHOG[hog_name] += 1
-            return i
+    def get_hog_indices(self, hog_name, n):
+        """
+        Allocate a block of n consecutive HOG numbers for a level
+        Returns:
+            i - the first number in the block
+        """
+        i = self.iHOG[hog_name]
+        self.iHOG[hog_name] += n
+        return i
+
+    def buffer_text(self, hog_name, text):
+        self.buffers[hog_name].append(text)
+        self.n_buffered += len(text)
+        if self.n_buffered > hogBufferSize:
+            self.flush_buffers()
+
+    def flush_buffers(self):
+        for name, texts in self.buffers.items():
+            if len(texts) > 0:
+                self.fhs[name].write("".join(texts))
+        self.buffers.clear()
+        self.n_buffered = 0
 
     def write_hog_genes(self, genes, sp_node_name_list, og_name):
         """
@@ -191,15 +222,15 @@ class HogWriter(object):
             isp, _ = g.split("_")
             genes_per_species[isp].append(self.seq_ids[g])
             genes_per_species_ids[isp].append(g)
-        i_hogs = [self.get_hog_index(sp_node_name) for sp_node_name in sp_node_name_list]
+        i_hogs = [self.get_hog_indices(sp_node_name, 1) for sp_node_name in sp_node_name_list]
         row_genes = [", ".join(genes_per_species[isp]) for isp in self.iSps]
         for i_hog, sp_node_name in zip(i_hogs, sp_node_name_list):
-            util.writerow(self.fhs[sp_node_name], ["%s.HOG%07d" % (sp_node_name, i_hog),  og_name, "-"] + row_genes)
+            self.buffer_text(sp_node_name, util.getrow(["%s.HOG%07d" % (sp_node_name, i_hog),  og_name, "-"] + row_genes))
             if sp_node_name == "N0":
                 row_genes_ids = [", ".join(genes_per_species_ids[isp]) for isp in self.iSps]
-                util.writerow(
-                    self.fhs[sp_node_name + ".ids"], 
-                    ["%s.HOG%07d" % (sp_node_name, i_hog),  og_name, "-"] + row_genes_ids
+                self.buffer_text(
+                    sp_node_name + ".ids", 
+                    util.getrow(["%s.HOG%07d" % (sp_node_name, i_hog),  og_name, "-"] + row_genes_ids)
                 )
 
     def write_clade_v2(self, n, og_name, split_paralogous_clades_from_same_hog = False):
@@ -241,7 +272,7 @@ class HogWriter(object):
         # scl_mrca = {nn.sp_node for nn in scl if not nn.is_leaf()}
         if debug: print("Dups below: " + str(n.dups_below))
         stop_at_dups = lambda nn : nn.name in n.dups_below
-        sp_node = self.species_tree & (n.sp_node)
+        sp_node = self.species_tree_lca.Node(n.sp_node)
         # don't need skip for dups, that's recorded in dups_below
         # traverse the species tree from the current node and record all nodes before hitting a duplication node from the gene tree
         hogs_to_write.update({nn.name for nn in sp_node.traverse('preorder', is_leaf_fn = stop_at_dups) if (not nn.is_leaf()) and (not nn.name in n.dups_below)})
@@ -290,8 +321,11 @@ class HogWriter(object):
             - We have the HOGs that need writing plus knowledge of what scl units 
               each HOG should contain. For each hog take the intersection of what 
               we have with what the hog should contain.
+            - A species' genes are the same in every HOG they appear in, so they
+              are translated to accessions once and the text shared by the rows.
         """
         ret = []
+        genes_text = dict()     # sp_id -> sorted accessions, comma separated
         for h in hogs_to_write:
             # print("HOG: " + h)
             q_empty = True
@@ -306,7 +340,9 @@ class HogWriter(object):
                 # translate the species ID to the species column it should be in
                 # after accounting for removed species
                 genes_row_ids[self.i_sp_to_index[isp]] = genes_ids_per_species_id[isp]
-                genes_row[self.i_sp_to_index[isp]] = ", ".join(sorted([self.seq_ids[g] for g in genes_ids_per_species_id[isp].split(", ")]))
+                if isp not in genes_text:
+                    genes_text[isp] = ", ".join(sorted([self.seq_ids[g] for g in genes_ids_per_species_id[isp].split(", ")]))
+                genes_row[self.i_sp_to_index[isp]] = genes_text[isp]
                 q_empty = False
             if not q_empty: 
                 # print((h, genes_row))
@@ -317,6 +353,7 @@ class HogWriter(object):
         return ret
 
     def close_files(self):
+        self.flush_buffers()
         for fh in self.fhs.values():
             fh.close()
 
@@ -421,9 +458,9 @@ class HogWriter(object):
         for l1, l2 in itertools.combinations(mrcas, 2):
             if l1 == l2:
                 attested.add(l1)
-            elif l2 in self.comp_nodes[l1][1]:
+            elif self.species_tree_lca.IsAncestor(l1, l2):
                 attested.add(l2)
-            elif l1 in self.comp_nodes[l2][1]:
+            elif self.species_tree_lca.IsAncestor(l2, l1):
                 attested.add(l1)
         if len(attested) == 1:
             return attested.pop()
@@ -435,38 +472,28 @@ class HogWriter(object):
         else:
             # get the highest in the tree
             attested = list(attested)
-            ancestor_lists = [(self.species_tree & a).get_ancestors() for a in attested]
             x = len(attested)
             for i in range(x):
-                if all(attested[i] in ancestor_lists[j] for j in range(x) if j!=i):
+                if all(self.species_tree_lca.IsAncestor(attested[i], attested[j]) for j in range(x) if j!=i):
                     return attested[i]
         print("WARNING: Unexpected gene tree topology 2")
         print(mrcas)
         # raise Exception()
         return None
 
-    def WriteCachedHOGs(
-            self, 
-            cached_hogs, 
-            lock_hogs, 
-        ):
+    def WriteCachedHOGs(self, cached_hogs):
         """
+        Number the HOGs and write them. Must be called in orthogroup order, from
+        a single process.
         Args:
             cached_hogs - List[Tuple[str,List]], of hog names and rows of
         """
         d = defaultdict(list)
         for h, row in cached_hogs:
             d[h].append(row)
-        lock_hogs.acquire()
-        try:
-            for h, hog_rows in d.items():
-                fh = self.fhs[h]
-                for r in hog_rows:
-                    hog_id = "%s.HOG%07d" % (h, self.get_hog_index(h))
-                    util.writerow(fh, [hog_id, ] + r)
-                fh.flush()
-        finally:
-            lock_hogs.release()
+        for h, hog_rows in d.items():
+            i0 = self.get_hog_indices(h, len(hog_rows))
+            self.buffer_text(h, "".join([util.getrow(["%s.HOG%07d" % (h, i0 + i), ] + r) for i, r in enumerate(hog_rows)]))
 
     @staticmethod
     def scl_fn(n):
@@ -482,20 +509,20 @@ def GetHOGs_from_tree(
         iog, 
         tree, 
         hog_writer, 
-        lock_hogs, 
         q_split_paralogous_clades, 
     ):
+    """
+    Returns:
+        cached_hogs - List[Tuple[str,List]] of the HOG rows for the tree, to be written by HogWriter.WriteCachedHOGs
+    """
     og_name = "OG%07d" % iog
     if debug: print("\n===== %s =====" % og_name)
+    cached_hogs = []
     try:
         tree = hog_writer.mark_dups_below(tree)
-        cached_hogs = []
         for n in tree.traverse("preorder"):
             cached_hogs.extend(hog_writer.write_clade_v2(n, og_name, q_split_paralogous_clades))
-        hog_writer.WriteCachedHOGs(
-            cached_hogs, 
-            lock_hogs, 
-        )
+        return cached_hogs
     except:
         print("WARNING: HOG analysis for %s failed" % og_name)
         print("Please report to https://github.com/davidemms/OrthoFinder/issues including \
@@ -514,38 +541,59 @@ def get_highest_nodes(nodes, comp_nodes):
     return  {n for n in nodes if not any(n in comp_nodes[n2][1] for n2 in nodes)}
 
 
-def get_comparable_nodes(sp_tree):
-    """
-    Return a dictionary of comaprable nodes
-    Node NX < NY if NX is on the path between NY and the root.
-    If a node is not <, =, > another then they are incomparable
-    Args:
-        sp_tree - sp_tree with labelled nodes
-    Returns:
-        comp_nodes - dict:NX -> ( {n|n<NX}, {n|n>NX} ) i.e. (higher_nodes, lower_nodes)
-    """
-    comp_nodes = dict()
-    for n in sp_tree.traverse('postorder'):
-        nodes_below = set()
-        if not n.is_leaf():
-            for ch in n.get_children():
-                if not ch.is_leaf():
-                    nodes_below.update(ch.nodes_below)
-                nodes_below.add(ch.name)
-        above = set([nn.name for nn in n.get_ancestors()])
-        n.add_feature('nodes_below', nodes_below)
-        comp_nodes[n.name] = (above, nodes_below, above.union(nodes_below.union(set(n.name))))
-    return comp_nodes
-
 """
 Orthologs
 -------------------------------------------------------------------------------
 """ 
 
-def OutgroupIngroupSeparationScore(sp_up, sp_down, sett1, sett2, N_recip, n1, n2):
-    f_dup = len(sp_up.intersection(sett1)) * len(sp_up.intersection(sett2)) * len(sp_down.intersection(sett1)) * len(sp_down.intersection(sett2)) * N_recip
-    f_a = len(sp_up.intersection(sett1)) * (n2-len(sp_up.intersection(sett2))) * (n1-len(sp_down.intersection(sett1))) * len(sp_down.intersection(sett2)) * N_recip
-    f_b = (n1-len(sp_up.intersection(sett1))) * len(sp_up.intersection(sett2)) * len(sp_down.intersection(sett1)) * (n2-len(sp_down.intersection(sett2))) * N_recip
+def PopCount(x):
+    return bin(x).count("1")
+
+def GetSpeciesBitmasks(t, GeneToSpecies, species_bits):
+    """
+    The species below and above each node, as StoreSpeciesSets stores them, but
+    as integer bitmasks rather than sets
+    Args:
+        t - gene tree
+        GeneToSpecies - function: gene name -> species
+        species_bits - dict: species -> bitmask with a single bit set. Other species are not recorded
+    Returns:
+        sp_down - dict: node -> bitmask of the species of the genes below the node
+        sp_up - dict: node -> bitmask of the species of the genes not below the node
+    """
+    sp_down = dict()
+    for node in t.traverse('postorder'):
+        if node.is_leaf():
+            sp_down[node] = species_bits.get(GeneToSpecies(node.name), 0)
+        else:
+            x = 0
+            for ch in node.children:
+                x |= sp_down[ch]
+            sp_down[node] = x
+    sp_up = {t: 0}
+    for node in t.traverse('preorder'):
+        x_up = sp_up[node]
+        for ch in node.children:
+            x = x_up
+            for other in node.children:
+                if other is not ch:
+                    x |= sp_down[other]
+            sp_up[ch] = x
+    return sp_down, sp_up
+
+def OutgroupIngroupSeparationScore(sp_up, sp_down, mask1, mask2, N_recip, n1, n2):
+    """
+    Args:
+        sp_up, sp_down - bitmasks of the species above and below the candidate root
+        mask1, mask2 - bitmasks of the species in the two clades of the species tree split
+    """
+    up1 = PopCount(sp_up & mask1)
+    up2 = PopCount(sp_up & mask2)
+    down1 = PopCount(sp_down & mask1)
+    down2 = PopCount(sp_down & mask2)
+    f_dup = up1 * up2 * down1 * down2 * N_recip
+    f_a = up1 * (n2-up2) * (n1-down1) * down2 * N_recip
+    f_b = (n1-up1) * up2 * down1 * (n2-down2) * N_recip
     choice = (f_dup, f_a, f_b)
     return max(choice)
 
@@ -575,40 +623,48 @@ def GetRoots(tree, species_tree_rooted, GeneToSpecies):
     roots_list = []
     scores_list = []   # the fraction completeness of the two clades
 #    roots_set = set()
+    # label all nodes in gene tree with the species below and above them, this doesn't depend on the split
+    species_bits = {sp: 1 << i for i, sp in enumerate(species_tree_rooted.get_leaf_names())}
+    sp_down, sp_up = GetSpeciesBitmasks(tree, GeneToSpecies, species_bits)
+    nodes_postorder = list(tree.traverse('postorder'))
+    # ingroup/outgroup identification: T - only ingroup species, F - only outgroup species, TF - both
+    T = 1
+    F = 2
+    TF = T | F
     for i in xrange(len(leaves)):
         t1 = leaves[i]
         t2 = set.union(*[l for j,l in enumerate(leaves) if j!=i])
         # G - set of species in gene tree
         # First relevant split in species tree is (A,B), such that A \cap G \neq \emptyset and A \cap G \neq \emptyset
         # label all nodes in gene tree according the whether subsets of A, B or both lie below node
-        StoreSpeciesSets(tree, GeneToSpecies)   # sets of species
-        root_mapper = RootMap(t1, t2, GeneToSpecies)    
-        sett1 = set(t1)
-        sett2 = set(t2)
+        mask1 = 0
+        for sp in t1:
+            mask1 |= species_bits[sp]
+        mask2 = 0
+        for sp in t2:
+            mask2 |= species_bits[sp]
         nt1 = float(len(t1))
         nt2 = float(len(t2))
         N_recip = 1./(nt1*nt1*nt2*nt2)
-        GeneMap = root_mapper.GeneMap
-        StoreSpeciesSets(tree, GeneMap, "inout_") # ingroup/outgroup identification
+        inout_down = {m: (T if sp_down[m] & mask1 else 0) | (F if sp_down[m] & mask2 else 0) for m in nodes_postorder}
+        inout_up = {m: (T if sp_up[m] & mask1 else 0) | (F if sp_up[m] & mask2 else 0) for m in nodes_postorder}
         # find all possible locations in the gene tree at which the root should be
-
-        T = {True,}
-        F = {False,}
-        TF = set([True, False])
-        for m in tree.traverse('postorder'):
+        for m in nodes_postorder:
+            m_up = inout_up[m]
+            m_down = inout_down[m]
             if m.is_leaf(): 
-                if len(m.inout_up) == 1 and m.inout_up != m.inout_down:
+                if (m_up == T or m_up == F) and m_up != m_down:
                     # this is the unique root
                     return [m]
             else:
-                if len(m.inout_up) == 1 and len(m.inout_down) == 1 and m.inout_up != m.inout_down:
+                if (m_up == T or m_up == F) and (m_down == T or m_down == F) and m_up != m_down:
                     # this is the unique root
                     return [m]
                 nodes = m.get_children() if m.is_root() else [m] + m.get_children()
-                clades = [ch.inout_down for ch in nodes] if m.is_root() else ([m.inout_up] + [ch.inout_down for ch in m.get_children()])
+                clades = [inout_down[ch] for ch in nodes] if m.is_root() else ([m_up] + [inout_down[ch] for ch in m.get_children()])
                 # do we have the situation A | B or (A,B),S?
                 if len(nodes) == 3:
-                    if all([len(c) == 1 for c in clades]) and T in clades and F in clades:
+                    if all([c == T or c == F for c in clades]) and T in clades and F in clades:
                         # unique root
                         if clades.count(T) == 1:
                             return [nodes[clades.index(T)]]
@@ -619,18 +675,14 @@ def GetRoots(tree, species_tree_rooted, GeneToSpecies):
                         ab = [c == TF for c in clades]
                         i = ab.index(True)
                         roots_list.append(nodes[i])
-                        sp_down = nodes[i].sp_down
-                        sp_up = nodes[i].sp_up
 #                        print(m)
-                        scores_list.append(OutgroupIngroupSeparationScore(sp_up, sp_down, sett1, sett2, N_recip, nt1, nt2))
+                        scores_list.append(OutgroupIngroupSeparationScore(sp_up[nodes[i]], sp_down[nodes[i]], mask1, mask2, N_recip, nt1, nt2))
                     elif clades.count(TF) >= 2:  
                         # (A,A,A)-excluded, (A,A,AB)-ignore as want A to be bigest without including B, (A,AB,AB), (AB,AB,AB) 
                         i = 0
                         roots_list.append(nodes[i])
-                        sp_down = nodes[i].sp_down
-                        sp_up = nodes[i].sp_up
 #                        print(m)
-                        scores_list.append(OutgroupIngroupSeparationScore(sp_up, sp_down, sett1, sett2, N_recip, nt1, nt2))
+                        scores_list.append(OutgroupIngroupSeparationScore(sp_up[nodes[i]], sp_down[nodes[i]], mask1, mask2, N_recip, nt1, nt2))
                 elif T in clades and F in clades:
                     roots_list.append(m)
                     scores_list.append(0)  # last choice
@@ -662,12 +714,82 @@ def GetGeneToSpeciesMap(args):
         GeneToSpecies = GeneToSpecies_hyphen  
     return GeneToSpecies
   
-def OverlapSize(node, GeneToSpecies, suspect_genes):  
-    descendents = [{GeneToSpecies(l) for l in n.get_leaf_names()}.difference(suspect_genes) for n in node.get_children()]
+class LeafIntervals(object):
+    """
+    The leaves of a gene tree in the order get_leaf_names returns them, the range
+    of them below each node and the species below each node as a bitmask, all
+    found in one postorder traversal. The leaves and species below a node can then
+    be looked up without visiting the subtree. The tree structure must not be 
+    modified while this is in use.
+    """
+    def __init__(self, tree, GeneToSpecies):
+        self.names = []
+        self.species = []
+        self.interval = dict()
+        self.sp_mask = dict()
+        self.species_bits = dict()
+        self.bit_species = []
+        self.species_sets = dict()
+        for n in tree.traverse('postorder'):
+            if n.is_leaf():
+                sp = GeneToSpecies(n.name)
+                if sp not in self.species_bits:
+                    self.species_bits[sp] = 1 << len(self.bit_species)
+                    self.bit_species.append(sp)
+                i = len(self.names)
+                self.names.append(n.name)
+                self.species.append(sp)
+                self.interval[n] = (i, i+1)
+                self.sp_mask[n] = self.species_bits[sp]
+            else:
+                mask = 0
+                for ch in n.children:
+                    mask |= self.sp_mask[ch]
+                self.interval[n] = (self.interval[n.children[0]][0], self.interval[n.children[-1]][1])
+                self.sp_mask[n] = mask
+
+    def LeafNames(self, node):
+        i, j = self.interval[node]
+        return self.names[i:j]
+
+    def LeafNamesAndSpecies(self, node):
+        i, j = self.interval[node]
+        return zip(self.names[i:j], self.species[i:j])
+
+    def Species(self, node):
+        """
+        Returns:
+            species - frozenset of the species of the genes below the node
+        """
+        mask = self.sp_mask[node]
+        try:
+            return self.species_sets[mask]
+        except KeyError:
+            species = []
+            x = mask
+            while x:
+                bit = x & -x
+                species.append(self.bit_species[bit.bit_length() - 1])
+                x ^= bit
+            self.species_sets[mask] = frozenset(species)
+            return self.species_sets[mask]
+
+    def NumberOfSpecies(self, node):
+        return bin(self.sp_mask[node]).count("1")
+
+def OverlapSize(node, GeneToSpecies, suspect_genes, leaf_intervals=None):  
+    """
+    Args:
+        leaf_intervals - LeafIntervals for the tree, otherwise the leaves below the node's children are visited
+    """
+    if leaf_intervals is None:
+        descendents = [{GeneToSpecies(l) for l in n.get_leaf_names()}.difference(suspect_genes) for n in node.get_children()]
+    else:
+        descendents = [set(leaf_intervals.Species(n)).difference(suspect_genes) for n in node.get_children()]
     intersection = descendents[0].intersection(descendents[1])
     return len(intersection), intersection, descendents[0], descendents[1]
 
-def ResolveOverlap(overlap, sp0, sp1, ch, tree, neighbours, GeneToSpecies, relOverlapCutoff=4):
+def ResolveOverlap(overlap, sp0, sp1, ch, tree, neighbours, GeneToSpecies, relOverlapCutoff=4, leaf_intervals=None):
     """
     Is an overlap suspicious and if so can it be resolved by identifying genes that are out of place?
     Args:
@@ -677,6 +799,7 @@ def ResolveOverlap(overlap, sp0, sp1, ch, tree, neighbours, GeneToSpecies, relOv
         ch - the two child nodes
         tree - the gene tree
         neighbours - dictionary species->neighbours, where neighbours is a list of the sets of species observed at successive topological distances from the species
+        leaf_intervals - LeafIntervals for the tree, otherwise the leaves below nodes are visited
     Returns:
         qSuccess - has the overlap been resolved
         genes_removed - the out-of-place genes that have been removed so as to resolve the overlap
@@ -698,19 +821,28 @@ def ResolveOverlap(overlap, sp0, sp1, ch, tree, neighbours, GeneToSpecies, relOv
     nB_removed = 0
     qResolved = True
     for sp in overlap:
-        A = [g for g in ch[0].get_leaf_names() if GeneToSpecies(g) == sp]
-        B = [g for g in ch[1].get_leaf_names() if GeneToSpecies(g) == sp]
+        if leaf_intervals is None:
+            A = [g for g in ch[0].get_leaf_names() if GeneToSpecies(g) == sp]
+            B = [g for g in ch[1].get_leaf_names() if GeneToSpecies(g) == sp]
+        else:
+            A = [g for g, s in leaf_intervals.LeafNamesAndSpecies(ch[0]) if s == sp]
+            B = [g for g, s in leaf_intervals.LeafNamesAndSpecies(ch[1]) if s == sp]
         A_levels = []
         B_levels = []
         for X, level in zip((A,B),(A_levels, B_levels)):
             for g in X:
                 gene_node = tree & g
                 r = gene_node.up
-                nextSpecies = set([GeneToSpecies(gg) for gg in r.get_leaf_names()])
                 # having a gene from the same species isn't enough?? No, but we add to the count I think.
-                while len(nextSpecies) == 1:
-                    r = r.up
+                if leaf_intervals is None:
                     nextSpecies = set([GeneToSpecies(gg) for gg in r.get_leaf_names()])
+                    while len(nextSpecies) == 1:
+                        r = r.up
+                        nextSpecies = set([GeneToSpecies(gg) for gg in r.get_leaf_names()])
+                else:
+                    while leaf_intervals.NumberOfSpecies(r) == 1:
+                        r = r.up
+                    nextSpecies = set(leaf_intervals.Species(r))
                 nextSpecies.remove(sp)
                 # get the level
                 # the sum of the closest and furthest expected distance topological distance for the closest genes in the gene tree (based on species tree topology)
@@ -750,15 +882,9 @@ def CheckAndRootTree(treeFN, species_tree_rooted, GeneToSpecies):
     """
     if (not os.path.exists(treeFN)) or os.stat(treeFN).st_size == 0:
         return None, False
-    qHaveSupport = False
-    try:
-        tree = tree_lib.Tree(treeFN, format=2)
-        qHaveSupport = True
-    except:
-        try:
-            tree = tree_lib.Tree(treeFN)
-        except:
-            tree = tree_lib.Tree(treeFN, format=3)
+    # Internal node labels are support values if possible, otherwise names
+    tree, treeFormat = newick.read_newick_first_format(treeFN, (2, 0, 3))
+    qHaveSupport = treeFormat == 2
     if len(tree) == 1: 
         return None, False
     root = GetRoot(tree, species_tree_rooted, GeneToSpecies)
@@ -769,11 +895,12 @@ def CheckAndRootTree(treeFN, species_tree_rooted, GeneToSpecies):
         tree.set_outgroup(root)
     return tree, qHaveSupport
 
-def Orthologs_and_Suspect(ch, suspect_genes, misplaced_genes, SpeciesAndGene):
+def Orthologs_and_Suspect(ch, suspect_genes, misplaced_genes, SpeciesAndGene, leaf_intervals=None):
     """
     ch - the two child nodes that are orthologous
     suspect_genes - genes already identified as misplaced at lower levels
     misplaced_genes - genes identified as misplaced at this level
+    leaf_intervals - LeafIntervals for the tree, otherwise the leaves below the nodes are visited
 
     Returns the tuple (o_0, o_1, os_0, os_1) where each element is a dictionary from species to genes from that species,
     the o are orthologs, the os are 'suspect' orthologs because the gene was previously identified as suspect
@@ -781,7 +908,8 @@ def Orthologs_and_Suspect(ch, suspect_genes, misplaced_genes, SpeciesAndGene):
     d = [defaultdict(list) for _ in range(2)]
     d_sus = [defaultdict(list) for _ in range(2)] 
     for node, di, d_susi in zip(ch, d, d_sus):
-        for g in [g for g in node.get_leaf_names() if g not in misplaced_genes]:
+        leaves = node.get_leaf_names() if leaf_intervals is None else leaf_intervals.LeafNames(node)
+        for g in [g for g in leaves if g not in misplaced_genes]:
             sp, seq = SpeciesAndGene(g)
             if g in suspect_genes:
                 d_susi[sp].append(seq)
@@ -797,9 +925,12 @@ def GetOrthologues_from_tree(
         GeneToSpecies, 
         neighbours,
         q_get_dups=False, 
-        qNoRecon=False
+        qNoRecon=False,
+        species_tree_lca=None
     ):
     """ 
+    Args:
+        species_tree_lca - tools/tree_lca.TreeLCA for species_tree_rooted, if it has already been built
     Returns:
         orthologues 
         tree - Each node of the tree has two features added: dup (bool) and sp_node (str)
@@ -808,6 +939,8 @@ def GetOrthologues_from_tree(
     """
     og_name = "OG%07d" % iog
     n_species = len(species_tree_rooted)
+    if species_tree_lca is None:
+        species_tree_lca = tree_lca.TreeLCA(species_tree_rooted)
     # max_genes_dups = 5*n_species
     # max_genes_text = (">%d genes" % max_genes_dups,)
     qPrune=False
@@ -816,7 +949,11 @@ def GetOrthologues_from_tree(
     duplications = []
     if not qNoRecon: tree = Resolve(tree, GeneToSpecies)
     if qPrune: tree.prune(tree.get_leaf_names())
+    # genes are looked up by name when resolving overlaps
+    tree.enable_name_index()
     if len(tree) == 1: return set(orthologues), tree, set(), duplications
+    # the leaves and species below each node, the tree structure doesn't change from here
+    leaf_intervals = LeafIntervals(tree, GeneToSpecies)
     """ At this point need to label the tree nodes """
     iNode = 1
     tree.name = "n0"
@@ -834,13 +971,13 @@ def GetOrthologues_from_tree(
         ## Don't know sorting is needed
         # ch = sorted(n.get_children(), key=lambda child: child.name) 
         if len(ch) == 2: 
-            oSize, overlap, sp0, sp1 = OverlapSize(n, GeneToSpecies, suspect_genes)
+            oSize, overlap, sp0, sp1 = OverlapSize(n, GeneToSpecies, suspect_genes, leaf_intervals)
             sp_present = sp0.union(sp1)
-            stNode = MRCA_node(species_tree_rooted, sp_present)
+            stNode = species_tree_lca.MRCA(sp_present)
             n.add_feature("sp_node", stNode.name)
             if oSize != 0:
                 # this should be moved to the tree resolution step. Except that doesn't use the species tree, so can't
-                qResolved, misplaced_genes = ResolveOverlap(overlap, sp0, sp1, ch, tree, neighbours, GeneToSpecies) 
+                qResolved, misplaced_genes = ResolveOverlap(overlap, sp0, sp1, ch, tree, neighbours, GeneToSpecies, leaf_intervals=leaf_intervals) 
                 # label the removed genes
                 for g in misplaced_genes:
                     nn = tree & g
@@ -853,36 +990,36 @@ def GetOrthologues_from_tree(
                 if q_get_dups:
                     # genes0 = ch[0].get_leaf_names() if len(ch[0]) <= max_genes_dups else max_genes_text
                     # genes1 = ch[1].get_leaf_names() if len(ch[1]) <= max_genes_dups else max_genes_text
-                    genes0 = ch[0].get_leaf_names()
-                    genes1 = ch[1].get_leaf_names()
+                    genes0 = leaf_intervals.LeafNames(ch[0])
+                    genes1 = leaf_intervals.LeafNames(ch[1])
                     duplications.append((stNode.name, n.name, float(oSize)/(len(stNode)), genes0, genes1))
             else:
                 # sort out bad genes - no orthology for all the misplaced genes at this level (misplaced_genes). 
                 # For previous levels, (suspect_genes) have their orthologues written to suspect orthologues file
-                orthologues.append(Orthologs_and_Suspect(ch, suspect_genes, misplaced_genes, SpeciesAndGene))
+                orthologues.append(Orthologs_and_Suspect(ch, suspect_genes, misplaced_genes, SpeciesAndGene, leaf_intervals))
                 suspect_genes.update(misplaced_genes)
         elif len(ch) > 2:
-            species = [{GeneToSpecies(l) for l in n_.get_leaf_names()} for n_ in ch]
-            all_species = set.union(*species)
-            stNode = MRCA_node(species_tree_rooted, all_species)
+            species_masks = [leaf_intervals.sp_mask[n_] for n_ in ch]
+            all_species = leaf_intervals.Species(n)
+            stNode = species_tree_lca.MRCA(all_species)
             n.add_feature("sp_node", stNode.name)
             # should skip if everything below this is a single species, but should write out the duplications
             if len(all_species) == 1:
                 # genes = n.get_leaf_names() if len(n) <= max_genes_dups else max_genes_text
-                genes = n.get_leaf_names()
+                genes = leaf_intervals.LeafNames(n)
                 duplications.append((stNode.name, n.name, 1., genes, []))
                 n.add_feature("dup", True)  
             else:
                 dups = []
-                for (n0, s0), (n1, s1) in itertools.combinations(zip(ch, species), 2):
-                    if len(s0.intersection(s1)) == 0:
-                        orthologues.append(Orthologs_and_Suspect((n0, n1), suspect_genes, empty_set, SpeciesAndGene))
+                for (n0, s0), (n1, s1) in itertools.combinations(zip(ch, species_masks), 2):
+                    if s0 & s1 == 0:
+                        orthologues.append(Orthologs_and_Suspect((n0, n1), suspect_genes, empty_set, SpeciesAndGene, leaf_intervals))
                         dups.append(False)
                     else:
                         dups.append(True)
                 if all(dups):
                     # genes = n.get_leaf_names() if len(n) <= max_genes_dups else max_genes_text
-                    genes = n.get_leaf_names()
+                    genes = leaf_intervals.LeafNames(n)
                     duplications.append((stNode.name, n.name, 1., genes, []))
                 n.add_feature("dup", all(dups))
                 # # if there are nodes below with same MRCA then dup (no HOGs) otherwise not dup (=> HOGS at this level)
@@ -900,7 +1037,8 @@ def GetLinesForOlogFiles(
         qContainsSuspectOlogs, 
         olog_lines, 
         olog_sus_lines, 
-        fewer_open_files
+        fewer_open_files,
+        olog_rows=None
     ):
     """
     Prepare the lines of text for the pairwise ortholog files and the species-wise
@@ -908,6 +1046,8 @@ def GetLinesForOlogFiles(
     Args:
         orthologues_alltrees - list of tuples (iog, (leavesL, leavesR, sus_leavesL, sus_leavesR))
         where each of the leavesL etc. is a dictionary, l : isp -> (iseq0, iseq0, ...)
+        olog_rows - if not None, append (iog, iL, iR, genesL, genesR) to this list 
+        for each row instead of writing text to olog_lines, see ortholog_pairs
           
     Implementation:
     Look at the genes and organise them per species. This is in contrast to the 
@@ -937,14 +1077,17 @@ def GetLinesForOlogFiles(
                     spR_ = spR + "_"
                     iR = sp_to_index[spR]
                     nR = len(genesR)
-                    textL = ", ".join([sequenceDict[spL_ + g] for g in genesL])
-                    textR = ", ".join([sequenceDict[spR_ + g] for g in genesR])
-                    if fewer_open_files:
-                        olog_lines[iL][0] += util.getrow((og, speciesDict[spR], textL, textR))
-                        olog_lines[iR][0] += util.getrow((og, speciesDict[spL], textR, textL))
+                    if olog_rows is not None:
+                        olog_rows.append((iog, iL, iR, genesL, genesR))
                     else:
-                        olog_lines[iL][iR] += util.getrow((og, textL, textR))
-                        olog_lines[iR][iL] += util.getrow((og, textR, textL))
+                        textL = ", ".join([sequenceDict[spL_ + g] for g in genesL])
+                        textR = ", ".join([sequenceDict[spR_ + g] for g in genesR])
+                        if fewer_open_files:
+                            olog_lines[iL][0] += util.getrow((og, speciesDict[spR], textL, textR))
+                            olog_lines[iR][0] += util.getrow((og, speciesDict[spL], textR, textL))
+                        else:
+                            olog_lines[iL][iR] += util.getrow((og, textL, textR))
+                            olog_lines[iR][iL] += util.getrow((og, textR, textL))
                     nOrtho.n[iL, iR] += nL
                     nOrtho.n[iR, iL] += nR
                     if nL == 1 and nR == 1:
@@ -1040,7 +1183,7 @@ def Worker_RootAndGetOrthologues_from_tree(iog, tree_fn, species_tree_rooted, Ge
             result_queue.put((iog, e))
 
 
-def GetOrthologuesStandalone_Parallel(trees_dir, species_tree_rooted_fn, GeneToSpecies, output_dir, qSingleTree):
+def GetOrthologuesStandalone_Parallel(trees_dir, species_tree_rooted_fn, GeneToSpecies, output_dir, qSingleTree, nProcesses=nThreadsDefault):
     species_tree_rooted = tree_lib.Tree(species_tree_rooted_fn)
     neighbours = GetSpeciesNeighbours(species_tree_rooted)
     args_queue = mp.Queue()
@@ -1049,17 +1192,14 @@ def GetOrthologuesStandalone_Parallel(trees_dir, species_tree_rooted_fn, GeneToS
         args_queue.put((0, treeFn, species_tree_rooted, GeneToSpecies, neighbours))
         task_size += 1
     # Now need to root the tree first
-    parallel_task_manager.RunMethodParallel(RootAndGetOrthologues_from_tree, args_queue, 16, task_size)
+    parallel_task_manager.RunMethodParallel(RootAndGetOrthologues_from_tree, args_queue, nProcesses, task_size)
 
 def RootTreeStandalone_Serial(trees_dir, species_tree_rooted_fn, GeneToSpecies, output_dir, qSingleTree):
     species_tree_rooted = tree_lib.Tree(species_tree_rooted_fn)
 #    args_queue = mp.Queue()
     for treeFN in glob.glob(trees_dir + ("*" if qSingleTree else "/*")): 
         if (not os.path.exists(treeFN)) or os.stat(treeFN).st_size == 0: return 
-        try:
-            tree = tree_lib.Tree(treeFN)
-        except:
-            tree = tree_lib.Tree(treeFN, format=3)
+        tree, _ = newick.read_newick_first_format(treeFN, (0, 3))
         if len(tree) == 1: return 
         root = GetRoot(tree, species_tree_rooted, GeneToSpecies)
         if root == None: return 
@@ -1087,8 +1227,13 @@ class OrthologsFiles(object):
             nSpecies, 
             sp_to_index, 
             save_space, 
-            fewer_open_files=False
+            fewer_open_files=False,
+            q_ortholog_files=True
     ):
+        """
+        q_ortholog_files - False if the orthologs are written by an ortholog_pairs.OrthologPairsWriter
+        instead, in which case only the putative xenolog files are opened
+        """
         self.d = directory
         self.speciesDict = speciesDict
         self.iSpeciesToUse = iSpeciesToUse
@@ -1099,11 +1244,14 @@ class OrthologsFiles(object):
         self.xenolog_file_handles = [None for _ in self.iSpeciesToUse]
         self.fewer_open_files = fewer_open_files
         self.save_space = save_space
+        self.q_ortholog_files = q_ortholog_files
 
     def __enter__(self):
         for i in xrange(self.nSpecies):
             sp0 = str(self.iSpeciesToUse[i])
             self.xenolog_file_handles[i] = open(self.dPutativeXenologs + "%s.tsv" % self.speciesDict[sp0], util.csv_append_mode)
+            if not self.q_ortholog_files:
+                continue
             strsp0 = sp0 + "_"
             isp0 = self.sp_to_index[sp0]
             d0 = self.d + "Orthologues_" + self.speciesDict[sp0] + "/"
@@ -1153,17 +1301,29 @@ def InitialiseSuspectGenesDirs(nspecies, speciesIDs, speciesDict):
             writer1 = csv.writer(outfile, delimiter="\t")
             writer1.writerow(("Orthogroup", speciesDict[str(speciesIDs[index1])], "Other"))
 
-def WriteSuspectGenes(nspecies, speciesToUse, suspect_genes, speciesDict, SequenceDict):
+def GetSuspectGenesLines(nspecies, speciesToUse, suspect_genes, speciesDict, SequenceDict):
+    """
+    Returns:
+        suspect_genes_lines - list of (species name, text for the species' suspect genes file)
+    """
     species = list(map(str, speciesToUse))
-    dSuspectGenes = files.FileHandler.GetSuspectGenesDir()
+    suspect_genes_lines = []
     for index0 in xrange(nspecies):
         strsp0 = species[index0]
         strsp0_ = strsp0+"_"
         these_genes = [g for g in suspect_genes if g.startswith(strsp0_)]
         if len(these_genes) > 0:
-            with open(dSuspectGenes + speciesDict[strsp0] + ".txt", util.csv_append_mode) as outfile:
-                # not a CSV file so \n line endings are fine
-                outfile.write("\n".join([SequenceDict[g] for g in these_genes]) + "\n")
+            # not a CSV file so \n line endings are fine
+            suspect_genes_lines.append((speciesDict[strsp0], "\n".join([SequenceDict[g] for g in these_genes]) + "\n"))
+    return suspect_genes_lines
+
+def WriteSuspectGenes(suspect_genes_lines):
+    if len(suspect_genes_lines) == 0:
+        return
+    dSuspectGenes = files.FileHandler.GetSuspectGenesDir()
+    for species_name, text in suspect_genes_lines:
+        with open(dSuspectGenes + species_name + ".txt", util.csv_append_mode) as outfile:
+            outfile.write(text)
 
 def WriteDuplications(dups_file_handle, og_name, duplications, spIDs, seqIDs, stride_dups):
     """
@@ -1195,8 +1355,13 @@ def DoOrthologuesForOrthoFinder(
         print_info=True,
         exist_msa=True,
         write_hog_tree=True,
-        fix_files=True
+        fix_files=True,
+        pairs_writer=None,
     ):
+    """
+    pairs_writer - ortholog_pairs.OrthologPairsWriter to write the orthologs to 
+    instead of the pairwise ortholog files, or None
+    """
     try:
         # Create directory structure
         speciesDict = ogSet.SpeciesDict()
@@ -1205,7 +1370,7 @@ def DoOrthologuesForOrthoFinder(
         nspecies = len(ogSet.speciesToUse)      
         dResultsOrthologues = files.FileHandler.GetOrthologuesDirectory()
 
-        if not write_hog_tree or not fix_files:
+        if (not write_hog_tree or not fix_files) and pairs_writer is None:
             for index1 in xrange(nspecies):
                 if fewer_open_files or save_space:  # current thinking (2023.03) is that fewer_open_files will always be true anyway
                     filename = dResultsOrthologues + '%s.tsv' % speciesDict[str(ogSet.speciesToUse[index1])]
@@ -1221,6 +1386,7 @@ def DoOrthologuesForOrthoFinder(
                             writer1 = csv.writer(outfile, delimiter="\t")
                             writer1.writerow(("Orthogroup", speciesDict[str(ogSet.speciesToUse[index1])], speciesDict[str(ogSet.speciesToUse[index2])]))
         
+        if not write_hog_tree or not fix_files:
             InitialiseSuspectGenesDirs(nspecies, ogSet.speciesToUse, speciesDict)
             
         neighbours = GetSpeciesNeighbours(species_tree_rooted_labelled)
@@ -1238,7 +1404,8 @@ def DoOrthologuesForOrthoFinder(
                     nspecies, 
                     sp_to_index, 
                     save_space, 
-                    fewer_open_files
+                    fewer_open_files,
+                    q_ortholog_files=pairs_writer is None
                 ) as (ologs_file_handles, putative_xenolog_file_handles):
             
             if not write_hog_tree or not fix_files:
@@ -1247,7 +1414,8 @@ def DoOrthologuesForOrthoFinder(
                     ["Orthogroup", "Species Tree Node", "Gene Tree Node", "Support", "Type", "Genes 1", "Genes 2"]
                 )
                 outfile_dups.flush()
-                OrthologsFiles.flush_olog_files(ologs_file_handles, fewer_open_files)
+                if pairs_writer is None:
+                    OrthologsFiles.flush_olog_files(ologs_file_handles, fewer_open_files)
 
             ta = TreeAnalyser(
                 len(iogs4), 
@@ -1270,7 +1438,8 @@ def DoOrthologuesForOrthoFinder(
                 fewer_open_files=fewer_open_files,
                 exist_msa=exist_msa,
                 write_hog_tree=write_hog_tree,
-                fix_files=fix_files
+                fix_files=fix_files,
+                pairs_writer=pairs_writer,
             )
 
             total_tasks = len(iogs4)
@@ -1281,7 +1450,6 @@ def DoOrthologuesForOrthoFinder(
                 update_cycle = 1
                 completed_tasks = 0
                 nOrthologues_SpPair = util.nOrtho_sp(nspecies)
-                dummy_lock = mp.Lock()
                 for iog in iogs4:
                     completed_tasks += 1
                     if (completed_tasks + 1) % update_cycle == 0:
@@ -1290,46 +1458,9 @@ def DoOrthologuesForOrthoFinder(
                     results = ta.AnalyseTree(iog) 
                     if results is None:
                         continue
-                    nOrthologues_this, olog_lines, olog_sus_lines = results
-                    if nOrthologues_this.n.sum() == 0 and sum(map(len, olog_sus_lines)) == 0: 
-                        continue
+                    nOrthologues_this, tree_results = results
                     nOrthologues_SpPair += nOrthologues_this
-                    if fewer_open_files:
-                        for i in range(nspecies):
-                            if len(olog_lines[i][0]) > 0:
-                                WriteOlogLinesToFile(
-                                    ta.ologs_files_handles[i][0], 
-                                    olog_lines[i][0], 
-                                    dummy_lock,
-                                    write_hog_tree=write_hog_tree,
-                                    fix_files=fix_files,
-                                )
-                    else:
-                        for i in range(nspecies):
-                            for j in range(i+1, nspecies):
-                                if len(olog_lines[i][j]) > 0:
-                                    # j is the largest (and intentionally changing quickest, which I think is best for the lock)
-                                    WriteOlogLinesToFile(
-                                        ta.ologs_files_handles[i][j], 
-                                        olog_lines[i][j], 
-                                        dummy_lock,
-                                        write_hog_tree=write_hog_tree,
-                                        fix_files=fix_files,
-                                    )
-                                    WriteOlogLinesToFile(
-                                        ta.ologs_files_handles[j][i], 
-                                        olog_lines[j][i], 
-                                        dummy_lock,
-                                        write_hog_tree=write_hog_tree,
-                                        fix_files=fix_files,
-                                    )
-                            WriteOlogLinesToFile(
-                                ta.putative_xenolog_file_handles[i], 
-                                olog_sus_lines[i], 
-                                dummy_lock,
-                                write_hog_tree=write_hog_tree,
-                                fix_files=fix_files,
-                            )
+                    ta.WriteTreeResults(tree_results)
                 progressbar.stop()
                 if print_info:
                     util.PrintTime("Done writing orthologs")
@@ -1343,11 +1474,7 @@ def DoOrthologuesForOrthoFinder(
                     args_queue, 
                     n_parallel,
                     total_tasks,  
-                    fewer_open_files, 
-                    n_ologs_cache=100,
                     old_version=old_version,
-                    write_hog_tree=write_hog_tree,
-                    fix_files=fix_files
                 )
     except IOError as e:
         if str(e).startswith("[Errno 24] Too many open files"):
@@ -1358,6 +1485,19 @@ def DoOrthologuesForOrthoFinder(
     return nOrthologues_SpPair
 
 
+class TreeResults(object):
+    """
+    The text from the analysis of one gene tree for each of the output files
+    """
+    def __init__(self, nspecies, dim2):
+        self.olog_lines = [["" for j in xrange(dim2)] for i in xrange(nspecies)]
+        self.olog_sus_lines = ["" for i in xrange(nspecies)]
+        self.dups_text = ""
+        self.suspect_genes_lines = []   # list of (species name, text)
+        self.hogs = []                  # list of (HOG level, row without the HOG ID)
+        self.olog_pairs = None          # ortholog_pairs.GetPairsArray array if there is a pairs_writer
+
+
 class TreeAnalyser(object):
     def __init__(
             self, 
@@ -1382,11 +1522,19 @@ class TreeAnalyser(object):
             exist_msa=True,
             write_hog_tree=True,
             fix_files=True,
+            pairs_writer=None,
     ):
+        """
+        The file handles are only written to by WriteTreeResults, from the parent
+        process
+        pairs_writer - ortholog_pairs.OrthologPairsWriter to write the orthologs to
+        instead of ologs_files_handles, or None
+        """
         self.nOgs = nOgs
         self.dResultsOrthologues = dResultsOrthologues
         self.reconTreesRenamedDir = reconTreesRenamedDir
         self.species_tree_rooted_labelled = species_tree_rooted_labelled
+        self.species_tree_lca = tree_lca.TreeLCA(species_tree_rooted_labelled)
         self.speciesToUse = speciesToUse
         self.nspecies = len(self.speciesToUse)
         self.GeneToSpecies = GeneToSpecies
@@ -1403,19 +1551,23 @@ class TreeAnalyser(object):
         self.hog_writer = hog_writer
         self.q_split_paralogous_clades = q_split_paralogous_clades
         self.fewer_open_files = fewer_open_files
-        self.lock_ologs = [mp.Lock() for i in range(self.nspecies)]   # lock the larger of the two species index
-        self.lock_dups = mp.Lock()
-        self.lock_suspect = mp.Lock()
-        self.lock_hogs = mp.Lock()
         self.exist_msa = exist_msa
         self.write_hog_tree = write_hog_tree
         self.fix_files = fix_files
+        self.pairs_writer = pairs_writer
 
     def AnalyseTree(self, iog):
+        """
+        Returns:
+            None if there is no tree to analyse, otherwise
+            nOrthologues_SpPair - util.nOrtho_sp, the number of orthologues between each pair of species
+            results - TreeResults, the text to write to the output files
+        """
+        dim2 = 1 if self.fewer_open_files else self.nspecies
+        results = TreeResults(self.nspecies, dim2)
         try:  
             og_name = "OG%07d" % iog
             n_species = len(self.speciesToUse)
-            dim2 = 1 if self.fewer_open_files else self.nspecies
 
             if self.write_hog_tree or not self.fix_files: 
                 if not os.path.exists(files.FileHandler.GetOGsTreeFN(iog)):
@@ -1462,36 +1614,31 @@ class TreeAnalyser(object):
                     self.GeneToSpecies, 
                     self.neighbours, 
                     q_get_dups=True, 
-                    qNoRecon=self.qNoRecon
+                    qNoRecon=self.qNoRecon,
+                    species_tree_lca=self.species_tree_lca
             )
             
             if not self.write_hog_tree or not self.fix_files: 
-                # Write Duplications
-                self.lock_dups.acquire()
-                try:                                                        
-                    WriteDuplications(
-                        self.dups_file_handle, 
-                        og_name, 
-                        dups, 
-                        self.speciesDict, 
-                        self.spec_seq_dict, 
-                        self.stride_dups
-                    )
-                    self.dups_file_handle.flush()
-                finally:
-                    self.lock_dups.release()
-
-                # Write Suspect Genes
+                # Duplications
+                dups_text = io.StringIO()
+                WriteDuplications(
+                    dups_text, 
+                    og_name, 
+                    dups, 
+                    self.speciesDict, 
+                    self.spec_seq_dict, 
+                    self.stride_dups
+                )
+                results.dups_text = dups_text.getvalue()
+
+                # Suspect Genes
                 if len(suspect_genes) > 0:
-                    self.lock_suspect.acquire()
-                    try:
-                        WriteSuspectGenes(n_species, self.speciesToUse, suspect_genes, self.speciesDict, self.SequenceDict)
-                    finally:
-                        self.lock_suspect.release()
+                    results.suspect_genes_lines = GetSuspectGenesLines(n_species, self.speciesToUse, suspect_genes, self.speciesDict, self.SequenceDict)
 
             # Get Orthologues
             olog_lines = [["" for j in xrange(dim2)] for i in xrange(self.nspecies)]
             olog_sus_lines = ["" for i in xrange(self.nspecies)]
+            olog_rows = None if self.pairs_writer is None else []
             nOrthologues_SpPair = GetLinesForOlogFiles(
                 [(iog, ologs)], 
                 self.speciesDict, 
@@ -1500,16 +1647,20 @@ class TreeAnalyser(object):
                 len(suspect_genes) > 0, 
                 olog_lines,
                 olog_sus_lines, 
-                fewer_open_files=self.fewer_open_files
+                fewer_open_files=self.fewer_open_files,
+                olog_rows=olog_rows
             )
+            if olog_rows is not None:
+                results.olog_pairs = ortholog_pairs.GetPairsArray(olog_rows, self.nspecies)
 
-            GetHOGs_from_tree(
+            results.hogs = GetHOGs_from_tree(
                 iog, 
                 recon_tree, 
                 self.hog_writer, 
-                self.lock_hogs, 
                 self.q_split_paralogous_clades,
             ) 
+            results.olog_lines = olog_lines
+            results.olog_sus_lines = olog_sus_lines
 
             # don't relabel nodes, they've already been done
             
@@ -1528,155 +1679,108 @@ class TreeAnalyser(object):
             # if iog > 0 and divmod(iog, 10 if self.nOgs <= 200 else 100 if self.nOgs <= 2000 else 1000)[1] == 0:
             #     util.PrintTime("Done %d of %d" % (iog, self.nOgs))
 
-            return nOrthologues_SpPair, olog_lines, olog_sus_lines
+            return nOrthologues_SpPair, results
         except Exception as e:
             print(str(e))
             print("WARNING: Unknown error analysing tree %s" % og_name)
-            olog_lines = [["" for j in xrange(self.nspecies)] for i in xrange(self.nspecies)]
-            olog_sus_lines = ["" for i in xrange(self.nspecies)]
-            return util.nOrtho_sp(n_species), olog_lines, olog_sus_lines
+            # keep the output from the steps that completed, as if it had been written already
+            results.olog_lines = [["" for j in xrange(dim2)] for i in xrange(self.nspecies)]
+            results.olog_sus_lines = ["" for i in xrange(self.nspecies)]
+            results.olog_pairs = None
+            return util.nOrtho_sp(n_species), results
+
+    def WriteTreeResults(self, results):
+        """
+        Write the results for a tree to the output files. Must be called in
+        orthogroup order.
+        Args:
+            results - TreeResults
+        """
+        if not self.write_hog_tree or not self.fix_files: 
+            if len(results.dups_text) > 0:
+                self.dups_file_handle.write(results.dups_text)
+            WriteSuspectGenes(results.suspect_genes_lines)
+            for i in range(self.nspecies):
+                if self.fewer_open_files:
+                    if len(results.olog_lines[i][0]) > 0:
+                        self.ologs_files_handles[i][0].write(results.olog_lines[i][0])
+                else:
+                    for j in range(self.nspecies):
+                        if len(results.olog_lines[i][j]) > 0:
+                            self.ologs_files_handles[i][j].write(results.olog_lines[i][j])
+                if len(results.olog_sus_lines[i]) > 0:
+                    self.putative_xenolog_file_handles[i].write(results.olog_sus_lines[i])
+            if results.olog_pairs is not None:
+                self.pairs_writer.Write(results.olog_pairs)
+        self.hog_writer.WriteCachedHOGs(results.hogs)
+
+
+def WriteTreeResultsShard(shard_file_handle, iog, results):
+    pic.dump((iog, results), shard_file_handle, protocol=pic.HIGHEST_PROTOCOL)
+
+
+def ReadTreeResultsShard(shard_fn):
+    """
+    Returns:
+        Iterator over the (iog, TreeResults) in the shard, in the order they were written
+    """
+    with open(shard_fn, "rb") as infile:
+        while True:
+            try:
+                yield pic.load(infile)
+            except EOFError:
+                return
+
+
+def MergeTreeResultsShards(tree_analyser, shard_fns):
+    """
+    Write the results from the worker shards to the output files in orthogroup
+    order. Each worker takes orthogroups from the queue in increasing order so 
+    each shard is already sorted and a k-way merge gives the final order.
+    """
+    shards = [ReadTreeResultsShard(fn) for fn in shard_fns]
+    for iog, results in heapq.merge(*shards, key=operator.itemgetter(0)):
+        tree_analyser.WriteTreeResults(results)
+
 
 def Worker_RunOrthologsMethod(
         tree_analyser, 
         nspecies, 
         args_queue, 
         results_queue, 
-        fewer_open_files, 
-        n_ologs_cache=100,
-        write_hog_tree=False,
-        fix_files=False
+        shard_fn,
     ):
     """
     Args:
         nspecies - the number in the analysis, after species have been removed
+        shard_fn - file for this worker's results, see MergeTreeResultsShards
     Must put an item in the results queue before exiting
     """
+    nOrthologues_SpPair = util.nOrtho_sp(nspecies) 
     try:
-        dim2 = 1 if fewer_open_files else nspecies
-        nOrthologues_SpPair = util.nOrtho_sp(nspecies) 
-        nCache = util.nOrtho_cache(nspecies) 
-        olog_lines_tot = [["" for j in range(dim2)] for i in range(nspecies)]
-        olog_sus_lines_tot = ["" for i in range(nspecies)]
-        while True:
-            try:
-                iog = args_queue.get(True, 1.)
-                results = tree_analyser.AnalyseTree(iog)
-                if results is None:
-                    continue
-                # if fewer_genes nOrtho still counts orthologs between all i,j species but olog_lines contains all the
-                # orthologs in olog_lines[i][0]
-                nOrtho, olog_lines, olog_sus_lines = results
-                nOrthologues_SpPair += nOrtho
-                nCache += nOrtho
-                for i in range(nspecies):
-                    olog_sus_lines_tot[i] += olog_sus_lines[i]
-                    for j in range(dim2):
-                        olog_lines_tot[i][j] += olog_lines[i][j]
-                # Now write those that we've collected enough lines for
-                I,J = nCache.get_i_j_to_write(n_ologs_cache, fewer_open_files)
-                if fewer_open_files:
-                    for i in I:
-                        WriteOlogLinesToFile(
-                            tree_analyser.ologs_files_handles[i][0], 
-                            olog_lines_tot[i][0], 
-                            tree_analyser.lock_ologs[i],
-                            write_hog_tree=write_hog_tree,
-                            fix_files=fix_files
-                        )
-                        olog_lines_tot[i][0] = ""
-                else:
-                    for i, j in zip(I,J):
-                        k_lock = max(i,j)
-                        WriteOlogLinesToFile(
-                            tree_analyser.ologs_files_handles[i][j], 
-                            olog_lines_tot[i][j], 
-                            tree_analyser.lock_ologs[k_lock],
-                            write_hog_tree=write_hog_tree,
-                            fix_files=fix_files
-                        )
-                        olog_lines_tot[i][j] = ""
-            except parallel_task_manager.queue.Empty:
-                for i in range(nspecies):
-                    if fewer_open_files:
-                        WriteOlogLinesToFile(
-                            tree_analyser.ologs_files_handles[i][0], 
-                            olog_lines_tot[i][0], 
-                            tree_analyser.lock_ologs[i],
-                            write_hog_tree=write_hog_tree,
-                            fix_files=fix_files
-                        )
-                    else:
-                        for j in range(i+1, nspecies):
-                            # j is the largest (and intentionally changing quickest, which I think is best for the lock)
-                            WriteOlogLinesToFile(
-                                tree_analyser.ologs_files_handles[i][j], 
-                                olog_lines_tot[i][j], 
-                                tree_analyser.lock_ologs[j],
-                                write_hog_tree=write_hog_tree,
-                                fix_files=fix_files
-                            )
-                            WriteOlogLinesToFile(
-                                tree_analyser.ologs_files_handles[j][i], 
-                                olog_lines_tot[j][i], 
-                                tree_analyser.lock_ologs[j],
-                                write_hog_tree=write_hog_tree,
-                                fix_files=fix_files
-                            )
-                    WriteOlogLinesToFile(
-                        tree_analyser.putative_xenolog_file_handles[i], 
-                        olog_sus_lines_tot[i], 
-                        tree_analyser.lock_suspect,
-                        write_hog_tree=write_hog_tree,
-                        fix_files=fix_files
-                    )
-                results_queue.put(nOrthologues_SpPair)
-                return
-            except Exception as e:
-                if type(e) is IOError and "handle out of range in select" in str(e):
-                    print("ERROR in this version of python multiprocessing library. Run with OrthoFinder source code version instead or add the OrthoFinder command line option '-a 1'")
-                    results_queue.put(False)   # signal error so can exit, otherwise hangs
-                    return
-                print("WARNING: Unknown error")
-                print(type(e))
-                print(e)
+        with open(shard_fn, "wb") as shard:
+            while True:
                 try:
+                    iog = args_queue.get(True, 1.)
+                    results = tree_analyser.AnalyseTree(iog)
+                    if results is None:
+                        continue
+                    # if fewer_genes nOrtho still counts orthologs between all i,j species but olog_lines contains all the
+                    # orthologs in olog_lines[i][0]
+                    nOrtho, tree_results = results
+                    nOrthologues_SpPair += nOrtho
+                    WriteTreeResultsShard(shard, iog, tree_results)
+                except parallel_task_manager.queue.Empty:
+                    break
+                except Exception as e:
+                    if type(e) is IOError and "handle out of range in select" in str(e):
+                        print("ERROR in this version of python multiprocessing library. Run with OrthoFinder source code version instead or add the OrthoFinder command line option '-a 1'")
+                        results_queue.put(False)   # signal error so can exit, otherwise hangs
+                        return
+                    print("WARNING: Unknown error")
+                    print(type(e))
+                    print(e)
                     print("Current orthogroup OG%07d" % iog)
-                    for i in range(nspecies):
-                        if fewer_open_files:
-                            WriteOlogLinesToFile(
-                                tree_analyser.ologs_files_handles[i][0], 
-                                olog_lines_tot[i][0], 
-                                tree_analyser.lock_ologs[i],
-                                write_hog_tree=write_hog_tree,
-                                fix_files=fix_files
-                            )
-                        else:
-                            for j in range(i+1, nspecies):
-                                # j is the largest (and intentionally changing quickest, which I think is best for the lock)
-                                WriteOlogLinesToFile(
-                                    tree_analyser.ologs_files_handles[i][j], 
-                                    olog_lines_tot[i][j], 
-                                    tree_analyser.lock_ologs[j],
-                                    write_hog_tree=write_hog_tree,
-                                    fix_files=fix_files
-                                )
-                                WriteOlogLinesToFile(
-                                    tree_analyser.ologs_files_handles[j][i], 
-                                    olog_lines_tot[j][i], 
-                                    tree_analyser.lock_ologs[j],
-                                    write_hog_tree=write_hog_tree,
-                                    fix_files=fix_files
-                                )
-                        WriteOlogLinesToFile(
-                            tree_analyser.putative_xenolog_file_handles[i], 
-                            olog_sus_lines_tot[i], 
-                            tree_analyser.lock_suspect,
-                            write_hog_tree=write_hog_tree,
-                            fix_files=fix_files
-                        )
-                    results_queue.put(nOrthologues_SpPair)
-                except:
-                    pass
     except Exception as e:
         print(e)
         print("WARNING: Unexpected error")
@@ -1688,10 +1792,7 @@ def Worker_RunOrthologsMethod_New(
         nspecies, 
         args_queue, 
         results_queue, 
-        fewer_open_files, 
-        n_ologs_cache=100,
-        write_hog_tree=False,
-        fix_files=False
+        shard_fn,
     ):
     """
     Worker function for parallel ortholog analysis.
@@ -1700,106 +1801,34 @@ def Worker_RunOrthologsMethod_New(
         nspecies (int): Number of species in the analysis after filtering.
         args_queue (Queue): Input queue containing tasks.
         results_queue (Queue): Queue for reporting results.
-        fewer_open_files (bool): If True, fewer file handles are used.
-        n_ologs_cache (int): Cache size before flushing ortholog lines to files.
+        shard_fn (str): File for this worker's results, see MergeTreeResultsShards.
     """
     try:
-        dim2 = 1 if fewer_open_files else nspecies
-        nOrthologues_SpPair = util.nOrtho_sp(nspecies)
-        nCache = util.nOrtho_cache(nspecies)
-        olog_lines_tot = [["" for j in range(dim2)] for i in range(nspecies)]
-        olog_sus_lines_tot = ["" for _ in range(nspecies)]
-
-        while True:
-            try:
-                iog = args_queue.get(True, 0.1)
-                if iog is None: 
-                    break
-                results = tree_analyser.AnalyseTree(iog)
-                if results is None:
-                    results_queue.put(False)  
-                    continue
-
-                nOrtho, olog_lines, olog_sus_lines = results
-                nOrthologues_SpPair += nOrtho
-                nCache += nOrtho
-
-                for i in range(nspecies):
-                    olog_sus_lines_tot[i] += olog_sus_lines[i]
-                    for j in range(dim2):
-                        olog_lines_tot[i][j] += olog_lines[i][j]
-
-                I, J = nCache.get_i_j_to_write(n_ologs_cache, fewer_open_files)
-                if fewer_open_files:
-                    for i in I:
-                        WriteOlogLinesToFile(
-                            tree_analyser.ologs_files_handles[i][0],
-                            olog_lines_tot[i][0],
-                            tree_analyser.lock_ologs[i],
-                            write_hog_tree=write_hog_tree,
-                            fix_files=fix_files
-                        )
-                        olog_lines_tot[i][0] = ""
-                else:
-                    for i, j in zip(I, J):
-                        k_lock = max(i, j)
-                        WriteOlogLinesToFile(
-                            tree_analyser.ologs_files_handles[i][j],
-                            olog_lines_tot[i][j],
-                            tree_analyser.lock_ologs[k_lock],
-                            write_hog_tree=write_hog_tree,
-                            fix_files=fix_files
-                        )
-                        olog_lines_tot[i][j] = ""
-
-                results_queue.put(nOrtho)
-
-            except parallel_task_manager.queue.Empty:
-                continue
+        with open(shard_fn, "wb") as shard:
+            while True:
+                try:
+                    iog = args_queue.get(True, 0.1)
+                    if iog is None: 
+                        break
+                    results = tree_analyser.AnalyseTree(iog)
+                    if results is None:
+                        results_queue.put(False)  
+                        continue
 
-            except Exception as e:
-                print(f"WARNING: Worker encountered an error: {e}")
-                results_queue.put(False)  # Signal error
-                break
-        try:
-            for i in range(nspecies):
-                if fewer_open_files:
-                    WriteOlogLinesToFile(
-                        tree_analyser.ologs_files_handles[i][0],
-                        olog_lines_tot[i][0],
-                        tree_analyser.lock_ologs[i],
-                        write_hog_tree=write_hog_tree,
-                        fix_files=fix_files
-                    )
-                else:
-                    for j in range(i + 1, nspecies):
-                        WriteOlogLinesToFile(
-                            tree_analyser.ologs_files_handles[i][j],
-                            olog_lines_tot[i][j],
-                            tree_analyser.lock_ologs[j],
-                            write_hog_tree=write_hog_tree,
-                            fix_files=fix_files
-                        )
-                        WriteOlogLinesToFile(
-                            tree_analyser.ologs_files_handles[j][i],
-                            olog_lines_tot[j][i],
-                            tree_analyser.lock_ologs[j],
-                            write_hog_tree=write_hog_tree,
-                            fix_files=fix_files
-                        )
-                WriteOlogLinesToFile(
-                    tree_analyser.putative_xenolog_file_handles[i],
-                    olog_sus_lines_tot[i],
-                    tree_analyser.lock_suspect,
-                    write_hog_tree=write_hog_tree,
-                    fix_files=fix_files
-                )
-            # results_queue.put(nOrthologues_SpPair)
+                    nOrtho, tree_results = results
+                    WriteTreeResultsShard(shard, iog, tree_results)
+                    results_queue.put(nOrtho)
 
-        except Exception as cleanup_error:
-            print(f"ERROR during cleanup: {cleanup_error}")
-            # results_queue.put(False)  # Signal error during cleanup
+                except parallel_task_manager.queue.Empty:
+                    continue
 
+                except Exception as e:
+                    print(f"WARNING: Worker encountered an error: {e}")
+                    results_queue.put(False)  # Signal error
+                    break
+    except Exception as e:
+        print(f"ERROR writing results: {e}")
+        results_queue.put(False)
     finally:
         results_queue.put(None) 
 
@@ -1809,243 +1838,129 @@ def RunOrthologsParallel(
         args_queue, 
         nProcesses,
         total_tasks, 
-        fewer_open_files, 
-        n_ologs_cache=100,
         old_version=False,
-        write_hog_tree=False,
-        fix_files=False
     ):
     """
     Run the ortholog analysis in parallel using multiprocessing.
     Tracks progress dynamically using a progress bar.
+    Each worker writes its results to its own shard file and these are merged
+    into the output files once all the trees have been analysed.
     """
-    if old_version:
-        results_queue = mp.Queue()
-        # Should use PTM?
-        # Can't easily pass tree_analyser since holds a _io.TextWrapper, which can't be pickled. It should be inheritted
-        # by a process, hence the need to 1) fork 2) create the processes at this point rather than use ones created earlier.
-        # I don't think this is a major RAM using step so hopefully this is not too much of a cost to pay. The alternative
-        # is to work out a different way to take care of the parallel file writing.
-        # args_list = [(tree_analyser, nspecies, args_queue, results_queue, fewer_open_files) for i_ in range(nProcesses)]
-        # parallel_task_manager.RunParallelMethods(Worker_RunOrthologsMethod, args_list, nProcesses)
-        runningProcesses = [
-            mp.Process(
-                target=Worker_RunOrthologsMethod, 
-                args=(
-                    tree_analyser, 
-                    nspecies, 
-                    args_queue, 
-                    results_queue, 
-                    fewer_open_files,
-                    n_ologs_cache,
-                    write_hog_tree,
-                    fix_files
-                )
-            ) 
-            for i_ in range(nProcesses)
-        ]
-        for proc in runningProcesses:
-            proc.start()
-        nOrthologues_SpPair = util.nOrtho_sp(nspecies)
-        n_remain = nProcesses
-        while True:
-            try:
-                nOrtho = results_queue.get()  # block until an item is available
-                if nOrtho is False:
-                    print("ERROR in parallel process, exiting.")
-                    print(traceback.format_exc())
-                    util.Fail()
-                nOrthologues_SpPair += nOrtho
-                n_remain -= 1
-                if n_remain == 0:
-                    break
-            except parallel_task_manager.queue.Empty: 
+    shard_dir = tempfile.mkdtemp(prefix="tree_results_", dir=files.FileHandler.GetWorkingDirectory_Write())
+    shard_fns = [os.path.join(shard_dir, "%d.pic" % i_) for i_ in range(nProcesses)]
+    try:
+        if old_version:
+            nOrthologues_SpPair = RunOrthologsParallel_Old(tree_analyser, nspecies, args_queue, nProcesses, shard_fns)
+        else:
+            nOrthologues_SpPair = RunOrthologsParallel_New(tree_analyser, nspecies, args_queue, nProcesses, total_tasks, shard_fns)
+        MergeTreeResultsShards(tree_analyser, [fn for fn in shard_fns if os.path.exists(fn)])
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+    return nOrthologues_SpPair
+
+def RunOrthologsParallel_Old(tree_analyser, nspecies, args_queue, nProcesses, shard_fns):
+    results_queue = mp.Queue()
+    # Should use PTM?
+    # Can't easily pass tree_analyser since holds a _io.TextWrapper, which can't be pickled. It should be inheritted
+    # by a process, hence the need to 1) fork 2) create the processes at this point rather than use ones created earlier.
+    # I don't think this is a major RAM using step so hopefully this is not too much of a cost to pay. 
+    runningProcesses = [
+        mp.Process(
+            target=Worker_RunOrthologsMethod, 
+            args=(
+                tree_analyser, 
+                nspecies, 
+                args_queue, 
+                results_queue, 
+                shard_fn,
+            )
+        ) 
+        for shard_fn in shard_fns
+    ]
+    for proc in runningProcesses:
+        proc.start()
+    nOrthologues_SpPair = util.nOrtho_sp(nspecies)
+    n_remain = nProcesses
+    while True:
+        try:
+            nOrtho = results_queue.get()  # block until an item is available
+            if nOrtho is False:
+                print("ERROR in parallel process, exiting.")
+                print(traceback.format_exc())
+                util.Fail()
+            nOrthologues_SpPair += nOrtho
+            n_remain -= 1
+            if n_remain == 0:
                 break
-        return nOrthologues_SpPair
-    else:
-        results_queue = mp.Queue()
-        progressbar, task = util.get_progressbar(total_tasks)
-        progressbar.start()
-        update_cycle = 1 
-
-        # Add sentinels to the args_queue to signal workers to terminate
-        for _ in range(nProcesses):
-            args_queue.put(None)
-
-        runningProcesses = [
-            mp.Process(
-                target=Worker_RunOrthologsMethod_New,
-                args=(
-                    tree_analyser, 
-                    nspecies, 
-                    args_queue, 
-                    results_queue, 
-                    fewer_open_files,
-                    n_ologs_cache,
-                    write_hog_tree,
-                    fix_files
-                )
-            ) for _ in range(nProcesses)
-        ]
-        for proc in runningProcesses:
-            proc.start()
-
-        nOrthologues_SpPair = util.nOrtho_sp(nspecies)
-        completed_tasks = 0
-        active_workers = nProcesses
-        while completed_tasks < total_tasks or active_workers > 0:
-            try:
-                nOrtho = results_queue.get(True, 0.1)
-                
-                if nOrtho is None:
-                    active_workers -= 1
-                elif nOrtho is False:
-                    print("ERROR in parallel process, exiting.")
-                    for proc in runningProcesses:
-                        proc.terminate()
-                    print(traceback.format_exc())
-                    util.Fail()
-                else:
-                    nOrthologues_SpPair += nOrtho
-                    completed_tasks += 1
-                    if (completed_tasks + 1) % update_cycle == 0:
-                        progressbar.update(task, advance=update_cycle)
+        except parallel_task_manager.queue.Empty: 
+            break
+    for proc in runningProcesses:
+        proc.join()
+    return nOrthologues_SpPair
 
-            except mp.queues.Empty:
-                if all(not proc.is_alive() for proc in runningProcesses):
-                    print("All worker processes have terminated but not all tasks are completed.")
-                    break
+def RunOrthologsParallel_New(tree_analyser, nspecies, args_queue, nProcesses, total_tasks, shard_fns):
+    results_queue = mp.Queue()
+    progressbar, task = util.get_progressbar(total_tasks)
+    progressbar.start()
+    update_cycle = 1 
+
+    # Add sentinels to the args_queue to signal workers to terminate
+    for _ in range(nProcesses):
+        args_queue.put(None)
+
+    runningProcesses = [
+        mp.Process(
+            target=Worker_RunOrthologsMethod_New,
+            args=(
+                tree_analyser, 
+                nspecies, 
+                args_queue, 
+                results_queue, 
+                shard_fn,
+            )
+        ) for shard_fn in shard_fns
+    ]
+    for proc in runningProcesses:
+        proc.start()
+
+    nOrthologues_SpPair = util.nOrtho_sp(nspecies)
+    completed_tasks = 0
+    active_workers = nProcesses
+    while completed_tasks < total_tasks or active_workers > 0:
+        try:
+            nOrtho = results_queue.get(True, 0.1)
+            
+            if nOrtho is None:
+                active_workers -= 1
+            elif nOrtho is False:
+                print("ERROR in parallel process, exiting.")
+                for proc in runningProcesses:
+                    proc.terminate()
+                print(traceback.format_exc())
+                util.Fail()
+            else:
+                nOrthologues_SpPair += nOrtho
+                completed_tasks += 1
+                if (completed_tasks + 1) % update_cycle == 0:
+                    progressbar.update(task, advance=update_cycle)
 
-        for proc in runningProcesses:
-            if proc.is_alive():
-                proc.terminate()
-            proc.join()
+        except mp.queues.Empty:
+            if all(not proc.is_alive() for proc in runningProcesses):
+                print("All worker processes have terminated but not all tasks are completed.")
+                break
 
-        progressbar.stop()
-        return nOrthologues_SpPair
+    for proc in runningProcesses:
+        proc.join()
+
+    progressbar.stop()
+    return nOrthologues_SpPair
 
 
-def WriteOlogLinesToFile(fh, text, lock, write_hog_tree=False, fix_files=False):
+def WriteOlogLinesToFile(fh, text, write_hog_tree=False, fix_files=False):
     if not write_hog_tree or not fix_files: 
         if len(text) == 0:
             return
-        if debug: util.PrintTime("Waiting: %d" % os.getpid())
-        lock.acquire()
-        try:
-            if debug: util.PrintTime("Acquired lock: %d" % os.getpid())
-            fh.write(text)
-            fh.flush()
-        finally:
-            lock.release()
-            if debug: util.PrintTime("Released lock: %d" %  os.getpid())
-
-def SortParallelFiles(
-        n_parallel, 
-        speciesToUse, 
-        speciesDict, 
-        fewer_open_files, 
-        write_hog_tree,
-        fix_files,
-        old_version,
-    ):
-    """
-    Args:
-        fewer_open_files - Orthologs have been written to one file per species, not one per species pair
-    Sort the lines by orthogroup for the files that were written in parallel:
-    - Orthologs
-    - Xenologs
-    - Duplications
-    - HOGs
-    """
-
-    # HOGs
-    hog_type = [(fn, "h") for fn in glob.glob(os.path.dirname(files.FileHandler.GetHierarchicalOrthogroupsFN("N0.tsv")) + "/*")]
-    if write_hog_tree:
-        hog_type.append((files.FileHandler.GetWorkingDirectory_Write() + "N0.ids.tsv", "h"))
-    
-    other_type = []
-    if not write_hog_tree or not fix_files:
-        species = [speciesDict[str(sp1)] for sp1 in speciesToUse]
-        # Orthologs
-        dResultsOrthologues = files.FileHandler.GetOrthologuesDirectory()
-        if fewer_open_files:
-            other_type = [(dResultsOrthologues + '%s.tsv' % sp1, "o") for sp1 in species]
-        else:
-            ds = [dResultsOrthologues + "Orthologues_" + sp1 + "/" for sp1 in species]
-            other_type = [(d + '%s__v__%s.tsv' % (sp1, sp2), "o") for sp1, d in zip(species, ds) for sp2 in species if sp1 != sp2]
-        # Xenologs 
-        dXenologs = files.FileHandler.GetPutativeXenelogsDir()
-        other_type.extend([(dXenologs + '%s.tsv' % sp1, "x") for sp1 in species])
-
-        # Duplications
-        other_type.append((files.FileHandler.GetDuplicationsFN(), "d"))
-    
-    fns_type = hog_type + other_type
-    task_size = len(fns_type)
-    args_queue = mp.Queue()
-    for x in fns_type:
-        args_queue.put(x)
-    if old_version:
-        parallel_task_manager.RunMethodParallel(SortFile, args_queue, n_parallel, task_size, old_version)
-    else:
-        parallel_task_manager.RunMethodParallel(Worker_SortFile, args_queue, n_parallel, task_size, old_version)
-
-def SortFile(fn, f_type):
-    """
-    Sort the contents of the file by the first column and save back to the same filename.
-    Args:
-        fn - filename
-        f_type - o, x, h or d for orthologs, xenologs, hogs or duplications
-    """
-    first_column_sort = lambda s : s.split("\t", 1)[0]
-    if f_type == "h":
-        # Need to renumber the hogs as the parallel numbering is incorrect
-        with open(fn, util.csv_read_mode) as infile:
-            try:
-                header = next(infile, None)
-            except StopIteration:
-                return
-            lines = []
-            # remove incorrect HOG numbering
-            for line in infile:
-                # if "N0.HOG0000009" in line:
-                #     print(line)
-                lines.append(line.split("\t", 1)[-1])
-            if len(lines) == 0:
-                return
-            hog_base = line.split(".", 1)[0]
-        lines.sort(key = first_column_sort)
-        with open(fn, util.csv_write_mode) as outfile:
-            outfile.write(header)
-            for ihog, l in enumerate(lines):
-                # with lock:
-                    # idx = counter.value
-                    # counter.value += 1
-                    # outfile.write(f"{hog_base}.HOG{idx:07d}" + "\t" + l)
-                outfile.write(hog_base + (".HOG%07d" % ihog) + "\t" + l)
-    else:
-        with open(fn, util.csv_read_mode) as infile:
-            try:
-                header = next(infile)
-            except StopIteration:
-                return
-            lines = list(infile)
-        lines.sort(key=first_column_sort)
-        with open(fn, util.csv_write_mode) as outfile:
-            outfile.write(header)
-            outfile.write("".join(lines))
-
-def Worker_SortFile(fn, f_type, result_queue):
-
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        try:
-            SortFile(fn, f_type)
-            result_queue.put((fn, "success"))
-        except Exception as e:
-            result_queue.put((fn, e))
-            print(traceback.format_exc(), flush=True)
-
+        fh.write(text)
 
 def GetOrthologues_from_phyldog_tree(iog, treeFN, GeneToSpecies, qWrite=False, dupsWriter=None, seqIDs=None, spIDs=None):
     """ if dupsWriter != None then seqIDs and spIDs must also be provided"""
@@ -2163,7 +2078,10 @@ if __name__ == "__main__":
     parser.add_argument("rooted_species_tree")
 #    parser.add_argument("-p", "--prune", action='store_true')
     parser.add_argument("-s", "--separator", choices=("dot", "dash", "second_dash", "3rd_dash", "hyphen"), help="Separator been species name and gene name in gene tree taxa")
+    parser.add_argument("-t", "--threads", type=int, default=nThreadsDefault, help="Number of parallel processes [Default = %d]" % nThreadsDefault)
     args = parser.parse_args()
+    # Start the worker processes while the RAM usage is low
+    parallel_task_manager.ParallelTaskManager_singleton().GetWorkerPool(max(1, args.threads))
     output_dir = os.path.split(args.trees_dir)[0]
     qSingleTree = False
     try:
@@ -2184,7 +2102,7 @@ if __name__ == "__main__":
     print(output_dir)
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
-    GetOrthologuesStandalone_Parallel(args.trees_dir, args.rooted_species_tree, GeneToSpecies, output_dir, qSingleTree)
+    GetOrthologuesStandalone_Parallel(args.trees_dir, args.rooted_species_tree, GeneToSpecies, output_dir, qSingleTree, max(1, args.threads))
     # GetOrthologuesStandalone_Serial(args.trees_dir, args.rooted_species_tree, GeneToSpecies, output_dir, qSingleTree)
 #    RootTreeStandalone_Serial(args.trees_dir, args.rooted_species_tree, GeneToSpecies, output_dir, qSingleTree)
     util.Success()
@@ -1,72 +1,296 @@
 from __future__ import absolute_import
 
 import os
+import functools
 import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
 
 import numpy.core.numeric as numeric
 import multiprocessing as mp
 
-from ..tools import mcl, trees_msa, waterfall
+from ..tools import mcl, sparse_mcl, trees_msa, waterfall
 from . import orthogroups_set
-from ..utils import util, files, matrices, parallel_task_manager
+from .orthogroup_array import OrthogroupArray
+from ..utils import util, files, matrices, parallel_task_manager, program_caller
 
+# Number of rows of the graph that are formatted at a time
+nRowsPerChunk = 2**12
 
-def WriteGraph_perSpecies(args):
-    seqsInfo, graphFN, iSpec, d_pickle = args
-    # calculate the 2-way connections for one query species
-    with open(graphFN + "_%d" % iSpec, "w") as graphFile:
-        connect2 = []
-        for jSpec in range(seqsInfo.nSpecies):
-            m1 = matrices.LoadMatrix("connect", iSpec, jSpec, d_pickle)
-            m2tr = numeric.transpose(
-                matrices.LoadMatrix("connect", jSpec, iSpec, d_pickle)
-            )
-            connect2.append(m1 + m2tr)
-            del m1, m2tr
-        B = matrices.LoadMatrixArray("B", seqsInfo, iSpec, d_pickle)
-        B_connect = matrices.MatricesAnd_s(connect2, B)
-        del B, connect2
-
-        W = [b.sorted_indices().tolil() for b in B_connect]
-        del B_connect
-        for query in range(seqsInfo.nSeqsPerSpecies[seqsInfo.speciesToUse[iSpec]]):
-            offset = seqsInfo.seqStartingIndices[iSpec]
-            graphFile.write("%d    " % (offset + query))
-            for jSpec in range(seqsInfo.nSpecies):
-                row = W[jSpec].getrowview(query)
-                jOffset = seqsInfo.seqStartingIndices[jSpec]
-                for j, value in zip(row.rows[0], row.data[0]):
-                    graphFile.write("%d:%.3f " % (j + jOffset, value))
-            graphFile.write("$\n")
-        if iSpec == (seqsInfo.nSpecies - 1):
-            graphFile.write(")\n")
-        # util.PrintTime("Written final scores for species %d to graph file" % iSpec)
+# Size of the buffer used when copying the per-species graph files into the batch graph files
+nBytesCopyBuffer = 2**24
 
 
-def WriteGraph_perSpecies_homology(args):
-    seqsInfo, graphFN, iSpec, d_pickle = args
+def WriteGraphRows(graphFile, W, offset):
+    """
+    Write the rows of a matrix to an MCL graph file, formatting a block of rows at a time
+    Args:
+        graphFile - file open for writing
+        W - CSR matrix with sorted indices, columns indexed by the sequence IDs used in the graph
+        offset - sequence ID of the first row of W
+    Returns:
+        nBytes - number of bytes written
+    """
+    nBytes = 0
+    indptr = W.indptr
+    nnz_row = np.diff(indptr)
+    for iStart in range(0, W.shape[0], nRowsPerChunk):
+        iEnd = min(iStart + nRowsPerChunk, W.shape[0])
+        a, b = indptr[iStart], indptr[iEnd]
+        # Each row is the query ID followed by a (hit ID, score) pair for each edge
+        r = np.arange(iEnd - iStart)
+        r_entry = np.repeat(r, nnz_row[iStart:iEnd])
+        i_entry = 2 * np.arange(b - a) + r_entry
+        values = np.empty(iEnd - iStart + 2 * (b - a))
+        values[2 * (indptr[iStart:iEnd] - a) + r] = offset + iStart + r
+        values[i_entry + 1] = W.indices[a:b]
+        values[i_entry + 2] = W.data[a:b]
+        fmt = "".join(["%d    " + "%d:%.3f " * n + "$\n" for n in nnz_row[iStart:iEnd].tolist()])
+        text = fmt % tuple(values.tolist())
+        graphFile.write(text)
+        nBytes += len(text)
+    return nBytes
+
+
+def GetGraph_perSpecies(args):
+    """
+    Returns:
+        W - CSR matrix of the graph rows for the query species, columns indexed by the sequence IDs used in the graph
+    """
+    seqsInfo, iSpec, d_pickle = args
+    # calculate the 2-way connections for one query species
+    connect_row = matrices.LoadMatrixArray("connect", seqsInfo, iSpec, d_pickle)
+    connect_col = matrices.LoadMatrixArray("connect", seqsInfo, iSpec, d_pickle, row=False)
+    connect2 = []
+    for m1, m2 in zip(connect_row, connect_col):
+        connect2.append(m1 + numeric.transpose(m2))
+    del connect_row, connect_col
+    B = matrices.LoadMatrixArray("B", seqsInfo, iSpec, d_pickle)
+    B_connect = matrices.MatricesAnd_s(connect2, B)
+    del B, connect2
+    W = sparse.hstack(B_connect, format="csr")
+    W.sum_duplicates()
+    return W
+
+
+def GetGraph_perSpecies_homology(args):
+    """
+    Returns:
+        W - CSR matrix of the graph rows for the query species, columns indexed by the sequence IDs used in the graph
+    """
+    seqsInfo, iSpec, d_pickle = args
     # calculate the 2-way connections for one query species
     # W = [matrices.LoadMatrix("B", iSpec, jSpec, d_pickle).tolil() for jSpec in range(seqsInfo.nSpecies)]
+    B_row = matrices.LoadMatrixArray("B", seqsInfo, iSpec, d_pickle)
+    B_col = matrices.LoadMatrixArray("B", seqsInfo, iSpec, d_pickle, row=False)
     W = []
-    for jSpec in range(seqsInfo.nSpecies):
-        w1 = matrices.LoadMatrix("B", iSpec, jSpec, d_pickle)
+    for jSpec, (w1, w2) in enumerate(zip(B_row, B_col)):
         matrices.DumpMatrix("H", (w1 > 0).tolil(), iSpec, jSpec, d_pickle)
-        w2tr = numeric.transpose(matrices.LoadMatrix("B", jSpec, iSpec, d_pickle))
-        W.append((w1 + w2tr > 0).tolil())  # symmetrise
+        w2tr = numeric.transpose(w2)
+        W.append((w1 + w2tr > 0).tocsr())  # symmetrise
+    del B_row, B_col
     # matrices.DumpMatrixArray("H", W, iSpec, d_pickle)
-    with open(graphFN + "_%d" % iSpec, "w") as graphFile:
-        for query in range(seqsInfo.nSeqsPerSpecies[seqsInfo.speciesToUse[iSpec]]):
-            offset = seqsInfo.seqStartingIndices[iSpec]
-            graphFile.write("%d    " % (offset + query))
-            for jSpec in range(seqsInfo.nSpecies):
-                row = W[jSpec].getrowview(query)
-                jOffset = seqsInfo.seqStartingIndices[jSpec]
-                for j in row.rows[0]:
-                    graphFile.write("%d:%.3f " % (j + jOffset, 1.0))
-            graphFile.write("$\n")
-        if iSpec == (seqsInfo.nSpecies - 1):
+    W = sparse.hstack(W, format="csr")
+    W.sum_duplicates()
+    W.data = np.ones(W.nnz)
+    return W
+
+
+def StoreGraph_perSpecies(get_func, seqsInfo, iSpec, d_pickle):
+    """
+    Calculate the graph rows for a species and store them, with the scores as they 
+    are written to the graph file, for WriteGraphBatches_perSpecies
+    Args:
+        get_func - function to return the graph rows for a species as a matrix
+    Returns:
+        nodes, roots - arrays of the nodes of the edges in these rows, other than the
+                       smallest node of each of their components, and that node. The 
+                       components of the graph are those of these edges for all species
+    """
+    W = get_func((seqsInfo, iSpec, d_pickle))
+    W.data = np.round(W.data, 3)
+    W.eliminate_zeros()
+    matrices.DumpMatrix("graph", W, iSpec, 0, d_pickle)
+    rows = seqsInfo.seqStartingIndices[iSpec] + np.repeat(np.arange(W.shape[0]), np.diff(W.indptr))
+    nodes, i_nodes = np.unique(np.concatenate((rows, W.indices)), return_inverse=True)
+    n = len(nodes)
+    A = sparse.csr_matrix((np.ones(W.nnz), (i_nodes[:W.nnz], i_nodes[W.nnz:])), shape=(n, n))
+    _, components = csgraph.connected_components(A, directed=True, connection="weak")
+    # nodes is sorted, so the first node of each component is its smallest
+    _, i_first = np.unique(components, return_index=True)
+    roots = nodes[i_first[components]]
+    q_edge = nodes != roots
+    return nodes[q_edge].astype(W.indices.dtype), roots[q_edge].astype(W.indices.dtype)
+
+
+def WriteGraphBatches_perSpecies(batch, local, nBatches, graphFilename, seqsInfo, iSpec, d_pickle):
+    """
+    Write the stored graph rows for a species that are in a batch to the file 
+    <graphFilename>_<iSpec>, in order of batch and with the nodes numbered within 
+    their batch
+    Args:
+        batch - array of the batch of each node, -1 if it isn't in a batch
+        local - array of the index of each node within its batch
+        nBatches - number of batches
+    Returns:
+        nBytes - array of the number of bytes written for each batch
+    """
+    W = matrices.LoadMatrix("graph", iSpec, 0, d_pickle)
+    offset = seqsInfo.seqStartingIndices[iSpec]
+    batch_rows = batch[offset:offset + W.shape[0]]
+    i_rows = np.flatnonzero(batch_rows >= 0)
+    i_rows = i_rows[np.argsort(batch_rows[i_rows], kind="stable")]
+    W = W[i_rows]
+    # the edges of a node are all in its batch, in which the nodes keep their order
+    W = sparse.csr_matrix((W.data, local[W.indices], W.indptr), shape=W.shape)
+    bounds = np.searchsorted(batch_rows[i_rows], np.arange(nBatches + 1))
+    nBytes = np.zeros(nBatches, dtype=np.int64)
+    with open(graphFilename + "_%d" % iSpec, "w") as graphFile:
+        for iBatch in np.flatnonzero(np.diff(bounds)):
+            iStart, iEnd = bounds[iBatch], bounds[iBatch + 1]
+            # the rows of a species in a batch are consecutive nodes of the batch
+            nBytes[iBatch] = WriteGraphRows(graphFile, W[iStart:iEnd], local[offset + i_rows[iStart]])
+    return nBytes
+
+
+def WriteBatchGraphFiles(graphFilename, batches, nBytes):
+    """
+    Assemble the graph file for each batch from the files written by
+    WriteGraphBatches_perSpecies, which are deleted
+    Args:
+        batches - list of arrays of the nodes of each batch
+        nBytes - for each species, the array of the number of bytes written for each batch
+    Returns:
+        batchFilenames - list of the graph filename for each batch
+    """
+    batchFilenames = [graphFilename + "_batch%d" % iBatch for iBatch in range(len(batches))]
+    for batchFN, nodes in zip(batchFilenames, batches):
+        with open(batchFN, "w") as graphFile:
+            graphFile.write("(mclheader\nmcltype matrix\ndimensions %dx%d\n)\n" % (len(nodes), len(nodes)))
+            graphFile.write("\n(mclmatrix\nbegin\n\n")
+    for iSpec, nBytes_species in enumerate(nBytes):
+        speciesFN = graphFilename + "_%d" % iSpec
+        # the species file has the rows for each batch in turn
+        with open(speciesFN, "rb") as speciesFile:
+            for iBatch in np.flatnonzero(nBytes_species):
+                with open(batchFilenames[iBatch], "ab") as graphFile:
+                    nRemaining = nBytes_species[iBatch]
+                    while nRemaining > 0:
+                        buffer = speciesFile.read(min(nRemaining, nBytesCopyBuffer))
+                        graphFile.write(buffer)
+                        nRemaining -= len(buffer)
+        os.remove(speciesFN)
+    for batchFN in batchFilenames:
+        with open(batchFN, "a") as graphFile:
             graphFile.write(")\n")
-        util.PrintTime("Written final scores for species %d to graph file" % iSpec)
+    return batchFilenames
+
+
+def RunMCLBatches(get_func, seqsInfo, graphFilename, d_pickle, nProcesses, inflation):
+    """
+    Cluster the graph with the mcl binary. The graph is split into its connected
+    components as for sparse_mcl.RunMCL and mcl is run on a graph file for each 
+    batch of components. The largest batches are run with all the threads, the 
+    rest in parallel with one thread each.
+    Args:
+        get_func - function to return the graph rows for a species as a matrix
+        graphFilename - base filename for the graph files
+        nProcesses - number of threads to use
+        inflation - MCL inflation parameter
+    Returns:
+        clusters - list of sorted arrays of node indices, ordered by decreasing size
+    """
+    pool = parallel_task_manager.ParallelTaskManager_singleton().GetWorkerPool(nProcesses)
+    forests = pool.Map(
+        functools.partial(StoreGraph_perSpecies, get_func, seqsInfo),
+        [(iSpec, d_pickle) for iSpec in range(seqsInfo.nSpecies)],
+    )
+    nodes = np.concatenate([f[0] for f in forests])
+    roots = np.concatenate([f[1] for f in forests])
+    del forests
+    A = sparse.csr_matrix(
+        (np.ones(len(nodes), dtype=np.int32), (nodes, roots)), shape=(seqsInfo.nSeqs, seqsInfo.nSeqs)
+    )
+    del nodes, roots
+    _, components = csgraph.connected_components(A, directed=True, connection="weak")
+    del A
+    labels, nLabels, batches = sparse_mcl.GetComponentBatches(components)
+    batch = np.full(seqsInfo.nSeqs, -1, dtype=np.int64)
+    local = np.zeros(seqsInfo.nSeqs, dtype=np.int64)
+    for iBatch, batch_nodes in enumerate(batches):
+        batch[batch_nodes] = iBatch
+        local[batch_nodes] = np.arange(len(batch_nodes))
+    nBytes = pool.Map(
+        functools.partial(WriteGraphBatches_perSpecies, batch, local, len(batches), graphFilename, seqsInfo),
+        [(iSpec, d_pickle) for iSpec in range(seqsInfo.nSpecies)],
+    )
+    matrices.DeleteMatrices("graph", d_pickle)
+    del batch, local
+    batchFilenames = WriteBatchGraphFiles(graphFilename, batches, nBytes)
+    commands = [
+        " ".join(["mcl", batchFN, "-I", str(inflation), "-o", batchFN + "_clusters", "-te", "METHODTHREAD", "-V", "all"])
+        for batchFN in batchFilenames
+    ]
+    if commands:
+        program_caller.RunParallelCommands(
+            nProcesses,
+            commands,
+            qListOfList=False,
+            method_threads_large=nProcesses,
+            method_threads_small=1,
+            q_print_on_error=True,
+        )
+    for batch_nodes, batchFN in zip(batches, batchFilenames):
+        batchClustersFN = batchFN + "_clusters"
+        if not os.path.exists(batchClustersFN):
+            print("ERROR: MCL failed for %s" % batchFN)
+            util.Fail()
+        batch_labels = mcl.ReadClusterLabels(batchClustersFN, len(batch_nodes))
+        labels[batch_nodes] = nLabels + batch_labels
+        nLabels += batch_labels.max() + 1
+        os.remove(batchFN)
+        os.remove(batchClustersFN)
+    return sparse_mcl.Clusters(labels)
+
+
+def ClusterGraph(get_func, seqsInfo, options, i_unassigned):
+    """
+    Cluster the graph with MCL, either by writing the graph files and running the
+    mcl binary or, for options.internal_mcl, in-process on the graph matrix.
+    Args:
+        get_func - function to return the graph rows for a species as a matrix
+    Returns:
+        clustersFilename_pairs - clusters file with sequences as species-sequence ID pairs
+    """
+    q_unassigned = i_unassigned is not None
+    clustersFilename, clustersFilename_pairs = (
+        files.FileHandler.CreateUnusedClustersFN(
+            "_I%0.1f" % options.mclInflation, i_unassigned
+        )
+    )
+    if options.internal_mcl:
+        W = waterfall.WaterfallMethod.GetGraphParallel(
+            get_func, seqsInfo, options.nProcessAlg
+        )
+        # use the scores as they would be written to the graph file
+        W.data = np.round(W.data, 3)
+        W.eliminate_zeros()
+        clusters = sparse_mcl.RunMCL(W, options.mclInflation, options.nProcessAlg)
+        del W
+    else:
+        clusters = RunMCLBatches(
+            get_func,
+            seqsInfo,
+            files.FileHandler.GetGraphFilename(i_unassigned),
+            files.FileHandler.GetPickleDir(),
+            options.nProcessAlg,
+            options.mclInflation,
+        )
+        waterfall.WaterfallMethod.DeleteGraphMatrices()
+    util.PrintTime("Ran MCL")
+    # If processing unassigned, then ignore all 'unclustered' genes - they will include any genes not included in this search
+    mcl.WriteClusters(seqsInfo, clusters, clustersFilename_pairs, q_unassigned)
+    return clustersFilename_pairs
 
 
 def GetSequenceLengths(seqsInfo):
@@ -155,32 +379,22 @@ def DoOrthogroups(
             proc.start()
         parallel_task_manager.ManageQueue(runningProcesses, cmd_queue)
     else:
+        pool = parallel_task_manager.ParallelTaskManager_singleton().GetWorkerPool(options.nProcessAlg)
         gathering_progress, task = util.get_progressbar(seqsInfo.nSpecies)
-        update_cycle = 1
         gathering_progress.start()
-        result_queue = mp.Queue()
-        runningProcesses = []
-        for iSpecies in range(seqsInfo.nSpecies):
-            proc = mp.Process(
-                target=waterfall.WaterfallMethod.Worker_ProcessBlastHits_New,
-                args=(
-                    seqsInfo,
-                    blastDir_list,
-                    Lengths,
-                    iSpecies,
-                    files.FileHandler.GetPickleDir(),
-                    options.qDoubleBlast,
-                    options.v2_scores,
-                    q_unassigned,
-                    result_queue,
-                ),
-            )
-            runningProcesses.append(proc)
-            proc.start()
-            if len(runningProcesses) >= options.nProcessAlg:
-                parallel_task_manager.ManageQueueNew(runningProcesses, result_queue, gathering_progress, task, update_cycle)
-                
-        parallel_task_manager.ManageQueueNew(runningProcesses, result_queue, gathering_progress, task, update_cycle)
+        # the large arguments are sent once to each worker rather than with each species
+        process_blast_hits = functools.partial(
+            waterfall.WaterfallMethod.ProcessBlastHits, seqsInfo, blastDir_list, Lengths
+        )
+        pool.Map(
+            process_blast_hits,
+            [
+                (iSpecies, files.FileHandler.GetPickleDir(), options.qDoubleBlast, options.v2_scores, q_unassigned)
+                for iSpecies in range(seqsInfo.nSpecies)
+            ],
+            gathering_progress,
+            task,
+        )
         gathering_progress.stop()
 
     if options.gathering_version < (3, 0):
@@ -206,61 +420,28 @@ def DoOrthogroups(
 
         else:
             ## -------------------------------------------------------------------------
+            pool = parallel_task_manager.ParallelTaskManager_singleton().GetWorkerPool(options.nProcessAlg)
             gathering_progress, task = util.get_progressbar(seqsInfo.nSpecies)
             gathering_progress.start()
-            result_queue = mp.Queue()
-            runningProcesses = []
-            for iSpecies in range(seqsInfo.nSpecies):
-                proc = mp.Process(
-                    target=waterfall.WaterfallMethod.Worker_ConnectCognates_New,
-                    args=(
-                        seqsInfo,
-                        iSpecies,
-                        files.FileHandler.GetPickleDir(),
-                        result_queue,
-                        options.v2_scores,
-                    ),
-                )
-                runningProcesses.append(proc)
-                proc.start()
-                if len(runningProcesses) >= options.nProcessAlg:
-                    parallel_task_manager.ManageQueueNew(runningProcesses, result_queue, gathering_progress, task, update_cycle)
-                
-            parallel_task_manager.ManageQueueNew(runningProcesses, result_queue, gathering_progress, task, update_cycle)
+            pool.Map(
+                functools.partial(waterfall.WaterfallMethod.ConnectCognates, seqsInfo),
+                [
+                    (iSpecies, files.FileHandler.GetPickleDir(), options.v2_scores)
+                    for iSpecies in range(seqsInfo.nSpecies)
+                ],
+                gathering_progress,
+                task,
+            )
             gathering_progress.stop()
  
-        graphFilename = waterfall.WaterfallMethod.WriteGraphParallel(
-            WriteGraph_perSpecies, seqsInfo, options.nProcessAlg, i_unassigned
-        )
-
         # 5b. MCL
-        clustersFilename, clustersFilename_pairs = (
-            files.FileHandler.CreateUnusedClustersFN(
-                "_I%0.1f" % options.mclInflation, i_unassigned
-            )
-        )
-        mcl.MCL.RunMCL(
-            graphFilename, clustersFilename, options.nProcessAlg, options.mclInflation
-        )
-        # If processing unassigned, then ignore all 'unclustered' genes - they will include any genes not included in this search
-        mcl.ConvertSingleIDsToIDPair(
-            seqsInfo, clustersFilename, clustersFilename_pairs, q_unassigned
+        clustersFilename_pairs = ClusterGraph(
+            GetGraph_perSpecies, seqsInfo, options, i_unassigned
         )
 
     elif options.gathering_version == (3, 2):
-        graphFilename = waterfall.WaterfallMethod.WriteGraphParallel(
-            WriteGraph_perSpecies_homology, seqsInfo, options.nProcessAlg, i_unassigned
-        )
-        clustersFilename, clustersFilename_pairs = (
-            files.FileHandler.CreateUnusedClustersFN(
-                "_I%0.1f" % options.mclInflation, i_unassigned
-            )
-        )
-        mcl.MCL.RunMCL(
-            graphFilename, clustersFilename, options.nProcessAlg, options.mclInflation
-        )
-        mcl.ConvertSingleIDsToIDPair(
-            seqsInfo, clustersFilename, clustersFilename_pairs, q_unassigned
+        clustersFilename_pairs = ClusterGraph(
+            GetGraph_perSpecies_homology, seqsInfo, options, i_unassigned
         )
     if not q_unassigned:
         post_clustering_orthogroups(
@@ -288,7 +469,7 @@ def post_clustering_orthogroups(
     Args:
         q_incremental - These are not the final orthogroups, don't write results
     """
-    ogs = mcl.GetPredictedOGs(clustersFilename_pairs)
+    ogs = OrthogroupArray.FromClustersFile(clustersFilename_pairs)
     resultsBaseFilename = files.FileHandler.GetOrthogroupResultsFNBase()
 
 
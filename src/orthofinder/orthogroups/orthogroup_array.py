@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 David Emms
+#
+# This program (OrthoFinder) is distributed under the terms of the GNU General Public License v3
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  When publishing work that uses OrthoFinder please cite:
+#      Emms, D.M. and Kelly, S. (2015) OrthoFinder: solving fundamental biases in whole genome comparisons dramatically
+#      improves orthogroup inference accuracy, Genome Biology 16:157
+#
+# For any enquiries send an email to David Emms
+# david_emms@hotmail.com
+import numpy as np
+from scipy import sparse
+
+
+class OrthogroupArray(object):
+    """
+    Orthogroups stored as integer arrays in the layout of a CSR matrix:
+        offsets - int64 array, orthogroup i is entries offsets[i]:offsets[i+1]
+        species - int32 array of the species ID of each gene
+        seqs - int32 array of the sequence ID of each gene within its species
+    The genes are kept in the order they were read. The "species_seq" ID
+    strings are only rendered on request, e.g. by iterating over the
+    orthogroups, which gives a list of ID strings for each orthogroup.
+    """
+    def __init__(self, offsets, species, seqs):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.species = np.asarray(species, dtype=np.int32)
+        self.seqs = np.asarray(seqs, dtype=np.int32)
+
+    @classmethod
+    def FromStrings(cls, ogs):
+        """
+        Args:
+            ogs - iterable of orthogroups, each an iterable of "species_seq" ID strings
+        """
+        ogs = [list(og) for og in ogs]
+        offsets = np.zeros(len(ogs) + 1, dtype=np.int64)
+        np.cumsum([len(og) for og in ogs], out=offsets[1:])
+        ids = "_".join(["_".join(og) for og in ogs if og])
+        if not ids:
+            return cls(offsets, [], [])
+        ids = np.array(ids.split("_"), dtype=np.int64)
+        if len(ids) != 2 * offsets[-1]:
+            raise ValueError("Sequence IDs must be of the form species_seq")
+        return cls(offsets, ids[0::2], ids[1::2])
+
+    @classmethod
+    def FromClustersFile(cls, clustersFilename):
+        """
+        Read the orthogroups from a clusters file with sequences as species-sequence ID pairs
+        """
+        with open(clustersFilename) as clusterFile:
+            text = clusterFile.read()
+        i = text.find("begin")
+        text = text[text.index("\n", i) + 1:] if i != -1 else ""
+        text = text[:text.find(")")] if ")" in text else text
+        ogs = []
+        for cluster in text.split("$"):
+            # the first field is the cluster index
+            genes = [g for g in cluster.split()[1:] if not g.startswith("Prof")]
+            if genes:
+                ogs.append(genes)
+        return cls.FromStrings(ogs)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, iOG):
+        return ["%d_%d" % g for g in zip(self.Species(iOG).tolist(), self.Seqs(iOG).tolist())]
+
+    def __iter__(self):
+        for iOG in range(len(self)):
+            yield self[iOG]
+
+    def Sizes(self):
+        return np.diff(self.offsets)
+
+    def Species(self, iOG):
+        return self.species[self.offsets[iOG]:self.offsets[iOG + 1]]
+
+    def Seqs(self, iOG):
+        return self.seqs[self.offsets[iOG]:self.offsets[iOG + 1]]
+
+    def OGIndices(self):
+        """
+        Returns:
+            array of the orthogroup index of each gene
+        """
+        return np.repeat(np.arange(len(self)), self.Sizes())
+
+    def Subset(self, iOGs):
+        """
+        Args:
+            iOGs - indices of the orthogroups to keep, in the order required
+        Returns:
+            OrthogroupArray of the selected orthogroups
+        """
+        iOGs = np.asarray(iOGs, dtype=np.int64)
+        sizes = self.Sizes()[iOGs]
+        offsets = np.zeros(len(iOGs) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        # position of each selected gene in the original arrays
+        i_genes = np.repeat(self.offsets[iOGs] - offsets[:-1], sizes) + np.arange(offsets[-1])
+        return OrthogroupArray(offsets, self.species[i_genes], self.seqs[i_genes])
+
+    def SpeciesCounts(self, speciesIDs=None):
+        """
+        Args:
+            speciesIDs - species IDs for the columns, defaults to 0..max species ID
+        Returns:
+            counts - (nOGs x nSpecies) CSR matrix of the number of genes from each species in each orthogroup
+        """
+        nCols = int(self.species.max()) + 1 if len(self.species) else 0
+        if speciesIDs is not None:
+            nCols = max(nCols, max(speciesIDs) + 1 if len(speciesIDs) else 0)
+        # duplicate (orthogroup, species) entries are summed
+        counts = sparse.csr_matrix((np.ones(len(self.species), dtype=np.int64), (self.OGIndices(), self.species)),
+                                   shape=(len(self), nCols))
+        return counts if speciesIDs is None else counts[:, list(speciesIDs)]
+
+    def Names(self, idDict):
+        """
+        Args:
+            idDict - dict from "species_seq" ID string to the gene name
+        Returns:
+            list of the names of all the genes, in order
+        """
+        return [idDict["%d_%d" % g] for g in zip(self.species.tolist(), self.seqs.tolist())]
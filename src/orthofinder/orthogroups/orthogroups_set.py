@@ -30,7 +30,7 @@ try:
     from rich import print
 except ImportError:
     ...
-from ..tools import mcl as MCL
+from .orthogroup_array import OrthogroupArray
 from ..utils import util, files
 
 
@@ -83,6 +83,7 @@ class OrthoGroupsSet(object):
         self._Spec_SeqIDs = None
         self._extractor = idExtractor
         self.seqIDsEx = None
+        self.ogs_array = None
         self.ogs_all = None
         self.ogs_single = None
         self.iOgs4 = None
@@ -134,17 +135,25 @@ class OrthoGroupsSet(object):
 
     def Get_iOGs4(self):
         if self.iOgs4 is None:
-            ogs = self.OGsAll()
-            self.iOgs4 = [i for i, og in enumerate(ogs) if len(og) >= self.min_seq]
+            sizes = self.OGsArray().Sizes()
+            if self.tree_program == "raxml":
+                sizes = sizes[sizes >= self.min_seq]
+            self.iOgs4 = np.flatnonzero(sizes >= self.min_seq).tolist()
         return self.iOgs4
 
+    def OGsArray(self):
+        """returns OrthogroupArray of all the orthogroups"""
+        if self.ogs_array is None:
+            self.ogs_array = OrthogroupArray.FromClustersFile(files.FileHandler.GetClustersFN())
+        return self.ogs_array
+
     def OGsAll(self):
         if self.ogs_all is None:
-            ogs = MCL.GetPredictedOGs(files.FileHandler.GetClustersFN())
+            ogs = self.OGsArray()
+            iOGs = range(len(ogs))
             if self.tree_program == "raxml":
-                self.ogs_all = [[Seq(g) for g in og]  for og in ogs if len(og) >= self.min_seq]
-            else:
-                self.ogs_all = [[Seq(g) for g in og] for og in ogs]
+                iOGs = np.flatnonzero(ogs.Sizes() >= self.min_seq)
+            self.ogs_all = [[Seq(g) for g in zip(ogs.Species(i).tolist(), ogs.Seqs(i).tolist())] for i in iOGs]
             # self.ogs_all = sorted(self.ogs_all, key=len, reverse=True)
         return self.ogs_all
     
@@ -161,8 +170,8 @@ class OrthoGroupsSet(object):
     
     def OGsSingle(self):
         if self.ogs_single is None:
-            ogs = MCL.GetPredictedOGs(files.FileHandler.GetClustersFN())
-            self.ogs_single = [og for og in ogs if len(og) == 1]
+            ogs = self.OGsArray()
+            self.ogs_single = [set(ogs[i]) for i in np.flatnonzero(ogs.Sizes() == 1)]
         return self.ogs_single
 
     # def OGs4AssumeOrdered(self):
@@ -173,18 +182,14 @@ class OrthoGroupsSet(object):
     def OrthogroupMatrix(self):
         """ qReduce give a matrix with only as many columns as species for cases when
         clustering has been performed on a subset of species"""
-        ogs = self.OGsAll()
+        ogs = self.OGsArray()
+        if self.tree_program == "raxml":
+            ogs = ogs.Subset(np.flatnonzero(ogs.Sizes() >= self.min_seq))
         iogs4 = self.Get_iOGs4()
-        ogs = [ogs[i] for i in iogs4]
-        iSpecies = sorted(set([gene.iSp for og in ogs for gene in og]))
-        speciesIndexDict = {iSp:iCol for iCol, iSp in enumerate(iSpecies)}
-        nSpecies = len(iSpecies)
-        nGroups = len(ogs)
+        counts = ogs.Subset(iogs4).SpeciesCounts()
+        iSpecies = np.flatnonzero(counts.getnnz(axis=0) > 0)
         # (i, j)-th entry of ogMatrix gives the number of genes from i in orthologous group j
-        ogMatrix = np.zeros((nGroups, nSpecies)) 
-        for i_og, og in enumerate(ogs):
-            for gene in og:
-                ogMatrix[i_og, speciesIndexDict[gene.iSp]] += 1
+        ogMatrix = counts[:, iSpecies].toarray().astype(float)
         return ogMatrix, iogs4
         
     def ID_to_OG_Dict(self):
@@ -365,7 +365,8 @@ def GetOrthologues_FromTrees(options):
         options.fewer_open_files,
         old_version=options.old_version,
         exist_msa=options.qMSATrees,
-        fix_files=options.fix_files
+        fix_files=options.fix_files,
+        q_ortholog_pairs=options.ortholog_pairs,
     )
 
 
@@ -388,6 +389,8 @@ def main(args=None):
             pickleDir_nonDefault,
             user_specified_M,
         ) = process_args.ProcessArgs(args)
+        # Start the worker processes for the parallel python stages while the RAM usage is low
+        ptm.GetWorkerPool(options.nProcessAlg)
 
         printer.print(f"[bold dark_goldenrod]OrthoFinder[/bold dark_goldenrod] version [deep_sky_blue2]{__version__}[/deep_sky_blue2]", end="")
         printer.print(" Copyright (C) 2014 [bold dark_goldenrod]David Emms[/bold dark_goldenrod]\n")
@@ -688,7 +691,7 @@ def main(args=None):
             raise NotImplementedError
             # ptm = parallel_task_manager.ParallelTaskManager_singleton()
             ptm.Stop()
-        if not options.save_space and not options.qFastAdd:
+        if not options.save_space and not options.qFastAdd and not options.ortholog_pairs:
             # split up the orthologs into one file per species-pair
             split_ortholog_files.split_ortholog_files(
                 files.FileHandler.GetOrthologuesDirectory()
@@ -144,6 +144,10 @@ def PrintHelp(prog_caller):
         "-I <[bright_magenta]int[/bright_magenta]>",
         f'MCL inflation parameter [Default = [deep_sky_blue2]{g_mclInflation:0.1f}[/deep_sky_blue2]]',
     )
+    table_options.add_row(
+        "--internal-mcl",
+        'Run MCL in-process rather than with the [dark_cyan]mcl[/dark_cyan] binary',
+    )
 
 
     # print(" --matrix <txt>          Scoring matrix allowed by DIAMOND")
@@ -228,6 +232,11 @@ def PrintHelp(prog_caller):
     #     "Only create one compressed orthologs file per species",
     # )
 
+    table_options.add_row(
+        "--ortholog-pairs",
+        "Write orthologs as binary gene ID pairs in Orthologues/Ortholog_Pairs/ instead of TSV files, requires --no-fix-files",
+    )
+
     # print(" -X                      Don't add species names to sequence IDs")
 
     table_options.add_row(
@@ -112,11 +112,13 @@ class Options(object):  #
         self.speciesXMLInfoFN = None
         self.speciesTreeFN = None
         self.mclInflation = g_mclInflation
+        self.internal_mcl = False
         self.dna = False
         self.fewer_open_files = (
             True  # By default only open O(n) orthologs files at a time
         )
         self.save_space = False  # On complete, have only one orthologs file per species
+        self.ortholog_pairs = False  # Write orthologs as gene ID pairs (utils/ortholog_pairs.py) rather than TSV files
         self.v2_scores = False
         self.root_from_previous = False
         self.score_matrix = None
@@ -614,6 +616,9 @@ def ProcessArgs(args):
                 print("Incorrect argument for MCL inflation parameter: %s\n" % arg)
                 util.Fail()
 
+        elif arg == "--internal-mcl":
+            options.internal_mcl = True
+
         elif arg == "-c1":
             print("\nThe option 'c1' has been renamed '--c-homologs'")
             util.Fail()
@@ -624,6 +629,9 @@ def ProcessArgs(args):
         elif arg == "--save-space":
             options.save_space = True
 
+        elif arg == "--ortholog-pairs":
+            options.ortholog_pairs = True
+
         elif arg == "--no-fix-files":
             options.fix_files = False
 
@@ -955,6 +963,12 @@ def ProcessArgs(args):
         )
         util.Fail()
 
+    if options.ortholog_pairs and options.fix_files:
+        print(
+            "ERROR: Argument '--ortholog-pairs' (write orthologs as gene ID pairs) also requires option '--no-fix-files'"
+        )
+        util.Fail()
+
     if options.qPhyldog and (not options.speciesTreeFN):
         print("ERROR: Phyldog currently needs a species tree to be provided")
         util.Fail()
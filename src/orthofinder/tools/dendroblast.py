@@ -3,6 +3,7 @@ import numpy as np
 from collections import defaultdict
 import itertools
 import multiprocessing as mp
+from multiprocessing import shared_memory
 import warnings
 try: 
     import queue
@@ -13,11 +14,15 @@ try:
 except ImportError:
     ...
 
-from . import stag, tree
+from . import stag, tree, phylip
 from ..utils import util, files, parallel_task_manager, program_caller
 from ..utils import blast_file_processor as BlastFileProcessor
 
 
+# Maximum number of gene pairs whose scores are looked up together
+nPairsPerChunk = 2**22
+
+
 class DendroBLASTTrees(object):
     def __init__(self, ogSet, nProcesses_alg, nProcess_std, qDoubleBlast):
         self.ogSet = ogSet
@@ -48,10 +53,9 @@ class DendroBLASTTrees(object):
             except:
                 iog4 = len(ogs_all)
             ogs = ogs_all[:iog4]
-            ogsPerSpecies = [[[(g, i) for i, g in enumerate(og) if g.iSp == iSp] for iSp in self.ogSet.seqsInfo.speciesToUse] for og in ogs]
-            nGenes = [len(og) for og in ogs]
+            genesPerSpecies = GetGenesPerSpecies(ogs, self.ogSet.seqsInfo.speciesToUse)
             nSeqs = self.ogSet.seqsInfo.nSeqsPerSpecies
-            ogMatrices = [[mp.Array('d', n, lock=False) for _ in range(n)] for n in nGenes]
+            ogMatrices = SharedOGMatrices([len(og) for og in ogs])
             blastDir_list = files.FileHandler.GetBlastResultsDir()
             cmd_queue = mp.Queue()
             for iiSp, sp1 in enumerate(self.ogSet.seqsInfo.speciesToUse):
@@ -59,8 +63,8 @@ class DendroBLASTTrees(object):
             worker_status_queue = mp.Queue()
             # Should use PTM?
             runningProcesses = [mp.Process(target=Worker_OGMatrices_ReadBLASTAndUpdateDistances,
-                                           args=(cmd_queue, worker_status_queue, iWorker, ogMatrices, nGenes,
-                                                 self.ogSet.seqsInfo, blastDir_list, ogsPerSpecies, self.qDoubleBlast))
+                                           args=(cmd_queue, worker_status_queue, iWorker, ogMatrices,
+                                                 self.ogSet.seqsInfo, blastDir_list, genesPerSpecies, self.qDoubleBlast))
                                 for iWorker in range(self.nProcesses)]
             for proc in runningProcesses:
                 proc.start()
@@ -102,57 +106,31 @@ class DendroBLASTTrees(object):
                    
     def CompleteOGMatrices(self, ogs, ogMatrices):
         newMatrices = []
-        for iog, (og, m) in enumerate(zip(ogs, ogMatrices)):
-            # dendroblast scores
-            n = m.shape[0]
-            m2 = np.zeros(m.shape)
-            max_og = -9e99
-            for i in range(n):
-                for j in range(i):
-                    m2[i, j] = -np.log(m[i,j] + m[j,i])  
-                    m2[j, i] = m2[i, j]  
-                    max_og = max(max_og, m2[i,j])
+        for m in ogMatrices:
+            m2, _ = CompleteOGMatrix(m.copy())
             newMatrices.append(m2)
         return newMatrices
         
     def CompleteAndWriteOGMatrices(self, ogs, ogMatrices):
         """
-        ogMatrices - each matrix is a list of mp.Array  (so that each represents an nSeq x nSeq matrix
+        ogMatrices - SharedOGMatrices, completed in place
         """
         for iog, (og, m) in enumerate(zip(ogs, ogMatrices)):
-            # dendroblast scores
-            n = len(m)
-            max_og = -9e99
-            # Careful not to over-write a value and then attempt to try to use the old value
-            for i in range(n):
-                for j in range(i):
-                    m[i][j] = -np.log(m[i][j] + m[j][i])  
-                    m[j][i] = m[i][j]  
-                    max_og = max(max_og, m[i][j])
+            _, max_og = CompleteOGMatrix(m)
             self.WritePhylipMatrix(m, [g.ToString() for g in og], files.FileHandler.GetOGsDistMatFN(iog), max_og)
         return ogMatrices
     
     @staticmethod
     def WritePhylipMatrix(m, names, outFN, max_og):
         """
-        m - list of mp.Array  (so that each represents an nSeq x nSeq matrix
+        m - nSeq x nSeq array
         """
-        max_og = 1.1*max_og
-        sliver = 1e-6
-        with open(outFN, 'w') as outfile:
-            n = len(m)
-            outfile.write("%d\n" % n)
-            for i in range(n):
-                outfile.write(names[i] + " ")
-                # values could be -inf, these are the most distantly related so replace with max_og
-                V = [0. + (0. if i==j else m[i][j] if m[i][j] > -9e99 else max_og) for j in range(n)] # "0. +": hack to avoid printing out "-0"
-                V = [sliver if 0 < v < sliver  else v for v in V]  # make sure scientific notation is not used (not accepted by fastme)
-                values = " ".join(["%.6f" % v for v in V])   
-                outfile.write(values + "\n")
+        # values could be -inf, these are the most distantly related so replace with max_og
+        phylip.WriteDistanceMatrix(m, names, outFN, max_og=1.1*max_og, q_zero_diagonal=True)
     
     def SpeciesTreeDistances(self, ogs, ogMatrices, method = 0):
         """
-        ogMatrices - each matrix is a list of mp.Array  (so that each represents an nSeq x nSeq matrix
+        ogMatrices - nSeq x nSeq array for each orthogroup
         """
         spPairs = list(itertools.combinations(self.ogSet.seqsInfo.speciesToUse, 2))
         D = [[] for _ in spPairs]
@@ -163,8 +141,8 @@ class DendroBLASTTrees(object):
                 for i, g in enumerate(og):
                     spDict[g.iSp].append(i)
                 for (sp1, sp2), d_list in zip(spPairs, D):
-                    distances = [m[i][j] for i in spDict[sp1] for j in spDict[sp2]]
-                    if len(distances) > 0: d_list.append(min(distances))
+                    if sp1 in spDict and sp2 in spDict:
+                        d_list.append(m[np.ix_(spDict[sp1], spDict[sp2])].min())
 #                    d_list.append(min(distances) if len(distances) > 0 else None)
         return D, spPairs
     
@@ -178,15 +156,7 @@ class DendroBLASTTrees(object):
             M[sp1, sp2] = x
             M[sp2, sp1] = x
         speciesMatrixFN = files.FileHandler.GetSpeciesTreeMatrixFN(qPutInWorkingDir)  
-        sliver = 1e-6
-        with open(speciesMatrixFN, 'w') as outfile:
-            outfile.write("%d\n" % n)
-            for i in range(n):
-                outfile.write(str(self.ogSet.seqsInfo.speciesToUse[i]) + " ")
-                V = [(0. + M[i,j]) for j in range(n)]  # hack to avoid printing out "-0"
-                V = [sliver if 0 < v < sliver else v for v in V]  # make sure scientific notation is not used (not accepted by fastme)
-                values = " ".join(["%.6f" % v for v in V])   
-                outfile.write(values + "\n")       
+        phylip.WriteDistanceMatrix(M, list(map(str, self.ogSet.seqsInfo.speciesToUse)), speciesMatrixFN)
         treeFN = files.FileHandler.GetSpeciesTreeUnrootedFN()
         cmd = " ".join(["fastme", "-i", speciesMatrixFN, "-o", treeFN, "-N", "-w", "O"] + (["-s"] if n < 1000 else []))
         return cmd, treeFN
@@ -233,6 +203,7 @@ class DendroBLASTTrees(object):
                 D, spPairs = self.SpeciesTreeDistances(ogs, ogMatrices)
                 cmd_spTree, spTreeFN_ids = self.PrepareSpeciesTreeCommand(D, spPairs)
                 cmds_trees = [[cmd_spTree]] + cmds_trees
+        ogMatrices.Release()
         del ogMatrices
         util.PrintUnderline("Inferring gene and species trees" if qSpeciesTree else "Inferring gene trees")
         program_caller.RunParallelCommands(self.nProcess_std, cmds_trees, qListOfList=True)
@@ -257,6 +228,7 @@ class DendroBLASTTrees(object):
         else:
             ogs, ogMatrices_partial = self.GetOGMatrices_FullParallel()
             ogMatrices = self.CompleteOGMatrices(ogs, ogMatrices_partial)
+            ogMatrices_partial.Release()
             del ogMatrices_partial
             D, spPairs = self.SpeciesTreeDistances(ogs, ogMatrices)
             del ogMatrices
@@ -269,8 +241,87 @@ class DendroBLASTTrees(object):
 # ==============================================================================================================================      
 # DendroBlast   
 
-def Worker_OGMatrices_ReadBLASTAndUpdateDistances(cmd_queue, worker_status_queue, iWorker, ogMatrices, nGenes, seqsInfo,
-                                                  blastDir_list, ogsPerSpecies, qDoubleBlast):
+class SharedOGMatrices(object):
+    """
+    The nSeq x nSeq distance matrix for each orthogroup, stored one after another in a
+    single shared memory block so that the worker processes can fill them in place
+    """
+    def __init__(self, nGenes):
+        self.nGenes = np.asarray(nGenes, dtype=np.int64)
+        self.offsets = np.zeros(len(self.nGenes) + 1, dtype=np.int64)
+        np.cumsum(self.nGenes * self.nGenes, out=self.offsets[1:])
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, 8 * int(self.offsets[-1])))
+        self.data = np.ndarray(int(self.offsets[-1]), dtype=np.float64, buffer=self.shm.buf)
+
+    def __len__(self):
+        return len(self.nGenes)
+
+    def __getitem__(self, iog):
+        n = int(self.nGenes[iog])
+        return self.data[self.offsets[iog]:self.offsets[iog + 1]].reshape((n, n))
+
+    def __iter__(self):
+        for iog in range(len(self)):
+            yield self[iog]
+
+    def Release(self):
+        """
+        Free the shared memory. Any arrays obtained from this object must no longer be used
+        """
+        del self.data
+        try:
+            self.shm.close()
+        except BufferError:
+            # a view is still referenced, the memory is freed once it is released
+            pass
+        self.shm.unlink()
+
+
+def GetGenesPerSpecies(ogs, speciesToUse):
+    """
+    Args:
+        ogs - list of orthogroups, each a list of Seq
+    Returns:
+        genesPerSpecies - for each species in speciesToUse, a tuple of arrays giving the orthogroup index, 
+                          the position within the orthogroup and the sequence ID of each of its genes, in 
+                          order of orthogroup
+    """
+    iOG = np.repeat(np.arange(len(ogs)), [len(og) for og in ogs])
+    iPos = np.concatenate([np.arange(len(og)) for og in ogs]) if ogs else np.zeros(0, dtype=np.int64)
+    iSp = np.array([g.iSp for og in ogs for g in og], dtype=np.int64)
+    iSeq = np.array([g.iSeq for og in ogs for g in og], dtype=np.int64)
+    return [(iOG[iSp == sp], iPos[iSp == sp], iSeq[iSp == sp]) for sp in speciesToUse]
+
+
+def GenePairs(genes_i, genes_j, nOGs):
+    """
+    All pairs of genes from two species that are in the same orthogroup, in chunks of at most
+    nPairsPerChunk pairs (or the pairs for a single gene, if more)
+    Args:
+        genes_i, genes_j - tuples of arrays for the two species, as returned by GetGenesPerSpecies
+        nOGs - number of orthogroups
+    Returns:
+        generator of (i, j) - arrays of the indices in genes_i and genes_j of the pairs of genes
+    """
+    counts_j = np.bincount(genes_j[0], minlength=nOGs)
+    starts_j = np.cumsum(counts_j) - counts_j
+    nPairs = counts_j[genes_i[0]]
+    cumulative = np.cumsum(nPairs)
+    nPairsTotal = cumulative[-1] if len(cumulative) else 0
+    bounds = np.searchsorted(cumulative, np.arange(nPairsPerChunk, nPairsTotal, nPairsPerChunk), side="right")
+    bounds = [0] + bounds.tolist() + [len(nPairs)]
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        n = nPairs[a:b]
+        i = np.repeat(np.arange(a, b), n)
+        if len(i) == 0:
+            continue
+        # position of each pair among the pairs for its gene i
+        k = np.arange(len(i)) - np.repeat(np.cumsum(n) - n, n)
+        yield i, starts_j[genes_i[0][i]] + k
+
+
+def Worker_OGMatrices_ReadBLASTAndUpdateDistances(cmd_queue, worker_status_queue, iWorker, ogMatrices, seqsInfo,
+                                                  blastDir_list, genesPerSpecies, qDoubleBlast):
     speciesToUse = seqsInfo.speciesToUse
     with np.errstate(divide='ignore'):
         while True:
@@ -283,21 +334,42 @@ def Worker_OGMatrices_ReadBLASTAndUpdateDistances(cmd_queue, worker_status_queue
                 mins = np.ones((nSeqs_sp1, 1), dtype=np.float64)*9e99 
                 maxes = np.zeros((nSeqs_sp1, 1), dtype=np.float64)
                 for B in Bs:
-                    m0, m1 = lil_minmax(B)
+                    m0, m1 = csr_minmax(B)
                     mins = np.minimum(mins, m0)
                     maxes = np.maximum(maxes, m1)
-                maxes_inv = 1./maxes
+                mins = mins.ravel()
+                maxes_inv = 1./maxes.ravel()
+                iOG_i, iPos_i, iSeq_i = genesPerSpecies[iiSp]
                 for jjSp, B  in enumerate(Bs):
-                    for og, m in zip(ogsPerSpecies, ogMatrices):
-                        for gi, i in og[iiSp]:
-                            for gj, j in og[jjSp]:
-                                    m[i][j] = 0.5*max(B[gi.iSeq, gj.iSeq], mins[gi.iSeq]) * maxes_inv[gi.iSeq]
+                    _, iPos_j, iSeq_j = genesPerSpecies[jjSp]
+                    for i, j in GenePairs(genesPerSpecies[iiSp], genesPerSpecies[jjSp], len(ogMatrices)):
+                        iOG = iOG_i[i]
+                        iSeq = iSeq_i[i]
+                        scores = np.asarray(B[iSeq, iSeq_j[j]]).ravel()
+                        ogMatrices.data[ogMatrices.offsets[iOG] + iPos_i[i] * ogMatrices.nGenes[iOG] + iPos_j[j]] = \
+                            0.5*np.maximum(scores, mins[iSeq]) * maxes_inv[iSeq]
                 del Bs, B, mins, maxes, m0, m1, maxes_inv    # significantly reduces RAM usage
                 worker_status_queue.put(("finish", iWorker, iiSp))
             except queue.Empty:
                 worker_status_queue.put(("empty", iWorker, None))
                 return 
 
+def CompleteOGMatrix(m):
+    """
+    Convert the scores for an orthogroup to the symmetric DendroBLAST distances, in place
+    Args:
+        m - nSeq x nSeq array of the normalised scores
+    Returns:
+        m - the distance matrix, with zero diagonal
+        max_og - the maximum distance
+    """
+    with np.errstate(divide='ignore'):
+        d = -np.log(m + m.T)
+    m[:] = d
+    np.fill_diagonal(m, 0.)
+    max_og = m[np.tril_indices(m.shape[0], -1)].max() if m.shape[0] > 1 else -9e99
+    return m, max_og
+
 def GetRAMErrorText():
     text = "ERROR: The computer ran out of RAM and killed OrthoFinder processes\n"
     text += "Try using a computer with more RAM. If you used the '-a' option\n"
@@ -306,16 +378,18 @@ def GetRAMErrorText():
 
 # ==============================================================================================================================
 
-def lil_minmax(M):
+def csr_minmax(M):
+    """
+    Row-wise minimum & maximum of the stored values of a CSR matrix. Rows without values have min 9e99 & max 0
+    """
     n = M.shape[0]
     mins = np.ones((n, 1), dtype = np.float64) * 9e99
     maxes = np.zeros((n, 1), dtype = np.float64)
-    for kRow in range(n):
-        values=M.getrowview(kRow)
-        if values.nnz == 0:
-            continue
-        mins[kRow] = min(values.data[0])
-        maxes[kRow] = max(values.data[0])
+    q_nonempty = np.diff(M.indptr) != 0
+    if M.nnz > 0:
+        starts = M.indptr[:-1][q_nonempty]
+        mins[q_nonempty, 0] = np.minimum.reduceat(M.data, starts)
+        maxes[q_nonempty, 0] = np.maximum.reduceat(M.data, starts)
     return mins, maxes
 
 # ==============================================================================================================================    
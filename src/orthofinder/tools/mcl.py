@@ -26,15 +26,18 @@
 from __future__ import absolute_import
 import sys
 import csv
+import bisect
 from typing import List, Set
+import numpy as np
 try:
     from rich import print
 except ImportError:
     ...
 
 from ..utils import parallel_task_manager, util, files
+from ..orthogroups.orthogroup_array import OrthogroupArray
 
-from collections import defaultdict, Counter
+from collections import defaultdict
 import xml.etree.ElementTree as ET              # Y
 from xml.etree.ElementTree import SubElement    # Y
 from xml.dom import minidom
@@ -87,44 +90,76 @@ def GetSingleID(speciesStartingIndices, seq, speciesToUse):
     return iSeq + offset  
 
 def GetIDPair(speciesStartingIndices, singleID, speciesToUse):   
-    for i, startingIndex in enumerate(speciesStartingIndices):
-        if startingIndex > singleID:
-            return "%d_%d" % (speciesToUse[i-1], singleID - speciesStartingIndices[i-1])
-    return "%d_%d" % (speciesToUse[-1], singleID - speciesStartingIndices[len(speciesStartingIndices)-1]) 
+    i = bisect.bisect_right(speciesStartingIndices, singleID) - 1
+    return "%d_%d" % (speciesToUse[i], singleID - speciesStartingIndices[i])
 
-def ConvertSingleIDsToIDPair(seqsInfo, clustersFilename, newFilename, q_unassigned=False):
-    with open(clustersFilename, 'r') as clusterFile, open(newFilename, "w") as output:
-        header = True
-        for line in clusterFile:
-            appendDollar = False
-            initialText = ""
-            idsString = ""
-            ids = []
-            if header:
-                output.write(line)
-                if line.count("begin"):
-                    header = False
-            else:
-                if line.find(")") != -1:
-                    output.write(line)
-                    break
-                if q_unassigned and not line.startswith(" ") and len(line.split()) == 3:
-                    # This is a single gene, not necessarily from this MCL clustering but here implicitly
-                    continue
-                if line[-2] == "$":
-                    line = line[:-3]
-                    appendDollar = True
-                if line[0] != " ":
-                    initialText, line = line.split(None, 1)
-                # continuation of group
-                ids = line.split()
-                for id in ids:
-                    idsString += GetIDPair(seqsInfo.seqStartingIndices, int(id), seqsInfo.speciesToUse) + " "
-                output.write(initialText + "      " + idsString)
-                if appendDollar:
-                    output.write("$\n")
-                else:
-                    output.write("\n")
+
+def GetIDPairs(seqsInfo, ids):
+    """
+    Convert sequence IDs used in the graph to species-sequence ID pairs
+    Args:
+        ids - array of the sequence IDs used in the graph
+    Returns:
+        list of "species_seq" ID strings
+    """
+    starts = np.asarray(seqsInfo.seqStartingIndices)
+    iSp = np.searchsorted(starts, ids, side="right") - 1
+    pairs = zip(np.asarray(seqsInfo.speciesToUse)[iSp].tolist(), (ids - starts[iSp]).tolist())
+    return ["%d_%d" % p for p in pairs]
+
+
+def ReadClusterLabels(clustersFilename, nNodes):
+    """
+    Read an mcl clusters file
+    Args:
+        nNodes - number of nodes in the graph
+    Returns:
+        labels - array of the cluster index for each node
+    """
+    with open(clustersFilename, 'r') as clusterFile:
+        text = clusterFile.read()
+    iBody = text.index("\n", text.index("begin")) + 1
+    iEnd = text.find(")", iBody)
+    iEnd = len(text) if iEnd == -1 else iEnd
+    labels = np.empty(nNodes, dtype=np.int64)
+    for c in text[iBody:iEnd].split("$"):
+        c = c.split()
+        # The first field is the cluster index
+        if len(c) > 1:
+            labels[np.array(c[1:], dtype=np.int64)] = int(c[0])
+    return labels
+
+
+def WriteClusters(seqsInfo, clusters, newFilename, q_unassigned=False):
+    """
+    Write clusters in the format of the mcl clusters file with the sequence IDs converted to ID pairs
+    Args:
+        clusters - list of arrays of the sequence IDs used in the graph
+        q_unassigned - skip single-gene clusters
+    """
+    with open(newFilename, "w") as output:
+        output.write("(mclheader\nmcltype matrix\ndimensions %dx%d\n)\n" % (seqsInfo.nSeqs, len(clusters)))
+        output.write("(mclmatrix\nbegin\n")
+        iCluster = 0
+        for ids in clusters:
+            if q_unassigned and len(ids) == 1:
+                continue
+            output.write("%d      %s $\n" % (iCluster, " ".join(GetIDPairs(seqsInfo, ids))))
+            iCluster += 1
+        output.write(")\n")
+
+
+def SpeciesColumns(species, speciesToUse):
+    """
+    Args:
+        species - array of species IDs
+        speciesToUse - list of species IDs
+    Returns:
+        array of the index in speciesToUse of each species ID
+    """
+    columns = np.full(max(speciesToUse) + 1, -1, dtype=np.int64)
+    columns[speciesToUse] = np.arange(len(speciesToUse))
+    return columns[species]
 
 
 def write_updated_clusters_file(ogs: List[Set[str]], clustersFilename_pairs):
@@ -196,29 +231,27 @@ class MCL:
     #            scoresNode = SubElement(root, 'scores')        # skip
 
         # Orthogroups
+        if not isinstance(predictedOGs, OrthogroupArray):
+            predictedOGs = OrthogroupArray.FromStrings(predictedOGs)
+        singleIDs = (np.asarray(speciesStartingIndices)[SpeciesColumns(predictedOGs.species, speciesToUse)] + predictedOGs.seqs).tolist()
+        offsets = predictedOGs.offsets.tolist()
         allGroupsNode = SubElement(root, 'groups')
-        for iOg, og in enumerate(predictedOGs):
+        for iOg in range(len(predictedOGs)):
             groupNode = SubElement(allGroupsNode, 'orthologGroup')
             groupNode.set('id', str(iOg))
     #                groupScoreNode = SubElement(groupNode, 'score')    # skip
     #                groupScoreNode.set('id', "")                       # skip
     #                groupScoreNode.set('value', "")                    # skip
     #                SubElement(groupNode, 'property')                  # skip
-            for seq in og:
+            for singleID in singleIDs[offsets[iOg]:offsets[iOg + 1]]:
                 geneNode = SubElement(groupNode, 'geneRef')
-                geneNode.set('id', str(GetSingleID(speciesStartingIndices, seq, speciesToUse)))
+                geneNode.set('id', str(singleID))
     #                    SubElement(geneNode, 'score')                  # skip
         with open(orthoxmlFilename, 'w') as orthoxmlFile:
     #            ET.ElementTree(root).write(orthoxmlFile)
             orthoxmlFile.write(MCL.prettify(root))
         print("Orthogroups have been written to orthoxml file:\n   %s" % orthoxmlFilename)
 
-    @staticmethod
-    def RunMCL(graphFilename, clustersFilename, nProcesses, inflation):
-        command = " ".join(["mcl", graphFilename, "-I", str(inflation), "-o", clustersFilename, "-te", str(nProcesses), "-V", "all"])
-        parallel_task_manager.RunCommand(command, qPrintOnError=True)
-        util.PrintTime("Ran MCL")
-
     @staticmethod
     def WriteOrthogroupFiles(
             ogs, 
@@ -268,9 +301,11 @@ class MCL:
     ):
 
         nSpecies = len(speciesNamesDict)
-
-        ogs_names = [[idToNameDict[seq] for seq in og] for og in ogs]
-        ogs_ints = [[list(map(int, sequence.split("_"))) for sequence in og] for og in ogs]
+        if not isinstance(ogs, OrthogroupArray):
+            ogs = OrthogroupArray.FromStrings(ogs)
+        names = ogs.Names(idToNameDict)
+        columns = SpeciesColumns(ogs.species, speciesToUse).tolist()
+        offsets = ogs.offsets.tolist()
 
         # write out
         outputFilename = resultsBaseFilename + ".tsv"
@@ -285,21 +320,21 @@ class MCL:
                 writer.writerow(row)
             fileWriter_counts.writerow(row + ['Total'])
 
-            for iOg, (og, og_names) in enumerate(zip(ogs_ints, ogs_names)):
-                ogDict = defaultdict(list)
+            for iOg in range(len(ogs)):
+                start, end = offsets[iOg], offsets[iOg + 1]
                 row = ["OG%07d" % iOg]
                 thisOutputWriter = fileWriter
                 # separate it into sequences from each species
-                if len(og) == 1:
+                if end - start == 1:
                     row.extend(['' for x in range(nSpecies)])
-                    row[speciesToUse.index(og[0][0]) + 1] = og_names[0]
+                    row[columns[start] + 1] = names[start]
                     thisOutputWriter = singleGeneWriter
                 else:
-                    for (iSpecies, iSequence), name in zip(og, og_names):
-                        ogDict[speciesToUse.index(iSpecies)].append(name)
+                    ogDict = defaultdict(list)
+                    for iCol, name in zip(columns[start:end], names[start:end]):
+                        ogDict[iCol].append(name)
                     for iSpecies in range(nSpecies):
                         row.append(", ".join(sorted(ogDict[iSpecies])))
-                    counts = Counter([iSpecies for iSpecies, _ in og])
-                    counts_row = [counts[iSpecies] for iSpecies in speciesToUse]
+                    counts_row = [len(ogDict[iCol]) for iCol in range(len(speciesToUse))]
                     fileWriter_counts.writerow(row[:1] + counts_row + [sum(counts_row)])
                 thisOutputWriter.writerow(row)
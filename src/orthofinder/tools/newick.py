@@ -46,6 +46,7 @@ except NameError:
 
 import re
 import os
+import gc
 try:
     from rich import print
 except ImportError:
@@ -202,85 +203,219 @@ def read_newick(newick, root_node=None, format=0):
     You can also take advantage from this behaviour to concatenate
     several tree structures.
     """
+    return read_newick_first_format(newick, [format], root_node)[0]
 
+def read_newick_first_format(newick, formats, root_node=None):
+    """ Reads a newick tree, as read_newick, using the first of the
+    formats that the node data of the tree matches. The tree is only
+    tokenized once, whatever the number of formats tried. E.g. formats
+    (2, 0) reads internal node labels as support values if all internal
+    nodes have them.
+
+    Returns the tuple (root_node, format). Raises NewickError if none of
+    the formats match.
+    """
     if root_node is None:
-        from .tree import TreeNode   
+        from .tree import TreeNode
         root_node = TreeNode()
-
+    parents, data, format = parse_newick_first_format(newick, formats)
+    # The nodes reference each other, so the cyclic garbage collector would
+    # otherwise run (and scan all tracked objects) many times while building
+    # a large tree. It is paused until the tree is complete.
+    q_gc = gc.isenabled()
+    gc.disable()
+    try:
+        # The new nodes are only reachable from root_node, so its name index
+        # is invalidated once here rather than on every child added
+        if root_node._q_name_indexed:
+            root_node._invalidate_name_index()
+        node_class = root_node.__class__
+        nodes = [root_node]
+        for p in parents[1:]:
+            child = node_class()
+            nodes[p]._children.append(child)
+            child._up = nodes[p]
+            nodes.append(child)
+        for node, d in zip(nodes, data):
+            if d is None:
+                continue
+            container1, value1, container2, value2, nhx = d
+            if container1 is not None:
+                node.add_feature(container1, value1)
+            if container2 is not None:
+                node.add_feature(container2, value2)
+            if nhx is not None:
+                _parse_extra_features(node, nhx)
+    finally:
+        if q_gc:
+            gc.enable()
+    return root_node, format
+
+def parse_newick_first_format(newick, formats):
+    """ Reads the structure and node data of a newick tree, from either a
+    string or a file, without building the tree. See read_newick_first_format.
+
+    Returns the tuple (parents, data, format): the index of the parent of
+    each node, numbered in preorder (-1 for the root), the node data as
+    returned by _parse_node_data and the format used.
+    """
     if isinstance(newick, basestring):
         if os.path.exists(newick):
-            nw = open(newick, 'r').read()
+            with open(newick, 'r') as infile:
+                nw = infile.read()
         else:
             nw = newick
         nw = nw.strip()
         if not nw.startswith('(') and nw.endswith(';'):
-            return _read_node_data(nw, root_node, "single", format)
-            
+            parents, node_types, labels = [-1], ["single"], [nw]
         elif not nw.startswith('(') or not nw.endswith(';'):
             raise NewickError('Unexisting tree file or Malformed newick tree structure: ' + newick[-200:])
         else:
-            return _read_newick_from_string(nw, root_node, format)
-
+            parents, node_types, labels = _tokenize_newick(nw)
     else:
         raise NewickError("'newick' argument must be either a filename or a newick string.")
 
-def _read_newick_from_string(nw, root_node, format):
-    """ Reads a newick string in the New Hampshire format. """
-
+    for i, format in enumerate(formats):
+        try:
+            data = _parse_node_data(node_types, labels, format)
+            break
+        except (NewickError, ValueError):
+            if i == len(formats) - 1:
+                raise
+    return parents, data, format
+
+# Tokens of a newick string: the structural characters and the text between them
+_NEWICK_TOKENS_RE = re.compile("[(),]|[^(),]+")
+
+def _tokenize_newick(nw):
+    """ Reads the structure of a newick string in a single pass. The
+    nodes are numbered in the order they appear in the string, which is
+    preorder, so a node's parent always precedes it.
+
+    Returns the lists (parents, node_types, labels): the index of the
+    parent of each node (-1 for the root), "leaf" or "internal" for each node
+    and the node data text of each node (None if there is none to read,
+    as for a root without data).
+    """
     if nw.count('(') != nw.count(')'):
         raise NewickError('Parentheses do not match. Broken tree structure')
 
     # white spaces and separators are removed
     nw = re.sub("[\n\r\t]+", "", nw)
 
-    current_parent = None
-
-    # Ok, this is my own way of reading newick structures. I find it
-    # more flexible and elegant than other docummented methods. Don't
-    # know if I'm loosing much efficiency. It Starts by splitting the
-    # structure using open parentheses. Each of the resulting chunks
-    # represent an internal node. So for each chunk I create a new node
-    # that hungs from the current parent node.  Each internal node chunk
-    # may contain information about terminal nodes hanging from the
-    # internal and clossing parenthessis (closing previously opened
-    # internal nodes).
-    #
-    # Enjoy.
-    # by JHC ;)
-
-    # Skip the first chunk. It is always == ''
-    for internal_node in nw.split("(")[1:]:
-        # If this is the root of tree, use the root_node instead of
-        # creating it, otherwise make a new one.
-        if current_parent is None:
-            current_parent = root_node
-        else:
-            current_parent = current_parent.add_child()
-        # We can only find leaf nodes within this chunk, since rest of
-        # internal nodes will be in the next newick chunks
-        possible_leaves = internal_node.split(",")
-        for i, leaf in enumerate(possible_leaves):
-            # Any resulting sub-chunk resulting from splitting by commas can
-            # be considered (tpologically) as a child to the current parent
-            # node. We only discard chunks if they are empty and in the last
-            # possition, meaining that the next brother is not terminal bu
-            # internal node (will be visited in the next newick chunk)
-            if leaf.strip() == '' and i == len(possible_leaves)-1:
+    parents = []
+    node_types = []
+    labels = []
+    current_parent = -1
+    q_closed = False
+    tokens = _NEWICK_TOKENS_RE.findall(nw, nw.index("("))
+    n = len(tokens)
+    k = 0
+    while k < n:
+        token = tokens[k]
+        k += 1
+        # the text following the token, up to the next structural character
+        text = ""
+        if k < n and _token_is_text(tokens[k]):
+            text = tokens[k]
+            k += 1
+        if q_closed:
+            raise NewickError('Unexpected text after the end of the tree: ' + text[:50])
+        if token == ")":
+            if text.strip() == ";":
                 continue
-            # Leaf text strings may end with a variable number of clossing
-            # parenthesis. For each ')' we read the information of the
-            # current node, close it and go up one more node.
-            clossing_nodes = leaf.split(")")
-            # first par contain leaf info
-            _read_node_data(clossing_nodes[0], current_parent, "leaf", format)
-            # The next parts containg clossing nodes and info about the
-            # internal nodes.
-            if len(clossing_nodes)>1:
-                for closing_internal in clossing_nodes[1:]:
-                    if closing_internal.strip() ==";": continue
-                    _read_node_data(closing_internal, current_parent, "internal", format)
-                    current_parent = current_parent.up
-    return root_node
+            # data of the internal node being closed
+            labels[current_parent] = text
+            current_parent = parents[current_parent]
+            q_closed = current_parent == -1
+            continue
+        if token == "(":
+            parents.append(current_parent)
+            node_types.append("internal")
+            labels.append(None)
+            current_parent = len(parents) - 1
+        # an empty text before an opening parenthesis is not a leaf, the
+        # next sibling is an internal node
+        if text.strip() == '' and (k == n or tokens[k] == "("):
+            continue
+        parents.append(current_parent)
+        node_types.append("leaf")
+        labels.append(text)
+    return parents, node_types, labels
+
+def _token_is_text(token):
+    return token != "(" and token != ")" and token != ","
+
+# Compiled regular expressions for the node data, by format and node type
+_NODE_DATA_RE = {}
+
+def _get_node_data_re(format, node_type):
+    """ Returns the compiled regular expression matching the data of a
+    node of the given type and the NW_FORMAT entries for its two fields """
+    key = (format, node_type)
+    if key not in _NODE_DATA_RE:
+        if node_type == "leaf" or node_type == "single":
+            attr1, attr2 = NW_FORMAT[format][0], NW_FORMAT[format][1]
+        else:
+            attr1, attr2 = NW_FORMAT[format][2], NW_FORMAT[format][3]
+        container1, converterFn1, flexible1 = attr1
+        container2, converterFn2, flexible2 = attr2
+
+        if converterFn1 == str:
+            FIRST_MATCH = "("+_NAME_RE+")"
+        elif converterFn1 == float:
+            FIRST_MATCH = "("+_FLOAT_RE+")"
+        elif converterFn1 is None:
+            FIRST_MATCH = '()'
+
+        if converterFn2 == str:
+            SECOND_MATCH = "(:"+_NAME_RE+")"
+        elif converterFn2 == float:
+            SECOND_MATCH = "(:"+_FLOAT_RE+")"
+        elif converterFn2 is None:
+            SECOND_MATCH = '()'
+
+        if flexible1:
+            FIRST_MATCH += "?"
+        if flexible2:
+            SECOND_MATCH += "?"
+
+        MATCH = r'%s\s*%s\s*(%s)?' % (FIRST_MATCH, SECOND_MATCH, _NHX_RE)
+        _NODE_DATA_RE[key] = (re.compile(MATCH), container1, converterFn1, container2, converterFn2)
+    return _NODE_DATA_RE[key]
+
+def _parse_node_data(node_types, labels, format):
+    """ Reads the data of each node from its text.
+
+    Returns a list with, for each node, the tuple (container1, value1,
+    container2, value2, nhx) of the attributes to set (a container is
+    None if there is no value) and the NHX string, if any, or None for
+    nodes without data to read. Raises NewickError if the data of a
+    node does not match the format.
+    """
+    data = []
+    for node_type, subnw in zip(node_types, labels):
+        if subnw is None:
+            data.append(None)
+            continue
+        pattern, container1, converterFn1, container2, converterFn2 = _get_node_data_re(format, node_type)
+        match = pattern.match(subnw)
+        if not match:
+            raise NewickError("Unexpected leaf node format:\n\t"+ subnw[0:50] + "[%s]" %format)
+        g1, g2, nhx = match.groups()
+        value1 = value2 = None
+        if g1 is not None and g1 != '':
+            value1 = converterFn1(g1.strip())
+        else:
+            container1 = None
+        if g2 is not None and g2 != '':
+            value2 = converterFn2(g2[1:].strip())
+        else:
+            container2 = None
+        if nhx is None or not nhx.startswith("[&&NHX"):
+            nhx = None
+        data.append((container1, value1, container2, value2, nhx))
+    return data
 
 def _parse_extra_features(node, NHX_string):
     """ Reads node's extra data form its NHX string. NHX uses this
@@ -295,66 +430,6 @@ def _parse_extra_features(node, NHX_string):
             raise ValueError(e)
         node.add_feature(pname, pvalue)
 
-def _read_node_data(subnw, current_node, node_type, format):
-    """ Reads a leaf node from a subpart of the original newick
-    tree """
-
-    if node_type == "leaf" or node_type == "single":
-        if node_type == "leaf":
-            node = current_node.add_child()
-        else:
-            node = current_node
-        container1 = NW_FORMAT[format][0][0]
-        container2 = NW_FORMAT[format][1][0]
-        converterFn1 = NW_FORMAT[format][0][1]
-        converterFn2 = NW_FORMAT[format][1][1]
-        flexible1 = NW_FORMAT[format][0][2]
-        flexible2 = NW_FORMAT[format][1][2]
-    else:
-        node = current_node
-        container1 = NW_FORMAT[format][2][0]
-        container2 = NW_FORMAT[format][3][0]
-        converterFn1 = NW_FORMAT[format][2][1]
-        converterFn2 = NW_FORMAT[format][3][1]
-        flexible1 = NW_FORMAT[format][2][2]
-        flexible2 = NW_FORMAT[format][3][2]
-
-    if converterFn1 == str:
-        FIRST_MATCH = "("+_NAME_RE+")"
-    elif converterFn1 == float:
-        FIRST_MATCH = "("+_FLOAT_RE+")"
-    elif converterFn1 is None:
-        FIRST_MATCH = '()'
-
-    if converterFn2 == str:
-        SECOND_MATCH = "(:"+_NAME_RE+")"
-    elif converterFn2 == float:
-        SECOND_MATCH = "(:"+_FLOAT_RE+")"
-    elif converterFn2 is None:
-        SECOND_MATCH = '()'
-
-    if flexible1:
-        FIRST_MATCH += "?"
-    if flexible2:
-        SECOND_MATCH += "?"
-
-    MATCH = '%s\s*%s\s*(%s)?' % (FIRST_MATCH, SECOND_MATCH, _NHX_RE)
-    data = re.match(MATCH, subnw)
-    if data:
-        data = data.groups()
-        if data[0] is not None and data[0] != '':
-            node.add_feature(container1, converterFn1(data[0].strip()))
-
-        if data[1] is not None and data[1] != '':
-            node.add_feature(container2, converterFn2(data[1][1:].strip()))
-
-        if data[2] is not None \
-                and data[2].startswith("[&&NHX"):
-            _parse_extra_features(node, data[2])
-    else:
-        raise NewickError("Unexpected leaf node format:\n\t"+ subnw[0:50] + "[%s]" %format)
-    return
-
 # def write_newick_recursive(node, features=None, format=1, _is_root=True):
 #     """ Recursively reads a tree structure and returns its NHX
 #     representation. """
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 David Emms
+#
+# This program (OrthoFinder) is distributed under the terms of the GNU General Public License v3
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  When publishing work that uses OrthoFinder please cite:
+#      Emms, D.M. and Kelly, S. (2015) OrthoFinder: solving fundamental biases in whole genome comparisons dramatically
+#      improves orthogroup inference accuracy, Genome Biology 16:157
+#
+# For any enquiries send an email to David Emms
+# david_emms@hotmail.com
+"""
+PHYLIP distance matrix files for FastME
+-------------------------------------------------------------------------------
+The values are written with six decimal places, as "%.6f" would write them,
+but formatted with NumPy into a byte buffer for a block of rows at a time.
+FastME does not accept scientific notation, so small positive values are
+written as the sliver value instead.
+"""
+import itertools
+
+import numpy as np
+
+sliver = 1e-6
+
+# Number of rows formatted together
+nRowsPerChunk = 2**8
+
+# Values at least this large, or that are this close to a rounding tie at the
+# sixth decimal place, are formatted individually with "%.6f"
+maxFastValue = 2.**20
+tieTolerance = 1e-3
+
+nDecimals = 6
+decimalScale = 10**nDecimals
+
+
+def PrepareValues(V, iFirstRow=0, max_og=None, q_zero_diagonal=False, q_sliver_all=False):
+    """
+    Apply the substitutions made before the values are written
+    Args:
+        V - (k x n) array of rows iFirstRow to iFirstRow + k of the matrix, modified in place
+        max_og - value used in place of -inf (any value not greater than -9e99), or None to keep them
+        q_zero_diagonal - write 0 on the diagonal whatever the stored value
+        q_sliver_all - replace all values less than the sliver, not just small positive values
+    Returns:
+        V - the values to write
+    """
+    if q_zero_diagonal:
+        i = np.arange(V.shape[0])
+        j = i + iFirstRow
+        q = j < V.shape[1]
+        V[i[q], j[q]] = 0.
+    if max_og is not None:
+        V[~(V > -9e99)] = max_og
+    V += 0.     # avoid writing "-0"
+    if q_sliver_all:
+        V[V < sliver] = sliver
+    else:
+        V[(0 < V) & (V < sliver)] = sliver
+    return V
+
+
+def FormatRows(V, prefixes):
+    """
+    Each value is formatted into a fixed-width record of bytes, right-aligned, and
+    the records are then packed together.
+    Args:
+        V - (k x n) array of values
+        prefixes - list of k strings to start each row with
+    Returns:
+        text - bytes for the k rows, each the prefix followed by the space-separated values as "%.6f"
+    """
+    k, n = V.shape
+    V = V.ravel()
+    x = np.abs(V) * decimalScale
+    with np.errstate(invalid='ignore'):
+        q_slow = ~(np.abs(V) < maxFastValue)
+        q_slow |= np.abs(x - np.floor(x) - 0.5) < tieTolerance
+    r = np.rint(np.where(q_slow, 0., x)).astype(np.int64)
+    iPart, fPart = np.divmod(r, decimalScale)
+    iPart = iPart.astype(np.int32)
+    fPart = fPart.astype(np.int32)
+    nIntDigits = np.ones(len(V), dtype=np.int32)
+    p = 10
+    while p <= iPart.max(initial=0):
+        nIntDigits += iPart >= p
+        p *= 10
+    q_neg = (V < 0) & ~q_slow
+    # record: sign, integer digits, point, decimal digits and the separator
+    nIntMax = int(nIntDigits.max(initial=1))
+    W = 1 + nIntMax + 1 + nDecimals + 1
+    R = np.empty((len(V), W), dtype=np.uint8)
+    for d in range(nDecimals):
+        q = fPart // 10
+        R[:, -2 - d] = fPart - 10 * q
+        fPart = q
+    for d in range(nIntMax):
+        q = iPart // 10
+        R[:, -3 - nDecimals - d] = iPart - 10 * q
+        iPart = q
+    R += ord("0")
+    R[:, -2 - nDecimals] = ord(".")
+    R[:, -1] = ord(" ")
+    R[n - 1::n, -1] = ord("\n")
+    i_neg = np.flatnonzero(q_neg)
+    R[i_neg, W - 3 - nDecimals - nIntDigits[i_neg]] = ord("-")
+    widths = np.where(q_slow, 0, q_neg + nIntDigits + 2 + nDecimals)
+    text = R[np.arange(W) >= (W - widths)[:, None]].tobytes()
+    # insert the row prefixes and the values formatted individually
+    i_slow = np.flatnonzero(q_slow)
+    seps = ["\n" if (i + 1) % n == 0 else " " for i in i_slow.tolist()]
+    inserts = [p.encode() for p in prefixes] + [("%.6f%s" % vs).encode() for vs in zip(V[i_slow].tolist(), seps)]
+    i_inserts = np.concatenate((np.arange(k) * n, i_slow))
+    order = np.argsort(i_inserts, kind="stable")
+    offsets = (np.cumsum(widths) - widths)[i_inserts[order]]
+    pieces = []
+    prev = 0
+    for offset, i in zip(offsets.tolist(), order.tolist()):
+        pieces.append(text[prev:offset])
+        pieces.append(inserts[i])
+        prev = offset
+    pieces.append(text[prev:])
+    return b"".join(pieces)
+
+
+def WriteDistanceMatrix(m, names, outFN, max_og=None, q_zero_diagonal=False, q_sliver_all=False):
+    """
+    Write a distance matrix in PHYLIP format
+    Args:
+        m - nSeq x nSeq array, or an iterable of its rows (which are then only read a block at a time)
+        names - list of the names for the rows
+        outFN - output filename
+        max_og, q_zero_diagonal, q_sliver_all - see PrepareValues
+    """
+    n = len(names)
+    rows = iter(m)
+    with open(outFN, 'wb') as outfile:
+        outfile.write(("%d\n" % n).encode())
+        for iFirstRow in range(0, n, nRowsPerChunk):
+            V = np.array(list(itertools.islice(rows, nRowsPerChunk)), dtype=np.float64).reshape((-1, n))
+            V = PrepareValues(V, iFirstRow, max_og, q_zero_diagonal, q_sliver_all)
+            prefixes = [name + " " for name in names[iFirstRow:iFirstRow + len(V)]]
+            outfile.write(FormatRows(V, prefixes))
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 David Emms
+#
+# This program (OrthoFinder) is distributed under the terms of the GNU General Public License v3
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  When publishing work that uses OrthoFinder please cite:
+#      Emms, D.M. and Kelly, S. (2015) OrthoFinder: solving fundamental biases in whole genome comparisons dramatically
+#      improves orthogroup inference accuracy, Genome Biology 16:157
+#
+# For any enquiries send an email to David Emms
+# david_emms@hotmail.com
+"""
+In-process Markov clustering
+-------------------------------------------------------------------------------
+An alternative to running the mcl binary on the graph file. It follows mcl's
+defaults: loops weighted by each node's maximum edge weight, the main
+inflation only, and resource scheme 6 for pruning.
+
+mcl reads each line of the graph file as a column of a column-stochastic
+matrix. Here the same matrix is held transposed, i.e. each row of the CSR
+matrix is the outgoing flow of a node, so the rows are the graph file lines.
+"""
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+# Resource scheme 6, the default in mcl 14-137
+nPrune = 10000          # -P, entries below 1/P are removed after expansion
+nSelect = 1100          # -S, maximum number of entries kept for a node
+nRecover = 1400         # -R, maximum number of entries kept when recovering mass
+pctRecover = 0.9        # -pct, pruning must keep this fraction of the mass or entries are recovered
+
+chaosLimit = 1e-4       # the process has converged once the chaos is below this
+nIterationsMax = 10000  # -L
+
+# Number of rows expanded by a thread at a time
+nRowsPerBlock = 2**12
+
+# Connected components are clustered together in batches of at least this many nodes
+nNodesPerBatch = 2**12
+
+
+def AddLoops(W):
+    """
+    Args:
+        W - square matrix of edge weights
+    Returns:
+        CSR matrix with self-loops weighted by the maximum edge weight of the node (or 1 for a node with no edges)
+    """
+    W = W.tocoo()
+    q_edge = W.row != W.col
+    row, col, data = W.row[q_edge], W.col[q_edge], W.data[q_edge]
+    loops = np.zeros(W.shape[0])
+    np.maximum.at(loops, row, data)
+    loops[loops <= 0] = 1.0
+    diag = np.arange(W.shape[0])
+    return sparse.csr_matrix(
+        (np.concatenate((data, loops)), (np.concatenate((row, diag)), np.concatenate((col, diag)))),
+        shape=W.shape
+    )
+
+
+def NormaliseRows(A):
+    """
+    Scale each row of the CSR matrix A, in place, to sum to 1
+    """
+    totals = np.asarray(A.sum(axis=1)).ravel()
+    A.data /= np.repeat(totals, np.diff(A.indptr))
+
+
+def Prune(C):
+    """
+    Prune the rows of the expanded matrix as mcl does: remove entries below 1/P,
+    select the S largest, then recover the largest entries (up to R) if less than
+    pct of the mass remains.
+    Args:
+        C - CSR matrix with canonical indices
+    Returns:
+        C_pruned - CSR matrix
+    """
+    n = C.shape[0]
+    rows = np.repeat(np.arange(n), np.diff(C.indptr))
+    q_keep = C.data >= 1.0 / nPrune
+    n_above = np.bincount(rows[q_keep], minlength=n)
+    mass_above = np.bincount(rows[q_keep], weights=C.data[q_keep], minlength=n)
+    mass = np.bincount(rows, weights=C.data, minlength=n)
+    # Only rows needing selection or recovery have their entries ranked
+    q_rank = (n_above > nSelect) | (mass_above < pctRecover * mass)
+    if q_rank.any():
+        i_entries = np.flatnonzero(q_rank[rows])
+        r = rows[i_entries]
+        order = np.lexsort((-C.data[i_entries], r))
+        r = r[order]
+        d = C.data[i_entries[order]]
+        i = np.arange(len(r))
+        q_first = np.ones(len(r), dtype=bool)
+        q_first[1:] = r[1:] != r[:-1]
+        i_first = np.maximum.accumulate(np.where(q_first, i, 0))
+        rank = i - i_first
+        # number of the largest entries needed to retain pct of the mass
+        cumulative_before = np.cumsum(d) - d
+        cumulative_before -= cumulative_before[i_first]
+        n_needed = np.bincount(r[cumulative_before < pctRecover * mass[r]], minlength=n)
+        n_keep = np.maximum(np.minimum(n_above, nSelect), np.minimum(n_needed, nRecover))
+        q_keep[i_entries[order]] = rank < n_keep[r]
+    indptr = np.zeros(n + 1, dtype=C.indptr.dtype)
+    np.cumsum(np.bincount(rows[q_keep], minlength=n), out=indptr[1:])
+    return sparse.csr_matrix((C.data[q_keep], C.indices[q_keep], indptr), shape=C.shape)
+
+
+def Expand(A, pool):
+    """
+    Square the matrix, pruning each block of rows as it is computed
+    Args:
+        A - row-stochastic CSR matrix
+        pool - ThreadPoolExecutor used for the block products
+    """
+    n = A.shape[0]
+    bounds = list(range(0, n, nRowsPerBlock)) + [n]
+
+    def ExpandBlock(iBlock):
+        C = A[bounds[iBlock]:bounds[iBlock + 1]] @ A
+        C.sum_duplicates()
+        return Prune(C)
+
+    blocks = list(pool.map(ExpandBlock, range(len(bounds) - 1)))
+    return sparse.vstack(blocks, format="csr")
+
+
+def Inflate(A, inflation):
+    """
+    Raise the entries of A to the power of the inflation parameter, in place, and renormalise
+    Returns:
+        chaos - measure of how far A is from the converged state, zero once each row is homogeneous
+    """
+    A.data **= inflation
+    NormaliseRows(A)
+    starts = A.indptr[:-1]
+    maxes = np.maximum.reduceat(A.data, starts)
+    sum_sq = np.add.reduceat(A.data * A.data, starts)
+    return np.max(maxes / sum_sq) - 1.0
+
+
+def Interpret(A):
+    """
+    Interpret the converged matrix as clusters. The attractors (nodes with a loop)
+    are grouped into attractor systems, then each node joins the system it sends
+    the most flow to.
+    Args:
+        A - converged row-stochastic CSR matrix
+    Returns:
+        labels - array of the cluster index for each node
+    """
+    n = A.shape[0]
+    q_attractor = A.diagonal() > 0
+    C = A.tocoo()
+    q = q_attractor[C.col]
+    row, col, data = C.row[q], C.col[q], C.data[q]
+    q_both = q_attractor[row]
+    links = sparse.csr_matrix((np.ones(np.count_nonzero(q_both)), (row[q_both], col[q_both])), shape=(n, n))
+    nSystems, system = csgraph.connected_components(links, directed=True, connection="weak")
+    flow = sparse.csr_matrix((data, (row, system[col])), shape=(n, nSystems))
+    labels = np.asarray(flow.argmax(axis=1)).ravel()
+    # A node with no attractor stays on its own
+    q_alone = np.diff(flow.indptr) == 0
+    labels[q_alone] = nSystems + np.arange(np.count_nonzero(q_alone))
+    return labels
+
+
+def Clusters(labels):
+    """
+    Args:
+        labels - array of the cluster index for each node
+    Returns:
+        clusters - list of sorted arrays of node indices, ordered by decreasing size and then by first node
+    """
+    order = np.argsort(labels, kind="stable")
+    _, starts, sizes = np.unique(labels[order], return_index=True, return_counts=True)
+    i_clusters = np.lexsort((order[starts], -sizes))
+    return [order[starts[i]:starts[i] + sizes[i]] for i in i_clusters]
+
+
+def MarkovCluster(W, inflation, nThreads=1):
+    """
+    Args:
+        W - square sparse matrix of edge weights
+        inflation - MCL inflation parameter
+        nThreads - number of threads used for the expansion
+    Returns:
+        labels - array of the cluster index for each node
+    """
+    A = AddLoops(W)
+    NormaliseRows(A)
+    with ThreadPoolExecutor(max_workers=nThreads) as pool:
+        for _ in range(nIterationsMax):
+            A = Expand(A, pool)
+            chaos = Inflate(A, inflation)
+            if chaos < chaosLimit:
+                break
+    return Interpret(A)
+
+
+def Worker_MarkovCluster(args):
+    nodes, W, inflation = args
+    return nodes, MarkovCluster(W, inflation)
+
+
+def GetSubgraphs(W, components, inflation):
+    for nodes in components:
+        yield nodes, W[nodes][:, nodes], inflation
+
+
+def GetComponentBatches(components):
+    """
+    Components of one or two nodes are clusters already, the others are 
+    gathered into batches to be clustered, largest first.
+    Args:
+        components - array of the connected component of each node of the graph
+    Returns:
+        labels - array of the cluster index for each node in a component of one or two nodes
+        nLabels - number of clusters labelled
+        batches - list of sorted arrays of the node indices of each batch of larger components
+    """
+    n = len(components)
+    order = np.argsort(components, kind="stable")
+    _, starts, sizes = np.unique(components[order], return_index=True, return_counts=True)
+    labels = np.empty(n, dtype=np.int64)
+    # Singletons and pairs don't need to be clustered
+    q_small = sizes <= 2
+    labels[order] = np.repeat(np.cumsum(q_small) - 1, sizes)
+    nLabels = np.count_nonzero(q_small)
+    batches = []
+    batch = []
+    nNodes = 0
+    i_large = np.flatnonzero(~q_small)
+    for i in i_large[np.argsort(-sizes[i_large], kind="stable")]:
+        batch.append(order[starts[i]:starts[i] + sizes[i]])
+        nNodes += sizes[i]
+        if nNodes >= nNodesPerBatch:
+            batches.append(np.sort(np.concatenate(batch)))
+            batch = []
+            nNodes = 0
+    if batch:
+        batches.append(np.sort(np.concatenate(batch)))
+    return labels, nLabels, batches
+
+
+def RunMCL(W, inflation, nProcesses=1):
+    """
+    Cluster a graph by Markov clustering. The graph is first split into its
+    connected components, which can be clustered independently. Components
+    of one or two nodes are clusters already, smaller components are clustered
+    together in batches. The first batch, with the largest component, is 
+    clustered using all the threads and the rest are then shared between the 
+    processes.
+    Args:
+        W - square sparse matrix, row i holds the weights of the edges of node i as
+            written to the graph file
+        inflation - MCL inflation parameter
+        nProcesses - number of processes (or threads for the first batch)
+    Returns:
+        clusters - list of sorted arrays of node indices, ordered by decreasing size
+    """
+    W = W.tocsr(copy=True)
+    W.eliminate_zeros()
+    _, components = csgraph.connected_components(W, directed=True, connection="weak")
+    labels, nLabels, batches = GetComponentBatches(components)
+    results = [(nodes, MarkovCluster(W_sub, inflation, nProcesses)) for nodes, W_sub, _ in GetSubgraphs(W, batches[:1], inflation)]
+    subgraphs = GetSubgraphs(W, batches[1:], inflation)
+    if len(batches) <= 2 or nProcesses == 1:
+        results.extend((nodes, MarkovCluster(W_sub, inflation, nProcesses)) for nodes, W_sub, _ in subgraphs)
+    else:
+        with mp.Pool(min(nProcesses, len(batches) - 1)) as pool:
+            results.extend(pool.imap_unordered(Worker_MarkovCluster, subgraphs))
+    for nodes, batch_labels in results:
+        labels[nodes] = nLabels + batch_labels
+        nLabels += batch_labels.max() + 1
+    return Clusters(labels)
@@ -34,7 +34,7 @@ try:
 except ImportError:
     ...
 
-from . import tree, newick
+from . import tree, newick, phylip
 from ..utils import util, parallel_task_manager
 from . import consensus_tree as cons
 
@@ -72,19 +72,10 @@ def CheckFastME(workingDir):
 
 def WritePhylipMatrix(m, names, outFN, max_og=1e6):
     """
-    m - list of mp.Array  (so that each represents an nSeq x nSeq matrix
+    m - nSeq x nSeq array
     """
-    sliver = 1e-6
-    with open(outFN, 'w') as outfile:
-        n = len(m)
-        outfile.write("%d\n" % n)
-        for i in range(n):
-            outfile.write(names[i] + " ")
-            # values could be -inf, these are the most distantly related so replace with max_og
-            V = [0. + (m[i][j] if m[i][j] > -9e99 else max_og) for j in range(n)] # "0. +": hack to avoid printing out "-0"
-            V = [sliver if v < sliver  else v for v in V]  # make sure scientific notation is not used (not accepted by fastme)
-            values = " ".join(["%.6f" % v for v in V])   
-            outfile.write(values + "\n")
+    # values could be -inf, these are the most distantly related so replace with max_og
+    phylip.WriteDistanceMatrix(m, names, outFN, max_og=max_og, q_sliver_all=True)
 
 class UnrecognisedGene(Exception):
     pass
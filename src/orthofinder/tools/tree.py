@@ -136,6 +136,12 @@ class TreeNode(object):
         t3 = Tree('/home/user/myNewickFile.txt')
     """
 
+    # (q_current, dict from name to nodes in levelorder), see enable_name_index
+    _name_index = None
+    # True once the node has been in a tree with a name index. Edits to other
+    # nodes can't make an index out of date, so they don't walk up the tree
+    _q_name_indexed = False
+
     def _get_dist(self):
         return self._dist
     def _set_dist(self, value):
@@ -156,6 +162,10 @@ class TreeNode(object):
         return self._up
     def _set_up(self, value):
         if type(value) == type(self) or value is None:
+            if self._q_name_indexed:
+                self._invalidate_name_index()
+            if value is not None and value._q_name_indexed:
+                value._invalidate_name_index()
             self._up = value
         else:
             raise ValueError("bad node_up type")
@@ -165,6 +175,8 @@ class TreeNode(object):
     def _set_children(self, value):
         if type(value) == list and \
            len(set([type(n)==type(self) for n in value]))<2:
+            if self._q_name_indexed:
+                self._invalidate_name_index()
             self._children = value
         else:
             raise ValueError("bad children type")
@@ -238,6 +250,11 @@ class TreeNode(object):
         """ This allows to execute tree&'A' to obtain the descendant node
         whose name is A"""
         value=str(value)
+        matches = self._search_name_index(value)
+        if matches is not None:
+            if matches:
+                return matches[0]
+            raise ValueError("Node not found")
         try:
             first_match = next(self.iter_search_nodes(name=value))
             return first_match
@@ -276,6 +293,75 @@ class TreeNode(object):
         """ Iterator over leaf nodes"""
         return self.iter_leaves()
 
+    def enable_name_index(self):
+        """
+        Keeps an index from node names to nodes on this node, which should
+        be the root of the tree. Looking up nodes by name anywhere in the
+        tree (tree & name, get_common_ancestor, set_outgroup, prune) then
+        uses the index instead of traversing the tree.
+
+        The index is built when it is first used. It is rebuilt after any
+        change to the structure of a tree (e.g. by set_outgroup, prune,
+        detach or delete). Renaming a node does not rebuild it: a renamed
+        node is no longer found by its old name and the index is rebuilt
+        if a name is not found, which is exact as long as the names in the
+        tree are unique. With duplicated names, a node renamed to the name
+        of another node may not be found.
+        """
+        self._name_index = (False, {})
+        self._q_name_indexed = True
+
+    def _build_name_index(self):
+        name2nodes = {}
+        for n in self.traverse():
+            n._q_name_indexed = True
+            name2nodes.setdefault(n.name, []).append(n)
+        self._name_index = (True, name2nodes)
+        return name2nodes
+
+    def _invalidate_name_index(self):
+        """
+        Marks the name indexes of this node and the nodes above it as out of
+        date, after a change to the structure of the tree below this node.
+        Only needed if _q_name_indexed: a node that hasn't been in an indexed
+        tree can only be below an index that is already out of date.
+        """
+        n = self
+        while n is not None:
+            if n._name_index is not None:
+                n._name_index = (False, {})
+            n = n._up
+
+    def _search_name_index(self, name):
+        """
+        Returns the list of nodes below (and including) this node that have
+        the given name, in levelorder, or None if the tree has no name index.
+        """
+        root = self
+        while root._up is not None:
+            root = root._up
+        if root._name_index is None:
+            return None
+        q_current, name2nodes = root._name_index
+        q_rebuilt = not q_current
+        if q_rebuilt:
+            name2nodes = root._build_name_index()
+        while True:
+            matches = [n for n in name2nodes.get(name, []) if n.name == name]
+            if self is not root:
+                matches = [n for n in matches if self in n._iter_path_to_root()]
+            if matches or q_rebuilt:
+                return matches
+            # a node may have been renamed since the index was built
+            name2nodes = root._build_name_index()
+            q_rebuilt = True
+
+    def _iter_path_to_root(self):
+        n = self
+        while n is not None:
+            yield n
+            n = n._up
+
     def add_feature(self, pr_name, pr_value):
         """ 
         Add or update a node's feature. 
@@ -518,6 +604,8 @@ class TreeNode(object):
         Swaps current children order.
         """
         if len(self.children)>1:
+            if self._q_name_indexed:
+                self._invalidate_name_index()
             self.children.reverse()
 
     # def prune_OLD(self, nodes):
@@ -1827,12 +1915,23 @@ class TreeNode(object):
 
 def _translate_nodes(root, *nodes):
     name2node = dict([ [n, None] for n in nodes if type(n) is str])
-    for n in root.traverse():
-        if n.name in name2node:
-            if name2node[n.name] is not None:
-                raise ValueError("Ambiguous node name: "+str(n.name))
-            else:
-                name2node[n.name] = n
+    q_indexed = False
+    for name in name2node:
+        matches = root._search_name_index(name)
+        if matches is None:
+            break
+        q_indexed = True
+        if len(matches) > 1:
+            raise ValueError("Ambiguous node name: "+str(name))
+        elif matches:
+            name2node[name] = matches[0]
+    if name2node and not q_indexed:
+        for n in root.traverse():
+            if n.name in name2node:
+                if name2node[n.name] is not None:
+                    raise ValueError("Ambiguous node name: "+str(n.name))
+                else:
+                    name2node[n.name] = n
 
     if None in name2node.values():
         notfound = [key for key, value in name2node.items() if value is None]
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 David Emms
+#
+# This program (OrthoFinder) is distributed under the terms of the GNU General Public License v3
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  When publishing work that uses OrthoFinder please cite:
+#      Emms, D.M. and Kelly, S. (2015) OrthoFinder: solving fundamental biases in whole genome comparisons dramatically
+#      improves orthogroup inference accuracy, Genome Biology 16:157
+#
+# For any enquiries send an email to David Emms
+# david_emms@hotmail.com
+"""
+Most recent common ancestors in a fixed tree
+-------------------------------------------------------------------------------
+The tree is stored as an Euler tour, the sequence of nodes visited by a
+depth-first traversal, with a sparse table giving the shallowest node in any
+range of the tour whose length is a power of two. The MRCA of a set of nodes is
+the shallowest node in the tour between the first and the last of them to be
+visited, so it is found in O(k) for k nodes after O(n log n) preprocessing.
+"""
+import numpy as np
+
+
+class TreeLCA(object):
+    """
+    MRCA and ancestor queries by node name on a rooted tree, e.g. the species
+    tree. The tree must not be modified after the TreeLCA is created.
+    """
+    def __init__(self, t):
+        """
+        Args:
+            t - rooted tools/tree.TreeNode with unique node names
+        """
+        self.nodes = list(t.traverse("preorder"))
+        n = len(self.nodes)
+        index = {node: i for i, node in enumerate(self.nodes)}
+        self.name_to_index = {node.name: i for i, node in enumerate(self.nodes)}
+        children = [[index[ch] for ch in node.children] for node in self.nodes]
+        self.parent = np.full(n, -1, dtype=np.int32)
+        for i, ch in enumerate(children):
+            self.parent[ch] = i
+        # the descendants of node i are nodes i+1 to i+size[i]-1 in preorder
+        self.size = np.ones(n, dtype=np.int32)
+        for i in range(n - 1, 0, -1):
+            self.size[self.parent[i]] += self.size[i]
+        self.depth = np.zeros(n, dtype=np.int32)
+        for i in range(1, n):
+            self.depth[i] = self.depth[self.parent[i]] + 1
+        # Euler tour: each node is visited on entry and after each of its children
+        tour = []
+        first = [0] * n
+        stack = [(0, 0)]
+        while stack:
+            i, k = stack.pop()
+            if k == 0:
+                first[i] = len(tour)
+            tour.append(i)
+            if k < len(children[i]):
+                stack.append((i, k + 1))
+                stack.append((children[i][k], 0))
+        self.tour = np.array(tour, dtype=np.int32)
+        self.first = first
+        # sparse[j][p] is the shallowest node in tour[p:p + 2**j]
+        tour_depth = self.depth[self.tour]
+        self.sparse = [self.tour]
+        j = 1
+        while (1 << j) <= len(tour):
+            prev = self.sparse[-1]
+            half = 1 << (j - 1)
+            left = prev[:-half]
+            right = prev[half:]
+            self.sparse.append(np.where(self.depth[left] <= self.depth[right], left, right))
+            j += 1
+        self.sparse = [s.tolist() for s in self.sparse]
+        self.depth_list = self.depth.tolist()
+
+    def Index(self, name):
+        try:
+            return self.name_to_index[name]
+        except KeyError:
+            raise ValueError("Node names not found: " + str([name]))
+
+    def Node(self, name):
+        """
+        Returns:
+            node - the tree node with this name
+        """
+        return self.nodes[self.Index(name)]
+
+    def MRCA(self, names):
+        """
+        Args:
+            names - iterable of node names
+        Returns:
+            node - the most recent common ancestor of the named nodes, the node itself if there is only one
+        """
+        first = self.first
+        positions = [first[self.Index(name)] for name in names]
+        if not positions:
+            raise ValueError("No nodes given")
+        l = min(positions)
+        r = max(positions)
+        j = (r - l + 1).bit_length() - 1
+        a = self.sparse[j][l]
+        b = self.sparse[j][r - (1 << j) + 1]
+        return self.nodes[a if self.depth_list[a] <= self.depth_list[b] else b]
+
+    def IsAncestor(self, name_above, name_below):
+        """
+        Returns:
+            q_ancestor - True if the first node is on the path from the second to the root (excluding the second node)
+        """
+        i = self.Index(name_above)
+        j = self.Index(name_below)
+        return i < j < i + self.size[i]
+
+    def Ancestors(self, name):
+        """
+        Returns:
+            names - the names of the ancestors of the node, closest first
+        """
+        ancestors = []
+        i = self.parent[self.Index(name)]
+        while i != -1:
+            ancestors.append(self.nodes[i].name)
+            i = self.parent[i]
+        return ancestors
+
+    def Descendants(self, name):
+        """
+        Returns:
+            names - the names of the descendants of the node, in preorder
+        """
+        i = self.Index(name)
+        return [node.name for node in self.nodes[i + 1:i + self.size[i]]]
+
+    def ComparableNodes(self):
+        """
+        Node NX < NY if NX is on the path between NY and the root.
+        If a node is not <, =, > another then they are incomparable
+        Returns:
+            comp_nodes - dict:NX -> ( {n|n<NX}, {n|n>NX}, {n|n<NX or n=NX or n>NX} ) i.e. (higher_nodes, lower_nodes, comparable)
+        """
+        comp_nodes = dict()
+        for node in self.nodes:
+            above = set(self.Ancestors(node.name))
+            below = set(self.Descendants(node.name))
+            comp_nodes[node.name] = (above, below, above.union(below, [node.name]))
+        return comp_nodes
@@ -34,7 +34,7 @@ import os
 import glob
 import copy
 import numpy as np
-from collections import Counter, defaultdict
+from collections import Counter
 try:
     from rich import print
 except ImportError:
@@ -192,83 +192,97 @@ def DetermineOrthogroupsForSpeciesTree(m, iogs4, nOGsMin=100, nSufficient=1000,
     ogsToUse = [iogs4[i_] for i_ in ogsToUse]
     return ogsToUse, f   
 
-class MSA(object):
-    def __init__(self, msa_dict):
-        self.seqs = msa_dict
-        self.length = len(list(msa_dict.values())[0])
-
-def ReadAlignment(fn):
-    msa = dict()
-    accession = None
-    length = None
-    seq = ""
-    with open(fn, 'r') as infile:
-        for line in infile:
-            line = line.rstrip()
-            if line.startswith(">"):
-                if accession != None:
-                    if length != None and len(seq) != length:
-                        text  = "ERROR: Sequence length mismatch in MSA: %s & %d" % (length, len(seq))
-                        files.FileHandler.LogFailAndExit(text)
-                    msa[accession] = seq
-                accession = line[1:]
-                seq = ""
-            else:
-                seq += line
-        if accession != None:
-            if length != None and len(seq) != length:
-                text = "Error: Sequence length mismatch in MSA: %s & %d" % (length, len(seq))
-                files.FileHandler.LogFailAndExit(text)
-            msa[accession] = seq
-    return MSA(msa)
+def GetConcatenatedAlignmentRows(msa, ogs_iOg):
+    """
+    Args:
+        msa - trim.MSA of the orthogroup alignment
+        ogs_iOg - the genes in the orthogroup
+    Returns:
+        rows - dict: species -> index of its sequence in the alignment, for the species with a single gene in
+               the orthogroup, in the order they appear in the alignment
+    """
+    speciesCounts = Counter([gene.iSp for gene in ogs_iOg])
+    selectedSeqs = {gene.ToString() for gene in ogs_iOg if speciesCounts[gene.iSp] == 1}
+    rows = dict()
+    for k, name in enumerate(msa.names):
+        if name.split()[0] in selectedSeqs:
+            rows[name.split("_")[0]] = k   # this allows for the MSA method to have failed to put the sequence in the MSA
+    return rows
 
 def CreateConcatenatedAlignment(ogsToUse_ids, ogs, alignment_filename_function, output_filename, fSingleCopy, fMaxGap=0.5):
+    """
+    Write the concatenated alignment of the single-copy genes in the orthogroups, with a row of gaps for each 
+    species missing from an orthogroup, keeping the columns with at most (1 - fMaxGap*fSingleCopy) gaps.
+    Each column's gaps are known from its own orthogroup so the kept columns are found one alignment at a time. 
+    The alignments are then read again and their kept columns copied into a byte matrix in a temporary file,
+    which is written out one species at a time.
+    """
     allSpecies = {str(gene.iSp) for og in ogs for gene in og}
-    concatentaedAlignments = defaultdict(str)
+    # Trim the completed alignment: to 50% of fraction of species present
+    maxGap = (1.-fMaxGap*fSingleCopy)*len(allSpecies)
+    names = None
+    used = []       # (iOg, rows, i_keep) for each alignment in the concatenated alignment
+    length = 0
     for iOg in ogsToUse_ids:
-        try:
-            speciesCounts = Counter([gene.iSp for gene in ogs[iOg]])
-            selectedSeqs = {gene.ToString() for gene in ogs[iOg] if speciesCounts[gene.iSp] == 1}
-            alignment = ReadAlignment(alignment_filename_function(iOg))
-            speciesInThisOg = set()
-            for name, al in alignment.seqs.items():
-                if name.split()[0] in selectedSeqs:
-                    iSp = name.split("_")[0]
-                    speciesInThisOg.add(iSp)  # this allows for the MSA method to have failed to put the sequence in the MSA
-                    al = al.replace('*', '-')
-                    concatentaedAlignments[iSp] += al
-            # now put blanks for the missing species
-            for iSp in allSpecies.difference(speciesInThisOg):
-                concatentaedAlignments[iSp] += "-"*(alignment.length)
-        except IndexError:
+        msa = trim.MSA(alignment_filename_function(iOg))
+        if msa.n == 0:
             # allow empty MSA (could fail for unknown reason)
             print("WARNING: An MSA failed for an unknown reason: %s" % alignment_filename_function(iOg))
             print("No tree or orthologs will be inferred for this orthogroup. To correct the issue, identify & correct the problematic gene sequence and rerun.")
-            pass
-    # Trim the completed alignment: to 50% of fraction of species present
-    maxGap = (1.-fMaxGap*fSingleCopy)*len(allSpecies)
-    # vectorise this as the for-loop method took too long (45mins on 3M length alignment vs 1.5s)
-    # The write method doesn't require further optimisation. Took 0.15s on the same alignment
-    if len(concatentaedAlignments) == 0 or len(list(concatentaedAlignments.values())[0]) == 0:
-        print("All MSAs for the concatenated multiple sequence alignment were empty.")
-        print("Please correct the error and re-run.")
-        util.Fail()
-    names = list(concatentaedAlignments.keys())
-    M = np.array([list(concatentaedAlignments[name]) for name in names])
-    gap_counts = sum(M == "-")
-    i_keep = np.where(gap_counts <= maxGap)
-    M = M[:, i_keep]
+            continue
+        rows = GetConcatenatedAlignmentRows(msa, ogs[iOg])
+        if names is None:
+            # species order is that of the first alignment, followed by those missing from it
+            names = list(rows) + list(allSpecies.difference(rows))
+        gap_counts = (len(names) - len(rows)) + (msa.X[list(rows.values())] == trim.gap).sum(axis=0)
+        i_keep = np.flatnonzero(gap_counts <= maxGap)
+        used.append((iOg, rows, i_keep))
+        length += msa.length
+    if names is None or length == 0:
+        raise ValueError("All MSAs for the concatenated multiple sequence alignment were empty.")
+    row_index = {name: i for i, name in enumerate(names)}
+    nKeep = sum(i_keep.size for _, _, i_keep in used)
+    temp_fn = output_filename + ".tmp"
+    M = np.memmap(temp_fn, dtype=np.uint8, mode="w+", shape=(len(names), nKeep)) if nKeep > 0 else np.zeros((len(names), 0), dtype=np.uint8)
+    M[:] = trim.gap
+    start = 0
+    for iOg, rows, i_keep in used:
+        msa = trim.MSA(alignment_filename_function(iOg))
+        end = start + i_keep.size
+        M[[row_index[iSp] for iSp in rows], start:end] = msa.X[list(rows.values())][:, i_keep]
+        start = end
     nChar = 80
-    with open(output_filename, 'w') as outfile:
+    with open(output_filename, 'wb') as outfile:
         for iSeq, name in enumerate(names):
-            outfile.write(">%s\n" % name)
-            seq = M[iSeq,:].tolist()[0]
-            for i in range(0, len(seq), nChar):
-                outfile.write("".join(seq[i:i+nChar]) + "\n")
+            outfile.write(b">%s\n" % name.encode())
+            seq = M[iSeq].tobytes()
+            outfile.write(b"".join(seq[i:i+nChar] + b"\n" for i in range(0, len(seq), nChar)))
+    del M
+    if os.path.exists(temp_fn):
+        os.remove(temp_fn)
             
 def trim_fn(fn):
     trim.main(fn, fn, 0.1, 500, 0.75, False)
 
+def ConcatenatedAlignmentTask(args):
+    """
+    Create the concatenated alignment for the species tree and record the orthogroups used. A python
+    function step in the lists of commands run by RunParallelCommandsAndMoveResultsFile
+    Args:
+        args - (iOgsForSpeciesTree, ogs, alignment_filename_function, output_filename, fSingleCopy)
+    Raises:
+        pc.StepFailedException - if the alignment couldn't be created, the species tree can't be inferred
+    """
+    iOgsForSpeciesTree, ogs, alignment_filename_function, output_filename, fSingleCopy = args
+    try:
+        CreateConcatenatedAlignment(iOgsForSpeciesTree, ogs, alignment_filename_function, output_filename, fSingleCopy)
+    except Exception as e:
+        raise pc.StepFailedException("Could not create the concatenated alignment for the species tree. %s Please correct the error and re-run." % e)
+    # write OGs used to file
+    dSpeciesTree = os.path.split(files.FileHandler.GetSpeciesTreeResultsFN(0, True))[0] + "/"
+    with open(dSpeciesTree + "Orthogroups_for_concatenated_alignment.txt", 'w') as outfile:
+        for iog in iOgsForSpeciesTree: outfile.write("OG%07d\n" % iog)
+
 """ 
 -----------------------------------------------------------------------------
                              TreesForOrthogroups            
@@ -421,17 +435,11 @@ class TreesForOrthogroups(object):
                 old_version=old_version
             )
             if qDoSpeciesTree:
-                CreateConcatenatedAlignment(
-                    iOgsForSpeciesTree, 
-                    ogs, 
-                    self.GetAlignmentFilename, 
-                    concatenated_algn_fn, 
-                    fSingleCopy
-                )
-                # write OGs used to file
-                dSpeciesTree = os.path.split(files.FileHandler.GetSpeciesTreeResultsFN(0, True))[0] + "/"
-                with open(dSpeciesTree + "Orthogroups_for_concatenated_alignment.txt", 'w') as outfile:
-                    for iog in iOgsForSpeciesTree: outfile.write("OG%07d\n" % iog)
+                try:
+                    ConcatenatedAlignmentTask((iOgsForSpeciesTree, ogs, self.GetAlignmentFilename, concatenated_algn_fn, fSingleCopy))
+                except pc.StepFailedException as e:
+                    print("ERROR: %s" % e)
+                    util.Fail()
             
             # ------------------ this section is not needed at this stage for the new procedure -------------
             # ids -> accessions
@@ -461,95 +469,56 @@ class TreesForOrthogroups(object):
 
         treeCommands_and_filenames = copy.deepcopy(orig_treeCommands_and_filenames)
         iogs_tree = copy.deepcopy(orig_iogs_tree)
-        commands_and_filenames = []
-        tree_tasksize = None
         if qDoSpeciesTree:
             print(("Species tree: Using %d orthogroups with minimum of %0.1f%% of species having single-copy genes in any orthogroup" % (len(iOgsForSpeciesTree), 100.*fSingleCopy)))
-            util.PrintUnderline("Inferring multiple sequence alignments for species tree") 
-            # util.PrintTime("This may take some time...")
-            # Do required alignments and trees
+            util.PrintUnderline("Inferring multiple sequence alignments, gene trees and species tree")
             speciesTreeFN_ids = files.FileHandler.GetSpeciesTreeUnrootedFN()
-            orig_commands_and_filenames = []
-            if qTrim:
-                for i in iOgsForSpeciesTree:
-                    orig_commands_and_filenames.append([alignCommands_and_filenames[i], 
-                                                (trim_fn, alignmentFilesToUse[i]), 
-                                                treeCommands_and_filenames[i]])
-            else:
-                for i in iOgsForSpeciesTree:
-                    orig_commands_and_filenames.append([alignCommands_and_filenames[i],
-                                                   treeCommands_and_filenames[i]])
-            commands_and_filenames = copy.deepcopy(orig_commands_and_filenames)        
-            if cmd_order == "ascending":
-                # tree_tasksize = [len(og) for og in tree_filtered_ogs[::-1]]
-                orig_commands_and_filenames = orig_commands_and_filenames[::-1]
-                tree_tasksize = [
-                        os.stat(item).st_size
-                        for cmd in orig_commands_and_filenames
-                        for item in cmd[0][0].split() if os.path.isfile(item) and os.path.exists(item)
-                    ]
-
-            pc.RunParallelCommandsAndMoveResultsFile(
-                nProcesses, 
-                orig_commands_and_filenames, 
-                True, 
-                tasksize=tree_tasksize,
-                method_threads=method_threads,
-                method_threads_large=method_threads_large,
-                method_threads_small=method_threads_small, 
-                threshold=threshold,
-                cmd_order=cmd_order,
-                qTrim=qTrim,
-                q_print_on_error=print_on_error,
-                old_version=old_version
-            )
-            CreateConcatenatedAlignment(iOgsForSpeciesTree, ogs, self.GetAlignmentFilename, concatenated_algn_fn, fSingleCopy)
-            # write OGs used to file
-            dSpeciesTree = os.path.split(files.FileHandler.GetSpeciesTreeResultsFN(0, True))[0] + "/"
-            with open(dSpeciesTree + "Orthogroups_for_concatenated_alignment.txt", 'w') as outfile:
-                for iog in iOgsForSpeciesTree: outfile.write("OG%07d\n" % iog)
-            # Add species tree to list of commands to run
-            commands_and_filenames = [
-                self.program_caller.GetTreeCommands(
-                        self.tree_program, 
-                        [concatenated_algn_fn], 
-                        [speciesTreeFN_ids], 
-                        ["SpeciesTree"],
-                        method_threads=method_threads 
-                    )
-                ]
-            util.PrintUnderline("Inferring remaining multiple sequence alignments and gene trees") 
         else:
             util.PrintUnderline("Inferring multiple sequence alignments and gene trees")
         # util.PrintTime("This may take some time...")
-        # Now continue as before
-        iOgsForSpeciesTree = set(iOgsForSpeciesTree)
+        # Each orthogroup is a list of commands: alignment, trimming and tree. The concatenated alignment and
+        # species tree depend on the orthogroups used for the species tree, the other orthogroups don't need
+        # to wait for them. Orthogroups before a restart were already done.
         iog_to_align_index = {iog: index for index, iog in enumerate(iogs_align)}
-        for i, iog in enumerate(iogs_tree):
-            if iog in iOgsForSpeciesTree: continue
-            if qTrim:
-                commands_and_filenames.append([alignCommands_and_filenames[iog_to_align_index[iog]],
-                                              (trim_fn, alignmentFilesToUse[iog_to_align_index[iog]]),
-                                              treeCommands_and_filenames[i]])
+        iog_to_tree_index = {iog: index for index, iog in enumerate(iogs_tree)}
+        iOgsForSpeciesTree_set = set(iOgsForSpeciesTree)
+        iogs_species_tree = [iog for iog in iOgsForSpeciesTree if iog in iog_to_align_index]
+        iogs_remaining = [iog for iog in iogs_tree if iog not in iOgsForSpeciesTree_set] + \
+                         [iog for iog in set(iogs_align).difference(iogs_tree) if iog not in iOgsForSpeciesTree_set]
+        commands_and_filenames = []
+        for iog in iogs_species_tree + iogs_remaining:
+            i_align = iog_to_align_index[iog]
+            if iog not in iog_to_tree_index:
+                commands_and_filenames.append([alignCommands_and_filenames[i_align]])
+            elif qTrim:
+                commands_and_filenames.append([alignCommands_and_filenames[i_align],
+                                              (trim_fn, alignmentFilesToUse[i_align]),
+                                              treeCommands_and_filenames[iog_to_tree_index[iog]]])
             else:
-                commands_and_filenames.append([alignCommands_and_filenames[iog_to_align_index[iog]],
-                                              treeCommands_and_filenames[i]])
-        for iog in set(iogs_align).difference(iogs_tree):
-            if iog in iOgsForSpeciesTree: continue
-            commands_and_filenames.append([alignCommands_and_filenames[iog_to_align_index[iog]]])
-        
+                commands_and_filenames.append([alignCommands_and_filenames[i_align],
+                                              treeCommands_and_filenames[iog_to_tree_index[iog]]])
+        dependencies = [[] for _ in commands_and_filenames]
+        if qDoSpeciesTree:
+            concatenate = (ConcatenatedAlignmentTask, (iOgsForSpeciesTree, ogs, self.GetAlignmentFilename, concatenated_algn_fn, fSingleCopy))
+            species_tree = self.program_caller.GetTreeCommands(
+                self.tree_program, 
+                [concatenated_algn_fn], 
+                [speciesTreeFN_ids], 
+                ["SpeciesTree"],
+                method_threads=method_threads 
+            )
+            nSpeciesTree = len(iogs_species_tree)
+            commands_and_filenames.insert(nSpeciesTree, [concatenate] + species_tree)
+            dependencies.insert(nSpeciesTree, list(range(nSpeciesTree)))
+
         if cmd_order == "ascending":
+            n = len(commands_and_filenames)
             commands_and_filenames = commands_and_filenames[::-1]
-            tree_tasksize = [
-                        os.stat(item).st_size
-                        for cmd in orig_commands_and_filenames
-                        for item in cmd[0][0].split() if os.path.isfile(item) and os.path.exists(item)
-                    ]
+            dependencies = [[n - 1 - j for j in deps] for deps in dependencies[::-1]]
 
         pc.RunParallelCommandsAndMoveResultsFile(nProcesses, 
                                                  commands_and_filenames, 
                                                  True, 
-                                                 tasksize=tree_tasksize,
                                                  method_threads=method_threads,
                                                  method_threads_large=method_threads_large,
                                                  method_threads_small=method_threads_small, 
@@ -557,8 +526,13 @@ class TreesForOrthogroups(object):
                                                  cmd_order=cmd_order,
                                                  qTrim=qTrim,
                                                  q_print_on_error=print_on_error,
-                                                 old_version=old_version
+                                                 old_version=old_version,
+                                                 dependencies=dependencies
                                                  )
+        if qDoSpeciesTree and not os.path.exists(concatenated_algn_fn):
+            # the old_version workers report a failed step as a warning
+            print("ERROR: The concatenated alignment for the species tree was not created: %s" % concatenated_algn_fn)
+            util.Fail()
         
         # # Convert ids to accessions for MSA
         # accessionAlignmentFNs = [self.GetAlignmentFilename(i, True) for i in iogs_align]
@@ -4,66 +4,54 @@ import os
 import sys
 import shutil
 import argparse
-import itertools
 import subprocess
 import numpy as np
-import scipy.sparse
 try:
     from rich import print
 except ImportError:
     ...
 
+gap = ord("-")
+stop = ord("*")
+
+
 class MSA(object):
     def __init__(self, fn):
         self.names = []         # list of names
-        self.non_gap_pos = []   # list of list of non-gaps positions
-        self.non_gaps = []      # list of list of non-gaps 
-        self.n = 0              # number of sequences   
-        self.length = None         # number of columns in MSA
-        current_length = 0
-        with open(fn, 'r') as infile:
-            for line in infile:
-                line = line.rstrip()
-                if line.startswith(">"):
-                    if len(self.names) > 1 and current_length != self.length:
-                        print("Error: sequence %d has length %d, previous was %d" % (len(self.names), current_length, self.length))
-                        sys.exit()
-                    self.length = current_length
-                    current_length = 0   
-                    self.names.append(line[1:])
-                    self.non_gap_pos.append([])
-                    self.non_gaps.append([])
+        self.n = 0              # number of sequences
+        self.length = None      # number of columns in MSA
+        seqs = []
+        with open(fn, 'rb') as infile:
+            text = infile.read()
+        for record in text.split(b"\n>"):
+            if record.startswith(b">"):
+                record = record[1:]
+            header, _, seq = record.partition(b"\n")
+            if not header and not seq:
+                continue
+            self.names.append(header.rstrip().decode())
+            seqs.append(seq.translate(None, b" \t\r\n"))
+        for i, seq in enumerate(seqs[1:], 1):
+            if len(seq) != len(seqs[0]):
+                if i == len(seqs) - 1:
+                    raise ValueError("%s: Last sequence length is %d, previous was %d" % (fn, len(seq), len(seqs[0])))
                 else:
-                    # process this bit of sequence
-                    # the index arithmetic current_length + i works for base 0 indexing
-                    self.non_gap_pos[-1].extend([current_length + i for i,c in enumerate(line) if (c != "*" and c != "-")])
-                    self.non_gaps[-1].extend([c for c in line if (c != "*" and c != "-")])
-                    current_length += len(line)  
+                    raise ValueError("%s: sequence %d has length %d, previous was %d" % (fn, i + 1, len(seq), len(seqs[0])))
+        self.length = len(seqs[0]) if seqs else 0
         self.n = len(self.names)
-        if self.n >= 2 and current_length != self.length:
-            print("Error: Last sequence length is %d, previous was %d" % (current_length, self.length))
-            sys.exit()
-        self.length = current_length   # could just be one sequence in file
-        self.length = 0 if self.length is None else self.length
-        # create a sparse matrix so less of the subsequent analysis code has to change
-        # Quite possibly this is the fastest way to do it too
-        row_ind = [i_seq for i_seq, ngp in enumerate(self.non_gap_pos) for _ in range(len(ngp))]
-        self.n_non_gaps = sum([len(ngp) for ngp in self.non_gap_pos])
-        col_ind = list(itertools.chain.from_iterable(self.non_gap_pos))
-        data = [1 for _ in range(self.n_non_gaps)]
-        self.M = scipy.sparse.csr_matrix((data, (row_ind, col_ind)), shape=(self.n, self.length))
-    
+        # n x length matrix of the characters, "*" is treated as a gap
+        self.X = np.frombuffer(b"".join(seqs), dtype=np.uint8).reshape(self.n, self.length).copy()
+        self.X[self.X == stop] = gap
+        self.aa_counts = (self.X != gap).sum(axis=0)   # per column
+        self.n_non_gaps = int(self.aa_counts.sum())
+
     def write_msa(self, i_cols, outfn, nChar = 80):
-        with open(outfn, 'w') as outfile:
-            for name, posn, chars in zip(self.names, self.non_gap_pos, self.non_gaps):
-                outfile.write(">" + name + "\n")
-                seq = ("-" * posn[0]) + chars[0]
-                for ipos, ipos_m1, c in zip(posn[1:], posn[:-1], chars[1:]):
-                    seq += "-" * (ipos - ipos_m1 - 1) + c
-                seq += "-" * (self.length - posn[-1] -1)
-                seq = "".join([seq[i] for i in i_cols])
-                for i in range(0, len(seq), nChar):
-                    outfile.write(seq[i:i+nChar] + "\n")
+        X = self.X[:, i_cols]
+        with open(outfn, 'wb') as outfile:
+            for name, row in zip(self.names, X):
+                seq = row.tobytes()
+                outfile.write(b">" + name.encode() + b"\n")
+                outfile.write(b"".join(seq[i:i+nChar] + b"\n" for i in range(0, len(seq), nChar)))
 
 def main(infn, outfn, f=0.1, n_min=500, c=0.75, exe=False):
     if exe:
@@ -118,10 +106,9 @@ def run_in_process(infn, outfn, f, n_min, c):
     n = msa.n
     length = msa.length
     maxGap = (1.-f)*n
-    aa_counts = msa.M.sum(axis=0)[0]   # per column
-    aa_counts = np.squeeze(np.asarray(aa_counts))
+    aa_counts = msa.aa_counts
     gap_counts = n- aa_counts
-    aa_before = msa.M.nnz
+    aa_before = msa.n_non_gaps
     i_keep = np.where(gap_counts <= maxGap)
     n_keep = i_keep[0].size     # it's an I, J tuple
     aa_after = sum(aa_counts[i_keep])
@@ -1,12 +1,10 @@
 import os
 import numpy as np
-import subprocess
 from scipy import sparse
 import warnings
 import numpy.core.numeric as numeric
 from scipy.optimize import curve_fit
-import multiprocessing as mp
-from ..utils import util, files, blast_file_processor, matrices
+from ..utils import util, files, blast_file_processor, matrices, parallel_task_manager
 
 try:
     import queue
@@ -32,7 +30,7 @@ class scnorm:
     @staticmethod
     def GetLengthArraysForMatrix(m, len_i, len_j):
         I, J = m.nonzero()
-        scores = [v for row in m.data for v in row]  # use fact that it's lil
+        scores = m.data[m.data != 0].tolist()  # use fact that it's csr with sorted indices
         Li = np.array(len_i[I])
         Lj = np.array(len_j[J])
         return Li, Lj, scores
@@ -86,7 +84,7 @@ class scnorm:
         lj_vals = Lh ** (-params[0])
         li_matrix = sparse.csr_matrix((li_vals, (rangeq, rangeq)))
         lj_matrix = sparse.csr_matrix((lj_vals, (rangeh, rangeh)))
-        return sparse.lil_matrix(10 ** (-params[1]) * li_matrix * b * lj_matrix)
+        return 10 ** (-params[1]) * li_matrix * b * lj_matrix
 
 
 """
@@ -113,21 +111,21 @@ class WaterfallMethod:
                 "WARNING: THIS IS UNCOMMON, there are zero hits when searching the genes in species %d against itself. Check the input proteome contains all the genes from that species and check the search program is working (default is diamond)."
                 % iSpecies
             )
-            return sparse.lil_matrix(B.get_shape())
+            return sparse.csr_matrix(B.get_shape())
         else:
             print(
                 "WARNING: Too few hits between species %d and species %d to normalise the scores, these hits will be ignored"
                 % (iSpecies, jSpecies)
             )
-            return sparse.lil_matrix(B.get_shape())
+            return sparse.csr_matrix(B.get_shape())
 
     @staticmethod
     def NormalisedBitScore(B, Lengths, iSpecies, jSpecies):
         """
         Args:
-            B - LIL matrix
+            B - CSR matrix
         Returns
-            B' - LIL matrix
+            B' - CSR matrix
         """
         if B.nnz == 0:
             return B
@@ -139,7 +137,7 @@ class WaterfallMethod:
         lj_vals = Lh ** (-0.5)
         li_matrix = sparse.csr_matrix((li_vals, (rangeq, rangeq)))
         lj_matrix = sparse.csr_matrix((lj_vals, (rangeh, rangeh)))
-        return sparse.lil_matrix(li_matrix * B * lj_matrix)
+        return li_matrix * B * lj_matrix
 
     @staticmethod
     def ProcessBlastHits(
@@ -214,37 +212,15 @@ class WaterfallMethod:
                 print("ERROR: Error processing files Blast%d_*" % i)
                 raise
 
-    @staticmethod
-    def Worker_ProcessBlastHits_New(
-        seqsInfo,
-        blastDir_list,
-        Lengths,
-        iSpecies,
-        d_pickle,
-        qDoubleBlast,
-        v2_scores,
-        q_allow_empty,
-        result_queue,
-    ):
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            try:
-                WaterfallMethod.ProcessBlastHits(
-                    seqsInfo,
-                    blastDir_list,
-                    Lengths, 
-                    iSpecies,
-                    d_pickle,
-                    qDoubleBlast,
-                    v2_scores,
-                    q_allow_empty,
-                )
-                result_queue.put((iSpecies, "success"))
-            except Exception as e:
-                result_queue.put((iSpecies, e))
-
     @staticmethod
     def GetBH_s(pairwiseScoresMatrices, seqsInfo, iSpecies, tol=1e-3):
+        """
+        Args:
+            pairwiseScoresMatrices - list of CSR score matrices for iSpecies vs each species
+        Returns:
+            H - list of 0-1 CSR matrices of the best hits (within tol) for each query sequence in 
+                each other species & the paralogues closer than the best hit in any other species
+        """
         nSeqs_i = seqsInfo.nSeqsPerSpecies[seqsInfo.speciesToUse[iSpecies]]
         bestHitForSequence = -1 * np.ones(nSeqs_i)
         H = [
@@ -254,44 +230,34 @@ class WaterfallMethod:
             if iSpecies == j:
                 # identify orthologs then come back to paralogs
                 continue
-            W = pairwiseScoresMatrices[j]
-            I = []
-            J = []
-            for kRow in range(nSeqs_i):
-                values = W.getrowview(kRow)
-                if values.nnz == 0:
-                    continue
-                m = max(values.data[0])
-                bestHitForSequence[kRow] = (
-                    m if m > bestHitForSequence[kRow] else bestHitForSequence[kRow]
-                )
-                # get all above this value with tolerance
-                temp = [
-                    index
-                    for index, value in zip(values.rows[0], values.data[0])
-                    if value > m - tol
-                ]
-                J.extend(temp)
-                I.extend(kRow * np.ones(len(temp), dtype=np.dtype(int)))
-            H[j] = sparse.csr_matrix((np.ones(len(I)), (I, J)), shape=W.get_shape())
+            W = pairwiseScoresMatrices[j].tocsr()
+            q_hits = np.diff(W.indptr) != 0
+            m = matrices.sparse_max_row(W)
+            bestHitForSequence[q_hits] = np.maximum(m[q_hits], bestHitForSequence[q_hits])
+            # get all above this value with tolerance
+            H[j] = WaterfallMethod.SelectAbove(W, m - tol)
         # now look for paralogs
-        I = []
-        J = []
-        W = pairwiseScoresMatrices[iSpecies]
-        for kRow in range(nSeqs_i):
-            values = W.getrowview(kRow)
-            if values.nnz == 0:
-                continue
-            temp = [
-                index
-                for index, value in zip(values.rows[0], values.data[0])
-                if value > bestHitForSequence[kRow] - tol
-            ]
-            J.extend(temp)
-            I.extend(kRow * np.ones(len(temp), dtype=np.dtype(int)))
-        H[iSpecies] = sparse.csr_matrix((np.ones(len(I)), (I, J)), shape=W.get_shape())
+        W = pairwiseScoresMatrices[iSpecies].tocsr()
+        H[iSpecies] = WaterfallMethod.SelectAbove(W, bestHitForSequence - tol)
         return H
 
+    @staticmethod
+    def SelectAbove(W, cutoffs):
+        """
+        Args:
+            W - CSR matrix
+            cutoffs - array, the cut-off for each row
+        Returns:
+            0-1 CSR matrix of the entries of W greater than the cut-off for their row
+        """
+        rows = np.repeat(np.arange(W.shape[0]), np.diff(W.indptr))
+        q_keep = W.data > cutoffs[rows]
+        indptr = np.zeros(W.shape[0] + 1, dtype=W.indptr.dtype)
+        np.cumsum(np.bincount(rows[q_keep], minlength=W.shape[0]), out=indptr[1:])
+        return sparse.csr_matrix(
+            (np.ones(np.count_nonzero(q_keep)), W.indices[q_keep], indptr), shape=W.shape
+        )
+
     @staticmethod
     def ConnectCognates(seqsInfo, iSpecies, d_pickle, v2_scores=False):
         # calculate RBH for species i
@@ -321,48 +287,30 @@ class WaterfallMethod:
                     return
 
     @staticmethod
-    def Worker_ConnectCognates_New(seqsInfo, iSpecies, d_pickle, result_queue, v2_scores=True):
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            try:
-                WaterfallMethod.ConnectCognates(
-                    seqsInfo, iSpecies, d_pickle=d_pickle, v2_scores=v2_scores
-                )
-                result_queue.put((iSpecies, "success"))
-            except Exception as e:
-                result_queue.put((iSpecies, e))
-        
-
-    @staticmethod
-    def WriteGraphParallel(func, seqsInfo, nProcess, i_unassigned=None):
-        graphFN = files.FileHandler.GetGraphFilename(i_unassigned)
-        # Should use PTM?
+    def GetGraphParallel(func, seqsInfo, nProcess):
+        """
+        Returns:
+            W - CSR matrix of the complete graph, indexed by the sequence IDs used in the graph
+        """
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            with open(graphFN, "w") as graphFile:
-                graphFile.write(
-                    "(mclheader\nmcltype matrix\ndimensions %dx%d\n)\n"
-                    % (seqsInfo.nSeqs, seqsInfo.nSeqs)
-                )
-                graphFile.write("\n(mclmatrix\nbegin\n\n")
-            pool = mp.Pool(nProcess)
-            pool.map(
+            pool = parallel_task_manager.ParallelTaskManager_singleton().GetWorkerPool(nProcess)
+            W = pool.Map(
                 func,
                 [
-                    (seqsInfo, graphFN, iSpec, files.FileHandler.GetPickleDir())
+                    ((seqsInfo, iSpec, files.FileHandler.GetPickleDir()),)
                     for iSpec in range(seqsInfo.nSpecies)
                 ],
             )
-            for iSp in range(seqsInfo.nSpecies):
-                subprocess.call(
-                    "cat " + graphFN + "_%d" % iSp + " >> " + graphFN, shell=True
-                )
-                os.remove(graphFN + "_%d" % iSp)
-            # Cleanup
-            pool.close()
-            matrices.DeleteMatrices("B", files.FileHandler.GetPickleDir())
-            matrices.DeleteMatrices("connect", files.FileHandler.GetPickleDir())
-        return graphFN
+            W = sparse.vstack(W, format="csr")
+            WaterfallMethod.DeleteGraphMatrices()
+        return W
+
+    @staticmethod
+    def DeleteGraphMatrices():
+        matrices.DeleteMatrices("B", files.FileHandler.GetPickleDir())
+        matrices.DeleteMatrices("BH", files.FileHandler.GetPickleDir())
+        matrices.DeleteMatrices("connect", files.FileHandler.GetPickleDir())
 
     @staticmethod
     def GetMostDistant_s(RBH, B, seqsInfo, iSpec):
@@ -28,6 +28,8 @@ import os
 import sys
 import csv
 import gzip
+from operator import methodcaller
+import numpy as np
 from scipy import sparse
 try:
     from rich import print
@@ -38,7 +40,64 @@ from . import util
 PY2 = sys.version_info <= (3,)       
 file_read_mode = 'rb' if PY2 else 'rt'
 
+# Approximate number of characters of a BLAST results file that are parsed at a time
+nCharsPerChunk = 2**24
+
+
+def ParseChunk(lines, qSpecies, hSpecies, sep):
+    """
+    Parse a block of lines from a BLAST results file in bulk
+    Args:
+        lines - list of lines read from the file
+        qSpecies, hSpecies - species IDs (as strings) expected for the query and hit sequences
+        sep - separator between the species ID and sequence ID
+    Returns:
+        (q, h, s) - arrays of query sequence IDs, hit sequence IDs & bit-scores, or None if the lines are not all in
+                    the expected format, in which case they should be parsed individually
+    """
+    n = len(lines)
+    nTabs = set(map(methodcaller("count", "\t"), lines))
+    if len(nTabs) != 1:
+        return None
+    nFields = nTabs.pop() + 1
+    if nFields < 12:
+        return None
+    fields = "".join(lines).replace("\n", "\t").split("\t", nFields * n)[:nFields * n]
+    q = sep.join(fields[0::nFields]).split(sep)
+    h = sep.join(fields[1::nFields]).split(sep)
+    if len(q) != 2 * n or len(h) != 2 * n or set(q[0::2]) != {qSpecies} or set(h[0::2]) != {hSpecies}:
+        return None
+    try:
+        return np.array(q[1::2], dtype=np.int64), np.array(h[1::2], dtype=np.int64), np.array(fields[11::nFields], dtype=np.float64)
+    except ValueError:
+        return None
+
+
+def MaxScoresMatrix(I, J, S, shape):
+    """
+    Args:
+        I, J - arrays of row and column indices, possibly containing repeated (i, j) pairs
+        S - array of scores
+        shape - shape of the matrix
+    Returns:
+        CSR matrix containing the maximum of the scores for each (i, j) pair
+    """
+    key = I * shape[1] + J
+    order = np.lexsort((S, key))
+    key = key[order]
+    S = S[order]
+    # the last entry for each pair has the highest score
+    q_last = np.ones(len(key), dtype=bool)
+    q_last[:-1] = key[1:] != key[:-1]
+    I, J = np.divmod(key[q_last], shape[1])
+    return sparse.coo_matrix((S[q_last], (I, J)), shape=shape).tocsr()
+
+
 def GetBLAST6Scores(seqsInfo, blastDir_list, iSpecies, jSpecies, qExcludeSelfHits = True, sep = "_", qDoubleBlast=True, q_allow_empty=False):
+    """
+    Returns:
+        B - CSR matrix of the best bit-score for each query, hit pair
+    """
     qSameSpecies = iSpecies==jSpecies
     qCheckForSelfHits = qExcludeSelfHits and qSameSpecies
     if not qDoubleBlast:
@@ -46,62 +105,80 @@ def GetBLAST6Scores(seqsInfo, blastDir_list, iSpecies, jSpecies, qExcludeSelfHit
     else:
         qRev = False      
     if qRev:
-        iQ = 1 
-        iH = 0
         iSpeciesOpen = jSpecies
         jSpeciesOpen = iSpecies
     else:        
-        iQ = 0 
-        iH = 1 
         iSpeciesOpen = iSpecies
         jSpeciesOpen = jSpecies
     nSeqs_i = seqsInfo.nSeqsPerSpecies[iSpecies]
     nSeqs_j = seqsInfo.nSeqsPerSpecies[jSpecies]
-    B = sparse.lil_matrix((nSeqs_i, nSeqs_j))
-    row = ""
     for d in blastDir_list:
         fn = d + "Blast%d_%d.txt" % (iSpeciesOpen, jSpeciesOpen)
         if os.path.exists(fn) or os.path.exists(fn + ".gz"): break
     if q_allow_empty and not os.path.exists(fn) and not os.path.exists(fn + ".gz"):
-        return B
+        return sparse.csr_matrix((nSeqs_i, nSeqs_j))
+    row = ""
+    I = []
+    J = []
+    S = []
     try:
         with (gzip.open(fn + ".gz", file_read_mode) if os.path.exists(fn + ".gz") else open(fn, file_read_mode)) as blastfile:
-            blastreader = csv.reader(blastfile, delimiter='\t')
-            for row in blastreader:
-                if len(row) == 0:
-                    continue
-                # Get hit and query IDs
-                try:
-                    sequence1ID = int(row[iQ].split(sep, 2)[1])
-                    sequence2ID = int(row[iH].split(sep, 2)[1])
-                except (IndexError, ValueError):
-                    sys.stderr.write("\nERROR: Query or hit sequence ID in BLAST results file was missing or incorrectly formatted.\n")
-                    raise
-                # Get bit score for pair
-                try:
-                    score = float(row[11])   
-                except (IndexError, ValueError):
-                    sys.stderr.write("\nERROR: 12th field in BLAST results file line should be the bit-score for the hit\n")
-                    raise
-                if (qCheckForSelfHits and sequence1ID == sequence2ID):
-                    continue
-                # store bit score
-                try:
-                    if score > B[sequence1ID, sequence2ID]: 
-                        B[sequence1ID, sequence2ID] = score   
-                except IndexError:
-                    def ord(n):
-                        return str(n)+("th" if 4<=n%100<=20 else {1:"st",2:"nd",3:"rd"}.get(n%10, "th"))
-#                        sys.stderr.write("\nError in input files, expected only %d sequences in species %d and %d sequences in species %d but found a hit in the Blast%d_%d.txt between sequence %d_%d (i.e. %s sequence in species) and sequence %d_%d (i.e. %s sequence in species)\n" %  (nSeqs_i, iSpecies, nSeqs_j, jSpecies, iSpecies, jSpecies, iSpecies, sequence1ID, ord(sequence1ID+1), jSpecies, sequence2ID, ord(sequence2ID+1)))
-                    sys.stderr.write("\nERROR: Inconsistent input files.\n")
-                    kSpecies, nSeqs_k, sequencekID = (iSpecies,  nSeqs_i, sequence1ID) if sequence1ID >= nSeqs_i else (jSpecies,  nSeqs_j, sequence2ID)
-                    print("ERROR: Blast%d_%d.txt is corrupted" % (iSpecies, jSpecies))
-                    sys.stderr.write("Species%d.fa contains only %d sequences " % (kSpecies,  nSeqs_k)) 
-                    sys.stderr.write("but found a query/hit in the Blast%d_%d.txt for sequence %d_%d (i.e. %s sequence in species %d).\n" %  (iSpecies, jSpecies, kSpecies, sequencekID, ord(sequencekID+1), kSpecies))
-                    util.Fail()
+            while True:
+                lines = blastfile.readlines(nCharsPerChunk)
+                if not lines:
+                    break
+                hits = ParseChunk(lines, str(iSpeciesOpen), str(jSpeciesOpen), sep)
+                if hits is None:
+                    # Parse one line at a time, identifying any malformatted line
+                    q = []
+                    h = []
+                    s = []
+                    for row in csv.reader(lines, delimiter='\t'):
+                        if len(row) == 0:
+                            continue
+                        # Get hit and query IDs
+                        try:
+                            q.append(int(row[0].split(sep, 2)[1]))
+                            h.append(int(row[1].split(sep, 2)[1]))
+                        except (IndexError, ValueError):
+                            sys.stderr.write("\nERROR: Query or hit sequence ID in BLAST results file was missing or incorrectly formatted.\n")
+                            raise
+                        # Get bit score for pair
+                        try:
+                            s.append(float(row[11]))
+                        except (IndexError, ValueError):
+                            sys.stderr.write("\nERROR: 12th field in BLAST results file line should be the bit-score for the hit\n")
+                            raise
+                    hits = (np.array(q, dtype=np.int64), np.array(h, dtype=np.int64), np.array(s, dtype=np.float64))
+                q, h, s = hits
+                if qRev:
+                    q, h = h, q
+                # Only positive scores are stored and self-hits are optionally excluded
+                q_keep = s > 0
+                if qCheckForSelfHits:
+                    q_keep &= (q != h)
+                I.append(q[q_keep])
+                J.append(h[q_keep])
+                S.append(s[q_keep])
     except Exception:
         print("ERROR: Blast%d_%d.txt is corrupted" % (iSpecies, jSpecies))
         sys.stderr.write("Malformatted line in %sBlast%d_%d.txt\nOffending line was:\n" % (d, iSpecies, jSpecies))
         sys.stderr.write("\t".join(row) + "\n")
         raise
-    return B
+    I = np.concatenate(I) if I else np.zeros(0, dtype=np.int64)
+    J = np.concatenate(J) if J else np.zeros(0, dtype=np.int64)
+    S = np.concatenate(S) if S else np.zeros(0)
+    q_bad = (I < 0) | (I >= nSeqs_i) | (J < 0) | (J >= nSeqs_j)
+    if q_bad.any():
+        def ord(n):
+            return str(n)+("th" if 4<=n%100<=20 else {1:"st",2:"nd",3:"rd"}.get(n%10, "th"))
+        k = np.argmax(q_bad)
+        sequence1ID = int(I[k])
+        sequence2ID = int(J[k])
+        sys.stderr.write("\nERROR: Inconsistent input files.\n")
+        kSpecies, nSeqs_k, sequencekID = (iSpecies,  nSeqs_i, sequence1ID) if not 0 <= sequence1ID < nSeqs_i else (jSpecies,  nSeqs_j, sequence2ID)
+        print("ERROR: Blast%d_%d.txt is corrupted" % (iSpecies, jSpecies))
+        sys.stderr.write("Species%d.fa contains only %d sequences " % (kSpecies,  nSeqs_k)) 
+        sys.stderr.write("but found a query/hit in the Blast%d_%d.txt for sequence %d_%d (i.e. %s sequence in species %d).\n" %  (iSpecies, jSpecies, kSpecies, sequencekID, ord(sequencekID+1), kSpecies))
+        util.Fail()
+    return MaxScoresMatrix(I, J, S, (nSeqs_i, nSeqs_j))
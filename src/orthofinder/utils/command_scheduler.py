@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 David Emms
+#
+# This program (OrthoFinder) is distributed under the terms of the GNU General Public License v3
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  When publishing work that uses OrthoFinder please cite:
+#      Emms, D.M. and Kelly, S. (2015) OrthoFinder: solving fundamental biases in whole genome comparisons dramatically
+#      improves orthogroup inference accuracy, Genome Biology 16:157
+#
+# For any enquiries send an email to David Emms
+# david_emms@hotmail.com
+"""
+Scheduling of the sequence search, MSA and tree commands
+-------------------------------------------------------------------------------
+Each task (a command, or a list of commands run in order) is given a predicted
+cost from the size of its input: the product of the sequence counts where the
+caller supplies task sizes, otherwise the total size of the input files. For
+each program the cost is c * size^e, with c and e fitted to the runtimes of
+previous commands (in CPU seconds) which are recorded in the working directory,
+so that later stages and analyses that build on this one are calibrated. Before
+there are enough records c = e = 1.
+
+A task can depend on others, e.g. the species tree on the alignments of the
+orthogroups used for it; it is started once they have all finished and the
+tasks that others wait on are started before the rest. The size of a task with
+dependencies and no input files yet is the total size of its dependencies.
+
+The tasks are started largest first (or smallest first for --order ascending)
+within a budget of cores. The largest tasks, which together account for
+threshold % of the total predicted cost, are run with method_threads_large
+threads and the rest with method_threads_small. Without these options every
+task uses method_threads, as before.
+"""
+import os
+import csv
+import heapq
+import types
+import multiprocessing as mp
+
+import numpy as np
+
+from . import util, files
+
+default_threshold = 20      # % of the predicted cost that is run with method_threads_large
+nMinRecords = 10            # runtimes required to fit the cost of a program
+min_exponent = 0.5
+max_exponent = 3.
+
+
+def GetProgramName(command):
+    """
+    Returns:
+        name - the program called by the command, None for a python function
+    """
+    if isinstance(command, types.FunctionType) or not isinstance(command, str):
+        return None
+    tokens = command.split()
+    return os.path.basename(tokens[0]) if tokens else None
+
+
+def GetInputSize(command):
+    """
+    Returns:
+        size - total size of the existing files named on the command line before any output redirection
+    """
+    size = 0
+    if not isinstance(command, str):
+        return size
+    for token in command.split():
+        if token.startswith(">"):
+            break
+        if os.path.isfile(token):
+            size += os.path.getsize(token)
+    return size
+
+
+def GetDependencyOrder(dependencies):
+    """
+    Args:
+        dependencies - list, for each task, of the indices of the tasks it depends on
+    Returns:
+        order - the task indices, each after all of the tasks it depends on
+    """
+    order = []
+    state = [0] * len(dependencies)     # 0 - not visited, 1 - in progress, 2 - done
+    for i0 in range(len(dependencies)):
+        stack = [i0]
+        while stack:
+            i = stack[-1]
+            if state[i] == 2:
+                stack.pop()
+                continue
+            state[i] = 1
+            waiting = [j for j in dependencies[i] if state[j] != 2]
+            for j in waiting:
+                if state[j] == 1:
+                    raise Exception("Circular dependencies between tasks %d and %d" % (i, j))
+            if waiting:
+                stack.extend(waiting)
+            else:
+                state[i] = 2
+                order.append(i)
+                stack.pop()
+    return order
+
+
+def GetDependencyLevels(dependencies):
+    """
+    Returns:
+        levels - list of lists of task indices, in index order, to run one after the other. Each task is in
+                 the last level that is before all the tasks that depend on it
+    """
+    dependents = [[] for _ in dependencies]
+    for i, deps in enumerate(dependencies):
+        for j in deps:
+            dependents[j].append(i)
+    height = [0] * len(dependencies)
+    for i in reversed(GetDependencyOrder(dependencies)):
+        height[i] = max([height[k] + 1 for k in dependents[i]], default=0)
+    nLevels = max(height, default=-1) + 1
+    levels = [[] for _ in range(nLevels)]
+    for i, h in enumerate(height):
+        levels[nLevels - 1 - h].append(i)
+    return levels
+
+
+class RuntimeModel(object):
+    """
+    The recorded runtimes and the power law fitted for each (program, size type)
+    """
+    def __init__(self):
+        self.records = []
+        self.new_records = []
+        try:
+            self.fn = files.FileHandler.GetCommandRuntimesFN()
+            fns = files.FileHandler.GetCommandRuntimesFNs_Read()
+        except Exception:
+            # no working directory, e.g. the dependency checks
+            self.fn = None
+            fns = []
+        for fn in fns:
+            with open(fn, util.csv_read_mode) as infile:
+                for row in csv.reader(infile, delimiter="\t"):
+                    try:
+                        self.records.append((row[0], row[1], float(row[2]), int(row[3]), float(row[4])))
+                    except (IndexError, ValueError):
+                        continue
+        self.Fit()
+
+    def Fit(self):
+        grouped = dict()
+        for program, size_type, size, threads, seconds in self.records:
+            if size > 0 and seconds > 0:
+                grouped.setdefault((program, size_type), []).append((size, threads * seconds))
+        self.params = dict()
+        for key, values in grouped.items():
+            x = np.log([size for size, _ in values])
+            y = np.log([cpu for _, cpu in values])
+            if len(values) < nMinRecords or x.min() == x.max():
+                continue
+            e = min(max(np.polyfit(x, y, 1)[0], min_exponent), max_exponent)
+            self.params[key] = (np.exp(np.mean(y - e * x)), e)
+
+    def Predict(self, program, size_type, size):
+        c, e = self.params.get((program, size_type), (1., 1.))
+        return c * size ** e
+
+    def Record(self, program, size_type, size, threads, seconds):
+        self.new_records.append((program, size_type, size, threads, seconds))
+
+    def Save(self):
+        if self.fn is None or len(self.new_records) == 0:
+            return
+        with open(self.fn, "a") as outfile:
+            for program, size_type, size, threads, seconds in self.new_records:
+                outfile.write("%s\t%s\t%d\t%d\t%0.3f\n" % (program, size_type, size, threads, seconds))
+        self.records.extend(self.new_records)
+        self.new_records = []
+        self.Fit()
+
+
+class CommandScheduler(object):
+    def __init__(self,
+                 tasks,
+                 nProcesses,
+                 method_threads="1",
+                 method_threads_large=None,
+                 method_threads_small=None,
+                 threshold=None,
+                 cmd_order="descending",
+                 tasksize=None,
+                 dependencies=None):
+        """
+        Args:
+            tasks - list of lists of (cmd, fns), the commands of each task to be run in order
+            nProcesses - the maximum number of tasks to run at once
+            method_threads - threads per command when neither large nor small threads are given
+            method_threads_large - threads for the largest tasks
+            method_threads_small - threads for the remaining tasks
+            threshold - % of the total predicted cost to run with method_threads_large
+            cmd_order - "descending" to start the largest tasks first, "ascending" for smallest first
+            tasksize - optional list of the size of each task, e.g. nSeqs0 * nSeqs1 for a sequence search
+            dependencies - optional list, for each task, of the indices of the tasks that must finish before it starts
+        """
+        method_threads = int(method_threads)
+        if nProcesses * method_threads > mp.cpu_count():
+            nProcesses = max(1, mp.cpu_count() // method_threads)
+        self.nProcesses = nProcesses
+        self.nCores = nProcesses * method_threads
+        self.model = RuntimeModel()
+        n = len(tasks)
+        if dependencies is None:
+            dependencies = [[] for _ in tasks]
+        q_tasksize = tasksize is not None and len(tasksize) == n
+        self.size_type = "tasksize" if q_tasksize else "bytes"
+        self.sizes = [float(s) for s in tasksize] if q_tasksize else [GetInputSize(task[0][0]) for task in tasks]
+        for i in GetDependencyOrder(dependencies):
+            if self.sizes[i] == 0 and dependencies[i]:
+                self.sizes[i] = sum(self.sizes[j] for j in dependencies[i])
+        costs = [sum(self.model.Predict(program, self.size_type, size) for program in self.Programs(task))
+                 for task, size in zip(tasks, self.sizes)]
+        self.dependents = [[] for _ in tasks]
+        for i, deps in enumerate(dependencies):
+            for j in deps:
+                self.dependents[j].append(i)
+        if cmd_order != "ascending":
+            order = sorted(range(n), key=lambda i: (len(self.dependents[i]) > 0, costs[i]), reverse=True)
+        else:
+            order = sorted(range(n), key=lambda i: (len(self.dependents[i]) == 0, costs[i]))
+        self.rank = [0] * n
+        for r, i in enumerate(order):
+            self.rank[i] = r
+
+        threads = [method_threads] * n
+        if method_threads_large is not None or method_threads_small is not None:
+            n_large = int(method_threads) if method_threads_large is None else int(method_threads_large)
+            n_small = int(method_threads) if method_threads_small is None else int(method_threads_small)
+            if threshold is None:
+                threshold = default_threshold
+            total = sum(costs)
+            cumulative = 0.
+            for i in sorted(range(n), key=lambda i: costs[i], reverse=True):
+                threads[i] = n_large if cumulative < 0.01 * threshold * total else n_small
+                cumulative += costs[i]
+        # commands that don't take a number of threads use a single core
+        self.threads = [min(t, self.nCores) if self.QTakesThreads(task) else 1 for t, task in zip(threads, tasks)]
+        self.tasks = [self.SetThreads(task, t) for task, t in zip(tasks, self.threads)]
+        self.n_waiting = [len(set(deps)) for deps in dependencies]
+        self.ready = [(self.rank[i], i) for i in range(n) if self.n_waiting[i] == 0]
+        heapq.heapify(self.ready)
+
+    @staticmethod
+    def Programs(task):
+        return [name for name in (GetProgramName(cmd) for cmd, _ in task) if name is not None]
+
+    @staticmethod
+    def QTakesThreads(task):
+        return any(isinstance(cmd, str) and "METHODTHREAD" in cmd for cmd, _ in task)
+
+    @staticmethod
+    def SetThreads(task, threads):
+        t = str(threads)
+        return [(cmd.replace("METHODTHREAD", t) if isinstance(cmd, str) else cmd,
+                 fns.replace("METHODTHREAD", t) if isinstance(fns, str) else fns)
+                for cmd, fns in task]
+
+    def Next(self):
+        """
+        Returns:
+            i, task, threads - the task to start next, i is None if no task is ready
+        """
+        if not self.ready:
+            return None, None, None
+        i = self.ready[0][1]
+        return i, self.tasks[i], self.threads[i]
+
+    def Start(self, i):
+        heapq.heappop(self.ready)
+
+    def Finished(self, i):
+        """ The tasks that depended on task i are ready once all their other dependencies have finished """
+        for j in set(self.dependents[i]):
+            self.n_waiting[j] -= 1
+            if self.n_waiting[j] == 0:
+                heapq.heappush(self.ready, (self.rank[j], j))
+
+    def RecordRuntimes(self, i, step_times):
+        """
+        Args:
+            i - index of the task
+            step_times - list of (cmd, seconds) for the commands that completed successfully
+        """
+        for cmd, seconds in step_times:
+            program = GetProgramName(cmd)
+            if program is not None:
+                self.model.Record(program, self.size_type, self.sizes[i], self.threads[i], seconds)
+
+    def Save(self):
+        self.model.Save()
@@ -744,6 +744,17 @@ class __Files_new_dont_manually_create__(object):
         if not os.path.exists(d): os.mkdir(d)
         return d    
 
+    def GetCommandRuntimesFN(self):
+        return self.GetWorkingDirectory_Write() + "Command_runtimes.tsv"
+
+    def GetCommandRuntimesFNs_Read(self):
+        """ Runtimes recorded by this analysis and those it builds on """
+        fns = [d + "Command_runtimes.tsv" for d in self.wd_base]
+        fn_write = self.GetCommandRuntimesFN()
+        if fn_write not in fns:
+            fns.append(fn_write)
+        return [fn for fn in fns if os.path.exists(fn)]
+
     def GetDependenciesCheckDir(self):
         d = self.GetWorkingDirectory_Write() + "dependencies/"
         if not os.path.exists(d):
@@ -27,33 +27,158 @@
 import os
 import glob
 import numpy as np
-try:
-    import cPickle as pic
-except ImportError:
-    import pickle as pic
+from scipy import sparse
 
-from .. import picProtocol
+"""
+Matrix store
+-------------------------------------------------------------------------------
+The sparse matrix for each species pair, (name, iSpecies, jSpecies), is stored in CSR format in two files per matrix 
+name in the pickle directory:
+    <name>.dat - the indptr, indices & data arrays of each matrix, back to back
+    <name>.idx - a fixed-size record for each matrix giving its location in the data file, its shape and its dtypes
+Both files are only ever appended to, a matrix's arrays and its record each with a single write, so that the
+processes for the different species can write to them concurrently. A matrix too large for a single write is instead
+written to its own file, <name><iSpecies>_<jSpecies>.dat, and its record has an offset of -1. If a matrix is written 
+more than once then its last record is used. Matrices are loaded as copy-on-write views of a memory map of the data 
+file.
+"""
+
+# Fields of each record in the index file
+nRecordFields = 8
+iRec_sp1, iRec_sp2, iRec_offset, iRec_nRows, iRec_nCols, iRec_nnz, iRec_indexType, iRec_dataType = range(nRecordFields)
+
+# Largest number of bytes appended to the data file with one write, larger matrices are written to their own file
+maxAppend = 1 << 30
+
+# dtypes that can be stored, recorded by their position in the list
+storeDtypes = [np.dtype(t) for t in (np.float64, np.float32, np.int64, np.int32, np.int8, np.bool_)]
+
+def _DataFN(name, d_pickle):
+    return d_pickle + "%s.dat" % name
+
+def _IndexFN(name, d_pickle):
+    return d_pickle + "%s.idx" % name
+
+def _LargeFN(name, iSpecies, jSpecies, d_pickle):
+    return d_pickle + "%s%d_%d.dat" % (name, iSpecies, jSpecies)
+
+def _Padded(nBytes):
+    """Arrays start on 8-byte boundaries in the data file"""
+    return -(-nBytes // 8) * 8
+
+def _Buffers(arrays):
+    buffers = []
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        buffers.append(a)
+        buffers.append(bytes(_Padded(a.nbytes) - a.nbytes))
+    return buffers
+
+def _Append(fn, arrays):
+    """
+    Append the arrays to the file, each padded to a multiple of 8 bytes, using a single write
+    Returns:
+        offset - the position in the file at which they were written
+    """
+    buffer = b"".join(_Buffers(arrays))
+    fd = os.open(fn, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        nWritten = os.write(fd, buffer)
+        if nWritten != len(buffer):
+            raise OSError("Incomplete write to %s" % fn)
+        # in append mode the file position is left at the end of the data just written
+        return os.lseek(fd, 0, os.SEEK_CUR) - nWritten
+    finally:
+        os.close(fd)
+
+def _Write(fn, arrays):
+    """
+    Write the arrays to a new file, each padded to a multiple of 8 bytes. The file object completes any partial writes.
+    """
+    with open(fn, 'wb') as outfile:
+        for buffer in _Buffers(arrays):
+            outfile.write(memoryview(buffer).cast("B"))
+
+def _ReadIndex(name, d_pickle):
+    index = np.fromfile(_IndexFN(name, d_pickle), dtype=np.int64)
+    return index[:len(index) // nRecordFields * nRecordFields].reshape((-1, nRecordFields))
+
+def _GetMatrix(data, record, name, d_pickle):
+    """
+    Args:
+        data - memory map of the data file, as uint8
+        record - the index record for the matrix
+        name - the matrix name
+        d_pickle - the directory containing the matrix files
+    """
+    offset = record[iRec_offset]
+    if offset < 0:
+        data = np.memmap(_LargeFN(name, record[iRec_sp1], record[iRec_sp2], d_pickle), dtype=np.uint8, mode='c')
+        offset = 0
+    nRows = record[iRec_nRows]
+    nnz = record[iRec_nnz]
+    indexType = storeDtypes[record[iRec_indexType]]
+    dataType = storeDtypes[record[iRec_dataType]]
+    arrays = []
+    for n, dtype in ((nRows + 1, indexType), (nnz, indexType), (nnz, dataType)):
+        nBytes = n * dtype.itemsize
+        arrays.append(data[offset:offset + nBytes].view(dtype))
+        offset += _Padded(nBytes)
+    indptr, indices, values = arrays
+    return sparse.csr_matrix((values, indices, indptr), shape=(nRows, record[iRec_nCols]), copy=False)
+
+def _MapData(name, d_pickle):
+    fn = _DataFN(name, d_pickle)
+    # an empty file can't be memory mapped, it only occurs if every matrix has its own file
+    if not os.path.exists(fn) or os.path.getsize(fn) == 0:
+        return None
+    return np.memmap(fn, dtype=np.uint8, mode='c')
 
 def DumpMatrix(name, m, iSpecies, jSpecies, d_pickle):
-    with open(d_pickle + "%s%d_%d.pic" % (name, iSpecies, jSpecies), 'wb') as picFile:
-        pic.dump(m, picFile, protocol=picProtocol)
+    m = sparse.csr_matrix(m)
+    arrays = (m.indptr, m.indices, m.data)
+    if sum(_Padded(a.nbytes) for a in arrays) > maxAppend:
+        _Write(_LargeFN(name, iSpecies, jSpecies, d_pickle), arrays)
+        offset = -1
+    else:
+        offset = _Append(_DataFN(name, d_pickle), arrays)
+    record = np.zeros(nRecordFields, dtype=np.int64)
+    record[iRec_sp1] = iSpecies
+    record[iRec_sp2] = jSpecies
+    record[iRec_offset] = offset
+    record[iRec_nRows], record[iRec_nCols] = m.shape
+    record[iRec_nnz] = m.nnz
+    record[iRec_indexType] = storeDtypes.index(m.indices.dtype)
+    record[iRec_dataType] = storeDtypes.index(m.dtype)
+    _Append(_IndexFN(name, d_pickle), (record,))
     
 def DumpMatrixArray(name, matrixArray, iSpecies, d_pickle):
     for jSpecies, m in enumerate(matrixArray):
         DumpMatrix(name, m, iSpecies, jSpecies, d_pickle)
 
 def LoadMatrix(name, iSpecies, jSpecies, d_pickle): 
-    with open(d_pickle + "%s%d_%d.pic" % (name, iSpecies, jSpecies), 'rb') as picFile:  
-        M = pic.load(picFile)
-    return M
+    index = _ReadIndex(name, d_pickle)
+    q = (index[:, iRec_sp1] == iSpecies) & (index[:, iRec_sp2] == jSpecies)
+    if not q.any():
+        raise KeyError("Matrix %s%d_%d not found in %s" % (name, iSpecies, jSpecies, _IndexFN(name, d_pickle)))
+    return _GetMatrix(_MapData(name, d_pickle), index[q][-1], name, d_pickle)
         
 def LoadMatrixArray(name, seqsInfo, iSpecies, d_pickle, row=True):
+    """
+    Load the matrices (iSpecies, jSpecies) for all jSpecies if row, otherwise (jSpecies, iSpecies)
+    """
+    index = _ReadIndex(name, d_pickle)
+    iFixed, iOther = (iRec_sp1, iRec_sp2) if row else (iRec_sp2, iRec_sp1)
+    records = dict()
+    for record in index[index[:, iFixed] == iSpecies]:
+        records[record[iOther]] = record  # later records replace earlier ones
+    data = _MapData(name, d_pickle)
     matrixArray = []
     for jSpecies in range(seqsInfo.nSpecies):
-        if row == True:
-            matrixArray.append(LoadMatrix(name, iSpecies, jSpecies, d_pickle))
-        else:
-            matrixArray.append(LoadMatrix(name, jSpecies, iSpecies, d_pickle))
+        if jSpecies not in records:
+            ij = (iSpecies, jSpecies) if row else (jSpecies, iSpecies)
+            raise KeyError("Matrix %s%d_%d not found in %s" % ((name,) + ij + (_IndexFN(name, d_pickle),)))
+        matrixArray.append(_GetMatrix(data, records[jSpecies], name, d_pickle))
     return matrixArray
               
 def MatricesAnd_s(Xarr, Yarr):
@@ -69,8 +194,10 @@ def MatricesAndTr_s(Xarr, Yarr):
     return Zarr   
     
 def DeleteMatrices(baseName, d_pickle):
-    for f in glob.glob(d_pickle + baseName + "*_*.pic"):
+    for f in (_DataFN(baseName, d_pickle), _IndexFN(baseName, d_pickle)):
         if os.path.exists(f): os.remove(f)
+    for f in glob.glob(d_pickle + "%s[0-9]*_[0-9]*.dat" % baseName):
+        os.remove(f)
 
 def sparse_max_row(csr_mat):
     ret = np.zeros(csr_mat.shape[0])
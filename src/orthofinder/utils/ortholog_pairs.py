@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 David Emms
+#
+# This program (OrthoFinder) is distributed under the terms of the GNU General Public License v3
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  When publishing work that uses OrthoFinder please cite:
+#      Emms, D.M. and Kelly, S. (2015) OrthoFinder: solving fundamental biases in whole genome comparisons dramatically
+#      improves orthogroup inference accuracy, Genome Biology 16:157
+#
+# For any enquiries send an email to David Emms
+# david_emms@hotmail.com
+"""
+Pairwise orthologs as integer gene-ID pairs
+-------------------------------------------------------------------------------
+An alternative to the pairwise ortholog TSV files (--ortholog-pairs). Each
+ortholog relation is stored once as a pair of sequence IDs and accessions are
+only looked up when the pairs are exported. The directory holds one column per
+.npy file, each of which can be memory-mapped:
+    og.npy      - orthogroup of each pair
+    row.npy     - the row of the TSV files the pair belongs to
+    gene0.npy   - sequence ID of the gene from the first species of the pair
+    gene1.npy   - sequence ID of the gene from the second species of the pair
+    index.npy   - the pairs for species i < j are [index[i*n+j], index[i*n+j+1])
+Species.tsv gives the species name for each index i and Sequences.tsv the
+accession for each (i, sequence ID). Within each species pair the pairs are
+in the order the rows would be written to the TSV files.
+
+To write the species-pair TSV files:
+python -m orthofinder.utils.ortholog_pairs Orthologues/Ortholog_Pairs/ output_directory
+"""
+import os
+import csv
+import sys
+import gzip
+import argparse
+
+import numpy as np
+
+from . import parallel_task_manager  # noqa: F401, imported before util
+from . import util
+
+dir_name = "Ortholog_Pairs/"
+columns = ("og", "row", "gene0", "gene1")
+pair_dtype = np.dtype([("partition", np.int32), ("og", np.int32), ("row", np.int64), ("gene0", np.int32), ("gene1", np.int32)])
+chunk_size = 2**22
+
+
+def GetPairsArray(rows, nspecies):
+    """
+    Args:
+        rows - list of (iog, i0, i1, genes0, genes1) for the rows of the ortholog
+               files, where i0, i1 are species indices and genes0, genes1 lists
+               of sequence ID strings
+        nspecies - number of species in the analysis
+    Returns:
+        pairs - structured array of pair_dtype, the rows numbered from 0
+    """
+    n = sum(len(genes0) * len(genes1) for _, _, _, genes0, genes1 in rows)
+    pairs = np.zeros(n, dtype=pair_dtype)
+    k = 0
+    for irow, (iog, i0, i1, genes0, genes1) in enumerate(rows):
+        if i0 > i1:
+            i0, i1, genes0, genes1 = i1, i0, genes1, genes0
+        n0 = len(genes0)
+        n1 = len(genes1)
+        m = k + n0 * n1
+        pairs["partition"][k:m] = i0 * nspecies + i1
+        pairs["og"][k:m] = iog
+        pairs["row"][k:m] = irow
+        pairs["gene0"][k:m] = np.repeat(np.array(genes0, dtype=np.int32), n1)
+        pairs["gene1"][k:m] = np.tile(np.array(genes1, dtype=np.int32), n0)
+        k = m
+    return pairs
+
+
+class OrthologPairsWriter(object):
+    """
+    Collects the pairs in the order they are written, in a temporary file, and
+    sorts them by species pair in Finalise
+    """
+    def __init__(self, directory, speciesToUse):
+        """
+        Args:
+            directory - the Orthologues results directory
+            speciesToUse - the species IDs, in the order of the species indices
+        """
+        self.d = directory + dir_name
+        if not os.path.exists(self.d):
+            os.mkdir(self.d)
+        self.speciesToUse = speciesToUse
+        self.nspecies = len(speciesToUse)
+        self.temp_fn = self.d + "pairs.tmp"
+        self.temp_file = open(self.temp_fn, "wb")
+        self.nRows = 0
+
+    def Write(self, pairs):
+        """
+        Args:
+            pairs - array from GetPairsArray
+        """
+        if len(pairs) == 0:
+            return
+        pairs["row"] += self.nRows
+        self.nRows = int(pairs["row"][-1]) + 1
+        self.temp_file.write(pairs.tobytes())
+
+    def Finalise(self, speciesDict, sequenceDict):
+        """
+        Write the column files, sorted by species pair, and the tables used to
+        look up the names
+        """
+        self.temp_file.close()
+        n = self.nspecies
+        nPairs = os.path.getsize(self.temp_fn) // pair_dtype.itemsize
+        pairs = np.memmap(self.temp_fn, dtype=pair_dtype, mode="r") if nPairs > 0 else np.zeros(0, dtype=pair_dtype)
+        counts = np.zeros(n * n, dtype=np.int64)
+        for start in range(0, nPairs, chunk_size):
+            counts += np.bincount(pairs["partition"][start:start + chunk_size], minlength=n * n)
+        index = np.zeros(n * n + 1, dtype=np.int64)
+        np.cumsum(counts, out=index[1:])
+        np.save(self.d + "index.npy", index)
+        if nPairs == 0:
+            for col in columns:
+                np.save(self.d + col + ".npy", np.zeros(0, dtype=pair_dtype[col]))
+        else:
+            out = {col: np.lib.format.open_memmap(self.d + col + ".npy", mode="w+", dtype=pair_dtype[col], shape=(nPairs,)) for col in columns}
+            # scatter each chunk to the next free positions for its species pairs, keeping the order
+            next_free = index[:-1].copy()
+            for start in range(0, nPairs, chunk_size):
+                chunk = np.array(pairs[start:start + chunk_size])
+                order = np.argsort(chunk["partition"], kind="stable")
+                p = chunk["partition"][order]
+                rank = np.arange(len(p)) - np.searchsorted(p, p, side="left")
+                positions = next_free[p] + rank
+                for col in columns:
+                    out[col][positions] = chunk[col][order]
+                next_free += np.bincount(p, minlength=n * n)
+            for col in columns:
+                out[col].flush()
+            del out
+        del pairs
+        os.remove(self.temp_fn)
+        sp_to_index = {str(sp): i for i, sp in enumerate(self.speciesToUse)}
+        with open(self.d + "Species.tsv", util.csv_write_mode) as outfile:
+            for i, sp in enumerate(self.speciesToUse):
+                util.writerow(outfile, (i, speciesDict[str(sp)]))
+        with open(self.d + "Sequences.tsv", util.csv_write_mode) as outfile:
+            for seq_id, accession in sequenceDict.items():
+                sp, iseq = seq_id.split("_")
+                if sp in sp_to_index:
+                    util.writerow(outfile, (sp_to_index[sp], iseq, accession))
+
+
+class OrthologPairs(object):
+    """ Read access to the directory written by OrthologPairsWriter """
+    def __init__(self, d):
+        if not d.endswith("/"):
+            d += "/"
+        self.index = np.load(d + "index.npy")
+        self.cols = {col: np.load(d + col + ".npy", mmap_mode="r") for col in columns}
+        with open(d + "Species.tsv", util.csv_read_mode) as infile:
+            self.species = [row[1] for row in csv.reader(infile, delimiter="\t")]
+        self.nspecies = len(self.species)
+        self.d = d
+
+    def Pairs(self, i, j):
+        """
+        Args:
+            i, j - species indices, i != j
+        Returns:
+            og, row, genes_i, genes_j - arrays, with the genes from species i and j
+        """
+        i0, i1 = (i, j) if i < j else (j, i)
+        p = i0 * self.nspecies + i1
+        start, end = self.index[p], self.index[p + 1]
+        og, row, gene0, gene1 = [self.cols[col][start:end] for col in columns]
+        return (og, row, gene0, gene1) if i < j else (og, row, gene1, gene0)
+
+    def Accessions(self):
+        """
+        Returns:
+            accessions - list, for each species, of dict: sequence ID -> accession
+        """
+        accessions = [dict() for _ in range(self.nspecies)]
+        with open(self.d + "Sequences.tsv", util.csv_read_mode) as infile:
+            for i, iseq, acc in csv.reader(infile, delimiter="\t"):
+                accessions[int(i)][int(iseq)] = acc
+        return accessions
+
+
+def GetRows(og, row, genes_i, genes_j):
+    """
+    Returns:
+        Iterator over (iog, genes_i, genes_j) for each row, the genes in order
+    """
+    if len(row) == 0:
+        return
+    row = np.asarray(row)
+    starts = np.flatnonzero(np.diff(row)) + 1
+    bounds = [0] + starts.tolist() + [len(row)]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        yield int(og[start]), list(dict.fromkeys(genes_i[start:end].tolist())), list(dict.fromkeys(genes_j[start:end].tolist()))
+
+
+def export_ortholog_files(d_pairs, d_out, q_compress=False):
+    """
+    Write the species-pair ortholog files, Orthologues_<sp0>/<sp0>__v__<sp1>.tsv,
+    in the same format as an analysis without --ortholog-pairs
+    """
+    if not d_out.endswith("/"):
+        d_out += "/"
+    if not os.path.exists(d_out):
+        os.mkdir(d_out)
+    pairs = OrthologPairs(d_pairs)
+    accessions = pairs.Accessions()
+    species = pairs.species
+    for i, sp0 in enumerate(species):
+        d = d_out + "Orthologues_" + sp0 + "/"
+        if not os.path.exists(d):
+            os.mkdir(d)
+        for j, sp1 in enumerate(species):
+            if i == j:
+                continue
+            fn = d + '%s__v__%s.tsv' % (sp0, sp1)
+            with gzip.open(fn + ".gz", util.csv_write_mode) if q_compress else open(fn, util.csv_write_mode) as outfile:
+                writer = csv.writer(outfile, delimiter="\t")
+                writer.writerow(("Orthogroup", sp0, sp1))
+                acc0 = accessions[i]
+                acc1 = accessions[j]
+                for iog, genes0, genes1 in GetRows(*pairs.Pairs(i, j)):
+                    writer.writerow(("OG%07d" % iog, ", ".join([acc0[g] for g in genes0]), ", ".join([acc1[g] for g in genes1])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pairs_directory", help="Ortholog_Pairs directory from an OrthoFinder analysis run with --ortholog-pairs")
+    parser.add_argument("output_directory", help="Directory for the ortholog files")
+    parser.add_argument("-c", "--compress", action="store_true", help="Compress output files")
+    args = parser.parse_args()
+    if not os.path.exists(args.pairs_directory):
+        print("Directory not found: %s" % args.pairs_directory)
+        sys.exit(1)
+    export_ortholog_files(args.pairs_directory, args.output_directory, q_compress=args.compress)
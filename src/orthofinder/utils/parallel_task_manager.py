@@ -28,6 +28,7 @@ import sys
 import platform
 import time
 import types
+import warnings
 import datetime
 import traceback
 import subprocess
@@ -147,29 +148,6 @@ def ManageQueue(runningProcesses, cmd_queue):
         Fail()
 
 
-def ManageQueueNew(processes, result_queue, progress_bar, task, update_cycle):
-    while processes:
-        for i, proc in enumerate(processes[:]):
-            if not proc.is_alive():
-                proc.join()
-                processes.remove(proc)
-                
-                try:
-                    ijob, result = result_queue.get(True, 0.1)
-                    if result != "success":
-                        for p in processes:
-                            p.terminate()
-                        printer.print(f"ERROR: Error processing job {ijob}", style="error")
-                        util.Fail()
-                except queue.Empty:
-                    if not processes:
-                        break
-                if (i + 1) % update_cycle == 0:
-                    progress_bar.update(task, advance=update_cycle)
-
-        time.sleep(0.1)
-    
-
 # not used
 def RunCommand_Simple(command):
     subprocess.call(command, env=my_env, shell=True)
@@ -347,7 +325,10 @@ def Worker_RunMethod(Function, args_queue):
 #     ManageQueue(runningProcesses, args_queue)
 
 def RunMethodParallel(Function, args_queue,  nProcesses, task_size, old_version=False):
-
+    """
+    Call Function(*args) for each of the task_size args in args_queue, using the
+    persistent worker pool unless old_version
+    """
     if old_version:
         runningProcesses = [
             mp.Process(target=Worker_RunMethod, args=(Function, args_queue))
@@ -357,27 +338,122 @@ def RunMethodParallel(Function, args_queue,  nProcesses, task_size, old_version=
             proc.start()
         ManageQueue(runningProcesses, args_queue)
     else:
-        visible = True
-        if Function.__name__ == "Worker_SortFile":
-            visible = False
-        method_progress, task = util.get_progressbar(task_size, visible=visible)
-        update_cycle = 1
-
+        args_list = [args_queue.get() for _ in range(task_size)]
+        method_progress, task = util.get_progressbar(task_size)
         method_progress.start()
-        result_queue = mp.Queue()
-        runningProcesses = []
+        pool = ParallelTaskManager_singleton().GetWorkerPool(nProcesses)
+        pool.Map(Function, args_list, method_progress, task, nParallel=nProcesses)
+        method_progress.stop()
+
+
+def Worker_Pool(stage_queue, task_queue, result_queue):
+    """
+    A process of a WorkerPool. Waits for the function for the next stage, then
+    calls it for each (i, args) task until it receives None
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        while True:
+            func = stage_queue.get()
+            if func is None:
+                return
+            while True:
+                task = task_queue.get()
+                if task is None:
+                    result_queue.put(None)  # acknowledge the end of the stage
+                    break
+                i, args = task
+                try:
+                    result_queue.put((i, func(*args), None))
+                except Exception:
+                    result_queue.put((i, None, traceback.format_exc()))
+
 
-        while not args_queue.empty():
-            args = args_queue.get()
-            proc = mp.Process(target=Function, args=(*args, result_queue))
-            runningProcesses.append(proc)
+class WorkerPool(object):
+    """
+    Worker processes that are reused for each parallel stage of the analysis, 
+    rather than forking a new process for each task. Each is a fork of the parent 
+    so they should be created as early as possible, while the parent is small, 
+    see ParallelTaskManager_singleton.GetWorkerPool.
+    
+    Arguments common to all the tasks of a stage (e.g. seqsInfo) can be bound to 
+    the function with functools.partial, they are then sent once to each worker 
+    rather than with every task.
+    """
+    def __init__(self, nProcesses):
+        self.nProcesses = nProcesses
+        self.stage_queues = [mp.Queue() for _ in range(nProcesses)]
+        self.task_queue = mp.Queue()
+        self.result_queue = mp.Queue()
+        self.processes = [
+            mp.Process(target=Worker_Pool, args=(q, self.task_queue, self.result_queue), daemon=True)
+            for q in self.stage_queues
+        ]
+        for proc in self.processes:
             proc.start()
 
-            if len(runningProcesses) >= nProcesses:
-                ManageQueueNew(runningProcesses, result_queue, method_progress, task, update_cycle)
+    def GetResult(self):
+        while True:
+            try:
+                return self.result_queue.get(True, 1.)
+            except queue.Empty:
+                # a worker killed by the OS (e.g. out of memory) can't report an error itself
+                if not all(proc.is_alive() for proc in self.processes):
+                    printer.print("ERROR: A parallel worker process exited unexpectedly", style="error")
+                    util.Fail()
 
-        ManageQueueNew(runningProcesses, result_queue, method_progress, task, update_cycle)
-        method_progress.stop()
+    def Map(self, func, args_list, progress_bar=None, task=None, nParallel=None):
+        """
+        Args:
+            func - function to call, must be picklable
+            args_list - list of tuples of arguments, one per task
+            progress_bar, task - optional progress bar from util.get_progressbar
+            nParallel - maximum number of tasks to run at once, default all the 
+            processes of the pool
+        Returns:
+            results - list of the return values of func, in the order of args_list
+        Implementation:
+            At most 2*nProcesses tasks are queued at a time (nParallel if that is 
+            fewer than nProcesses), the parent then blocks until a result arrives 
+            before sending the next one. If any task raises an exception its 
+            traceback is printed and the analysis fails.
+        """
+        for q in self.stage_queues:
+            q.put(func)
+        n_tasks = len(args_list)
+        results = [None for _ in range(n_tasks)]
+        n_sent = 0
+        n_done = 0
+        if nParallel is None or nParallel >= self.nProcesses:
+            max_pending = 2 * self.nProcesses
+        else:
+            max_pending = max(1, nParallel)
+        while n_done < n_tasks:
+            while n_sent < n_tasks and n_sent - n_done < max_pending:
+                self.task_queue.put((n_sent, args_list[n_sent]))
+                n_sent += 1
+            i, result, error = self.GetResult()
+            if error is not None:
+                print(error, flush=True)
+                printer.print(f"ERROR: Error processing job {i}", style="error")
+                util.Fail()
+            results[i] = result
+            n_done += 1
+            if progress_bar is not None:
+                progress_bar.update(task, advance=1)
+        for _ in self.processes:
+            self.task_queue.put(None)
+        for _ in self.processes:
+            self.GetResult()
+        return results
+
+    def Stop(self):
+        for q in self.stage_queues:
+            q.put(None)
+        for proc in self.processes:
+            proc.join(1.)
+            if proc.is_alive():
+                proc.terminate()    # still running a task, e.g. stopping after an error in another task
 
 def _I_Spawn_Processes(message_to_spawner, message_to_PTM):
     """
@@ -453,6 +529,7 @@ class ParallelTaskManager_singleton:
                 args=(self.message_to_spawner, self.message_to_PTM),
             )
             self.manager_process.start()
+            self.worker_pool = None
 
     instance = None
 
@@ -479,8 +556,25 @@ class ParallelTaskManager_singleton:
                 pass
             time.sleep(1)
 
+    def GetWorkerPool(self, nProcesses):
+        """
+        Returns:
+            worker_pool - WorkerPool with nProcesses processes, started on the first 
+            request, ideally straight after the options have been read
+        Implementation:
+            The pool is never re-forked from the (by then larger) parent, later 
+            requests get the existing pool whatever its size. A stage that should use 
+            fewer processes passes nParallel to WorkerPool.Map instead.
+        """
+        if self.instance.worker_pool is None:
+            self.instance.worker_pool = WorkerPool(nProcesses)
+        return self.instance.worker_pool
+
     def Stop(self):
         """Warning, cannot be restarted"""
+        if self.instance.worker_pool is not None and mp.current_process().name == "MainProcess":
+            self.instance.worker_pool.Stop()
+            self.instance.worker_pool = None
         self.instance.message_to_spawner.put(None)
         self.instance.manager_process.join()
 
@@ -30,6 +30,7 @@ import json
 import numpy as np
 import subprocess
 # from .. import my_env
+import time
 import types
 import traceback
 
@@ -38,15 +39,13 @@ try:
 except ImportError:
     import Queue as queue
 
-from . import util, parallel_task_manager
+from . import util, parallel_task_manager, command_scheduler
 from .util import printer
 try:
     from rich import print
 except ImportError:
     ...
 
-import multiprocessing as mp
-
 
 # try:
 #     longer_file = impresources.files(test_sequences) / "longer.txt"
@@ -97,6 +96,14 @@ class InvalidEntryException(Exception):
     pass
 
 
+class StepFailedException(Exception):
+    """
+    Raised by a python function step of a task run by RunParallelCommandsAndMoveResultsFile when the run can't
+    continue without its output. The call then fails rather than the exception being reported as a warning.
+    """
+    pass
+
+
 class Method(object):
     def __init__(self, name, config_dict):
         self.skip_check = False
@@ -882,6 +889,7 @@ def RunParallelCommands(
     q_print_on_error=False,
     q_always_print_stderr=False,
     old_version=False,
+    dependencies=None,
 ):
 
     if qListOfList:
@@ -904,6 +912,7 @@ def RunParallelCommands(
         q_print_on_error,
         q_always_print_stderr,
         old_version,
+        dependencies,
     )
 
 
@@ -954,6 +963,7 @@ def RunParallelCommandsAndMoveResultsFile(
     q_print_on_error=False,
     q_always_print_stderr=False,
     old_version=False,
+    dependencies=None,
 ):
     """
     Calls the commands in parallel and if required moves the results file to the required new filename
@@ -967,152 +977,136 @@ def RunParallelCommandsAndMoveResultsFile(
         qListOfList - if False then commands_and_filenames is a list of (cmd, actual_target_fn) tuples
                       if True then commands_and_filenames is a list of lists of (cmd, actual_target_fn) tuples where the elements
                       of the inner list need to be run in the order they appear.
+        method_threads, method_threads_large, method_threads_small, threshold, cmd_order, tasksize - see
+                      command_scheduler.CommandScheduler
         q_print_on_error - If error code returend print stdout & stederr
+        dependencies - optional list, for each element of commands_and_filenames, of the indices of the elements
+                      that must have finished before it is started
     """
     if old_version:
         print("\n*** You are running David's version of Multiprocessing ***\n")
-        cmd_queue = queue.Queue()
-        i = -1
-        for i, cmd in enumerate(commands_and_filenames):
-            # print(cmd)
-            cmd_queue.put((i, cmd))
-
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = [
-                executor.submit(
-                    parallel_task_manager.Worker_RunCommands_And_Move,
-                    cmd_queue,
-                    nProcesses,
-                    i + 1,
-                    qListOfList,
-                    q_print_on_error,
-                    q_always_print_stderr=q_always_print_stderr,
-                )
-                for _ in range(nProcesses)
-            ]
-        concurrent.futures.wait(futures)
+        if dependencies is None:
+            levels = [list(range(len(commands_and_filenames)))]
+        else:
+            levels = command_scheduler.GetDependencyLevels(dependencies)
+        for level in levels:
+            cmd_queue = queue.Queue()
+            i = -1
+            for i, j in enumerate(level):
+                # print(cmd)
+                cmd_queue.put((i, commands_and_filenames[j]))
+
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                futures = [
+                    executor.submit(
+                        parallel_task_manager.Worker_RunCommands_And_Move,
+                        cmd_queue,
+                        nProcesses,
+                        i + 1,
+                        qListOfList,
+                        q_print_on_error,
+                        q_always_print_stderr=q_always_print_stderr,
+                    )
+                    for _ in range(nProcesses)
+                ]
+            concurrent.futures.wait(futures)
 
     else:
-        total_commands = len(commands_and_filenames)
-        if method_threads is None:
-            method_threads = "1"
-
-        if method_threads is not None:
-            if nProcesses * int(method_threads) > mp.cpu_count():
-                nProcesses = mp.cpu_count() // int(method_threads)
-
+        i_tasks = [i for i, cmd in enumerate(commands_and_filenames) if cmd is not None]
         if not qListOfList:
-            if "METHODTHREAD" in commands_and_filenames[0][0]:
-                commands_and_filenames = [
-                    (cmd[0].replace("METHODTHREAD", method_threads), cmd[1])
-                    for cmd in commands_and_filenames
-                ]
-
+            tasks = [[commands_and_filenames[i]] for i in i_tasks]
         else:
-            if "METHODTHREAD" in commands_and_filenames[0][0][0]:
-                if qTrim:
-                    commands_and_filenames = [
-                        (
-                            [
-                                (
-                                    cmd[0][0].replace(
-                                        "METHODTHREAD", method_threads
-                                    ),
-                                    cmd[0][1],
-                                ),
-                                (
-                                    cmd[1][0],
-                                    cmd[1][1].replace(
-                                        "METHODTHREAD", method_threads
-                                    ),
-                                ),
-                                (
-                                    cmd[2][0].replace(
-                                        "METHODTHREAD", method_threads
-                                    ),
-                                    cmd[2][1],
-                                ),
-                            ]
-                            if len(cmd) > 1
-                            else [
-                                (
-                                    cmd[0][0].replace(
-                                        "METHODTHREAD", method_threads
-                                    ),
-                                    cmd[0][1],
-                                )
-                            ]
-                        )
-                        for cmd in commands_and_filenames
-                    ]
-
-                else:
-                    commands_and_filenames = [
-                        [
-                            (
-                                cmd[0][0].replace("METHODTHREAD", method_threads),
-                                cmd[0][1],
-                            ),
-                            (
-                                cmd[1][0].replace("METHODTHREAD", method_threads),
-                                cmd[1][1],
-                            ),
-                        ]
-                        for cmd in commands_and_filenames
-                    ]
-        progressbar, task = util.get_progressbar(total_commands)
+            tasks = [list(commands_and_filenames[i]) for i in i_tasks]
+        if len(tasks) == 0:
+            return
+        if dependencies is not None:
+            index = {i: k for k, i in enumerate(i_tasks)}
+            dependencies = [[index[j] for j in dependencies[i] if j in index] for i in i_tasks]
+        scheduler = command_scheduler.CommandScheduler(
+            tasks,
+            nProcesses,
+            method_threads="1" if method_threads is None else method_threads,
+            method_threads_large=method_threads_large,
+            method_threads_small=method_threads_small,
+            threshold=threshold,
+            cmd_order=cmd_order,
+            tasksize=tasksize,
+            dependencies=dependencies,
+        )
+        progressbar, task = util.get_progressbar(len(tasks))
         progressbar.start()
-        update_cycle = 1 #10 if total_commands <= 200 else 100 if total_commands <= 2000 else 1000
-
-        with concurrent.futures.ThreadPoolExecutor(
-            max_workers=nProcesses
-        ) as executor:
-            futures = {
-                executor.submit(
-                    Worker_RunCommands_And_Move,
-                    cmd,
-                    qListOfList,
-                    q_print_on_error,
-                    q_always_print_stderr,
-                ): cmd
-                for cmd in commands_and_filenames
-                if cmd is not None
-            }
 
-            for i, future in enumerate(concurrent.futures.as_completed(futures)):
-                try:
-                    result = future.result()
-                    # completed_count += 1
-                    # if (
-                    #     divmod(
-                    #         completed_count,
-                    #         (
-                    #             10
-                    #             if total_commands <= 200
-                    #             else 100 if total_commands <= 2000 else 1000
-                    #         ),
-                    #     )[1]
-                    #     == 0
-                    # ):
-                    #     util.PrintTime(
-                    #         "Done %d of %d" % (completed_count, total_commands)
-                    #     )
-
-                    if result != 0 and q_print_on_error:
-                        print(f"ERROR occurred with command: {futures[future]}")
-                except Exception as e:
-                    print(f"Exception with command {futures[future]}: {e}")
-
-                finally:
-                    if (i + 1) % update_cycle == 0:
-                        progressbar.update(task, advance=update_cycle)
+        # Start the tasks in order, each once it is ready and there are enough free cores for it. If a step fails
+        # with a StepFailedException no more tasks are started and, once the running ones have finished, the run fails
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=scheduler.nProcesses
+            ) as executor:
+                nFree = scheduler.nCores
+                running = dict()
+                nStarted = 0
+                while nStarted < len(tasks):
+                    i, cmd, threads = scheduler.Next()
+                    if i is None or len(running) == scheduler.nProcesses or threads > nFree:
+                        nFree += Wait_RunCommands_And_Move(running, scheduler, q_print_on_error, progressbar, task)
+                        continue
+                    scheduler.Start(i)
+                    nStarted += 1
+                    step_times = []
+                    future = executor.submit(
+                        Worker_RunCommands_And_Move,
+                        cmd,
+                        True,
+                        q_print_on_error,
+                        q_always_print_stderr,
+                        step_times,
+                    )
+                    running[future] = (i, cmd if qListOfList else cmd[0], threads, step_times)
+                    nFree -= threads
+                while running:
+                    Wait_RunCommands_And_Move(running, scheduler, q_print_on_error, progressbar, task)
+        except StepFailedException as e:
+            progressbar.stop()
+            print("ERROR: %s" % e)
+            util.Fail()
         progressbar.stop()
+        scheduler.Save()
+
+
+def Wait_RunCommands_And_Move(running, scheduler, q_print_on_error, progressbar, task):
+    """
+    Wait for at least one of the running tasks to finish. The tasks that depended on them become ready. A
+    StepFailedException from a task is raised again
+    Args:
+        running - dict: future -> (i, cmd, threads, step_times), the finished tasks are removed
+    Returns:
+        nFreed - the number of cores the finished tasks were using
+    """
+    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+    nFreed = 0
+    for future in done:
+        i, cmd, threads, step_times = running.pop(future)
+        nFreed += threads
+        scheduler.Finished(i)
+        try:
+            result = future.result()
+            if result != 0 and q_print_on_error:
+                print(f"ERROR occurred with command: {cmd}")
+            scheduler.RecordRuntimes(i, step_times)
+        except StepFailedException:
+            raise
+        except Exception as e:
+            print(f"Exception with command {cmd}: {e}")
+        finally:
+            progressbar.update(task, advance=1)
+    return nFreed
+
 
 q_print_first_traceback_0 = False
 
 
 def Worker_RunCommands_And_Move(
-    command_fns_list, qListOfLists, q_print_on_error, q_always_print_stderr
+    command_fns_list, qListOfLists, q_print_on_error, q_always_print_stderr, step_times=None
 ):
     """
     Continuously takes commands that need to be run from the cmd_and_filename_queue until the queue is empty. If required, moves
@@ -1126,6 +1120,8 @@ def Worker_RunCommands_And_Move(
         nToDo - The total number of elements in the original queue
         qListOfLists - Boolean, whether each element of the queue corresponds to a single command or a list of ordered commands
         qShell - Boolean, should a shell be used to run the command.
+        step_times - optional list, (cmd, seconds) is appended for each command that completes successfully
+        A StepFailedException from a python function step is raised, any other exception is reported as a warning
 
     Implementation:
         nProcesses and nToDo are used to print out the progress.
@@ -1152,11 +1148,14 @@ def Worker_RunCommands_And_Move(
                     print("ERROR: Cannot run command: " + str(command))
                     print("Please report this issue.")
                 else:
+                    start = time.time()
                     return_code = RunCommand(
                         command,
                         qPrintOnError=q_print_on_error,
                         qPrintStderr=q_always_print_stderr,
                     )
+                    if step_times is not None and return_code == 0:
+                        step_times.append((command, time.time() - start))
                     if fns != None:
                         actual, target = fns
                         if os.path.exists(actual):
@@ -1164,6 +1163,8 @@ def Worker_RunCommands_And_Move(
         return return_code
     # except queue.Empty:
     #     return
+    except StepFailedException:
+        raise
     except Exception as e:
         print("WARNING: ")
         print(str(e))
@@ -30,7 +30,7 @@ import numpy as np
 import datetime
 from collections import namedtuple
 from ..citation import citation
-from ..tools import tree
+from ..tools import tree, newick
 from . import parallel_task_manager
 import shutil
 import traceback
@@ -528,11 +528,8 @@ def RenameTreeTaxa(
         else:
             qHaveSupport = False
             if inFormat == None:
-                try:
-                    t = tree.Tree(treeFN_or_tree, format=2)
-                    qHaveSupport = True
-                except:
-                    t = tree.Tree(treeFN_or_tree)
+                t, treeFormat = newick.read_newick_first_format(treeFN_or_tree, (2, 0))
+                qHaveSupport = treeFormat == 2
             else:
                 t = tree.Tree(treeFN_or_tree, format=inFormat)
         for node in t.get_leaves():
@@ -703,33 +700,6 @@ class nOrtho_sp(object):
         return self
 
 
-class nOrtho_cache(object):
-    """matrix of approx number of unwritten cached orthologs"""
-
-    def __init__(self, nSp):
-        self.n = np.zeros((nSp, nSp))
-
-    def __iadd__(self, nOrtho_sp_obj):
-        self.n += nOrtho_sp_obj.n
-        return self
-
-    def get_i_j_to_write(self, n_max_cache, fewer_open_files=False):
-        if fewer_open_files:
-            # all genes for species i are collated
-            IJ = np.where(self.n.sum(axis=1) > n_max_cache)
-            I = list(IJ[0])
-            J = None
-            for i in I:
-                self.n[i, :] = 0
-        else:
-            IJ = np.where(self.n > n_max_cache)
-            I = list(IJ[0])
-            J = list(IJ[1])
-            for i, j in zip(I, J):
-                self.n[i, j] = 0
-        return I, J
-
-
 class Finalise(object):
     def __enter__(self):
         pass
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Test the package in src/ rather than an installed copy, or orthofinder.py in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from orthofinder.utils import parallel_task_manager  # noqa: E402, F401, imported before util
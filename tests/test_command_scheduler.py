@@ -0,0 +1,68 @@
+import pytest
+
+from orthofinder.utils import command_scheduler
+from orthofinder.utils.command_scheduler import CommandScheduler
+
+
+def Task(name, threads=True):
+    return [("prog %s%s > %s.out" % (name, " -t METHODTHREAD" if threads else "", name), None)]
+
+
+def RunOrder(scheduler):
+    """ Start each task as soon as it is ready, finishing the earliest started first """
+    order = []
+    running = []
+    while True:
+        i, _, _ = scheduler.Next()
+        if i is None:
+            if not running:
+                return order
+            scheduler.Finished(running.pop(0))
+            continue
+        scheduler.Start(i)
+        order.append(i)
+        running.append(i)
+
+
+def test_dependency_order():
+    dependencies = [[1, 2], [], [1], [0]]
+    order = command_scheduler.GetDependencyOrder(dependencies)
+    assert sorted(order) == [0, 1, 2, 3]
+    position = {i: k for k, i in enumerate(order)}
+    for i, deps in enumerate(dependencies):
+        assert all(position[j] < position[i] for j in deps)
+
+
+def test_circular_dependencies():
+    with pytest.raises(Exception):
+        command_scheduler.GetDependencyOrder([[1], [2], [0]])
+
+
+def test_dependency_levels():
+    # each task runs in the last level before the tasks that depend on it
+    assert command_scheduler.GetDependencyLevels([[], [], [0], [2], []]) == [[0], [2], [1, 3, 4]]
+    assert command_scheduler.GetDependencyLevels([]) == []
+
+
+def test_order_by_size():
+    tasks = [Task(str(i)) for i in range(4)]
+    sizes = [10, 40, 20, 30]
+    assert RunOrder(CommandScheduler(tasks, 1, tasksize=sizes)) == [1, 3, 2, 0]
+    assert RunOrder(CommandScheduler(tasks, 1, tasksize=sizes, cmd_order="ascending")) == [0, 2, 3, 1]
+
+
+def test_dependencies():
+    # tasks 0 and 1 have a dependent, task 3, so are started before the larger task 2
+    tasks = [Task(str(i)) for i in range(4)]
+    scheduler = CommandScheduler(tasks, 1, tasksize=[1, 2, 100, 0], dependencies=[[], [], [], [0, 1]])
+    assert RunOrder(scheduler) == [1, 0, 2, 3]
+
+
+def test_threads():
+    tasks = [Task("a"), Task("b"), Task("c", threads=False)]
+    scheduler = CommandScheduler(tasks, 1, method_threads_large="4", method_threads_small="2",
+                                 threshold=50, tasksize=[100, 10, 1])
+    assert scheduler.threads == [min(4, scheduler.nCores), min(2, scheduler.nCores), 1]
+    i, task, threads = scheduler.Next()
+    assert i == 0
+    assert task == [("prog a -t %d > a.out" % threads, None)]
@@ -0,0 +1,39 @@
+import pytest
+
+from orthofinder.utils import program_caller
+from orthofinder.tools import trees_msa
+from orthofinder.orthogroups.orthogroups_set import Seq
+
+alignments = [
+    ">0_0\nAC-D\n>1_0\nA--D\n>2_0\n-CKD\n",
+    ">0_1\nMM\n>0_2\nM-\n>1_1\n-N\n>2_1\n*N\n",    # species 0 isn't single-copy
+    "",                                             # a failed alignment
+]
+ogs = [
+    [Seq((0, 0)), Seq((1, 0)), Seq((2, 0))],
+    [Seq((0, 1)), Seq((0, 2)), Seq((1, 1)), Seq((2, 1))],
+    [Seq((0, 3)), Seq((1, 3))],
+]
+
+
+@pytest.fixture
+def alignment_fn(tmp_path):
+    for iog, text in enumerate(alignments):
+        (tmp_path / ("OG%07d.fa" % iog)).write_text(text)
+    return lambda iog: str(tmp_path / ("OG%07d.fa" % iog))
+
+
+def test_concatenated_alignment(tmp_path, alignment_fn):
+    outfn = tmp_path / "concatenated.fa"
+    trees_msa.CreateConcatenatedAlignment([0, 1, 2], ogs, alignment_fn, str(outfn), 1.0)
+    # columns with more than 1.5 gaps are removed, species 0 is a row of gaps in OG0000001
+    assert outfn.read_text() == ">0\nACD-\n>1\nA-DN\n>2\n-CDN\n"
+    assert not (tmp_path / "concatenated.fa.tmp").exists()
+
+
+def test_all_alignments_empty(tmp_path, alignment_fn):
+    outfn = str(tmp_path / "concatenated.fa")
+    with pytest.raises(ValueError):
+        trees_msa.CreateConcatenatedAlignment([2], ogs, alignment_fn, outfn, 1.0)
+    with pytest.raises(program_caller.StepFailedException):
+        trees_msa.ConcatenatedAlignmentTask(([2], ogs, alignment_fn, outfn, 1.0))
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from orthofinder.utils import matrices
+
+
+class SeqsInfo(object):
+    nSpecies = 3
+
+
+def RandomMatrix(iSpecies, jSpecies, dtype=np.float64):
+    m = sparse.random(5 + iSpecies, 4 + jSpecies, density=0.4, format="csr", random_state=10 * iSpecies + jSpecies)
+    return m.astype(dtype)
+
+
+def Equal(a, b):
+    return a.shape == b.shape and a.dtype == b.dtype and (a != b).nnz == 0
+
+
+@pytest.fixture
+def d_pickle(tmp_path):
+    return str(tmp_path) + os.sep
+
+
+def test_round_trip(d_pickle):
+    ms = {(i, j): RandomMatrix(i, j) for i in range(3) for j in range(3)}
+    for i in range(3):
+        matrices.DumpMatrixArray("B", [ms[i, j] for j in range(3)], i, d_pickle)
+    for i in range(3):
+        assert Equal(matrices.LoadMatrix("B", i, 2, d_pickle), ms[i, 2])
+        for j, m in enumerate(matrices.LoadMatrixArray("B", SeqsInfo, i, d_pickle)):
+            assert Equal(m, ms[i, j])
+        for j, m in enumerate(matrices.LoadMatrixArray("B", SeqsInfo, i, d_pickle, row=False)):
+            assert Equal(m, ms[j, i])
+
+
+def test_dtypes_and_empty(d_pickle):
+    matrices.DumpMatrix("H", RandomMatrix(0, 0) > 0.5, 0, 0, d_pickle)
+    matrices.DumpMatrix("H", sparse.csr_matrix((3, 2), dtype=np.float32), 0, 1, d_pickle)
+    m = matrices.LoadMatrix("H", 0, 0, d_pickle)
+    assert m.dtype == np.bool_ and Equal(m, RandomMatrix(0, 0) > 0.5)
+    m = matrices.LoadMatrix("H", 0, 1, d_pickle)
+    assert m.shape == (3, 2) and m.nnz == 0 and m.dtype == np.float32
+
+
+def test_last_record_used(d_pickle):
+    matrices.DumpMatrix("B", RandomMatrix(0, 0), 0, 0, d_pickle)
+    matrices.DumpMatrix("B", RandomMatrix(1, 1), 0, 0, d_pickle)
+    assert Equal(matrices.LoadMatrix("B", 0, 0, d_pickle), RandomMatrix(1, 1))
+
+
+def test_missing_matrix(d_pickle):
+    matrices.DumpMatrix("B", RandomMatrix(0, 0), 0, 0, d_pickle)
+    with pytest.raises(KeyError):
+        matrices.LoadMatrix("B", 0, 1, d_pickle)
+    with pytest.raises(KeyError):
+        matrices.LoadMatrixArray("B", SeqsInfo, 0, d_pickle)
+
+
+def test_large_matrices_own_file(d_pickle, monkeypatch):
+    monkeypatch.setattr(matrices, "maxAppend", 200)
+    ms = {(i, j): RandomMatrix(i, j) for i in range(3) for j in range(3)}
+    ms[0, 1] = sparse.csr_matrix((5, 5))    # small enough for the shared file
+    for i in range(3):
+        matrices.DumpMatrixArray("B", [ms[i, j] for j in range(3)], i, d_pickle)
+    matrices.DumpMatrix("BH", RandomMatrix(2, 2), 0, 0, d_pickle)
+    assert os.path.exists(d_pickle + "B2_2.dat") and not os.path.exists(d_pickle + "B0_1.dat")
+    for i in range(3):
+        for j, m in enumerate(matrices.LoadMatrixArray("B", SeqsInfo, i, d_pickle, row=False)):
+            assert Equal(m, ms[j, i])
+    matrices.DeleteMatrices("B", d_pickle)
+    assert sorted(os.listdir(d_pickle)) == ["BH.idx", "BH0_0.dat"]
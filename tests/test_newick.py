@@ -0,0 +1,43 @@
+import pytest
+
+from orthofinder.tools import newick
+
+
+def test_first_format_support_values():
+    t, format = newick.read_newick_first_format("((A:1,B:2)0.9:0.5,C:1.5);", (2, 0, 3))
+    assert format == 2
+    assert [n.name for n in t.get_leaves()] == ["A", "B", "C"]
+    assert t.children[0].support == pytest.approx(0.9)
+    assert t.children[0].dist == pytest.approx(0.5)
+
+
+def test_first_format_node_names():
+    t, format = newick.read_newick_first_format("((A:1,B:2)N1:0.5,C:1.5)N0;", (2, 1))
+    assert format == 1
+    assert t.name == "N0"
+    assert t.children[0].name == "N1"
+    assert t.children[1].dist == pytest.approx(1.5)
+
+
+def test_no_format_matches():
+    with pytest.raises(newick.NewickError):
+        newick.read_newick_first_format("((A:1,B:2)N1:0.5,C:1.5)N0;", (2,))
+
+
+def test_round_trip():
+    nw = "((A:1,(B:2,D:0.25)N2:0.5)N1:0.5,C:1.5)N0;"
+    t = newick.read_newick(nw, format=1)
+    assert t.name == "N0"
+    assert newick.write_newick(t, format=1, format_root_node=False) == "((A:1,(B:2,D:0.25)N2:0.5)N1:0.5,C:1.5);"
+
+
+def test_single_node():
+    t = newick.read_newick("A;", format=1)
+    assert t.is_leaf() and t.name == "A"
+
+
+def test_file(tmp_path):
+    fn = tmp_path / "tree.txt"
+    fn.write_text("(A,(B,C));\n")
+    t = newick.read_newick(str(fn))
+    assert sorted(t.get_leaf_names()) == ["A", "B", "C"]
@@ -0,0 +1,48 @@
+import pytest
+from scipy import sparse
+
+from orthofinder.orthogroups.orthogroup_array import OrthogroupArray
+
+ogs = [["0_3", "1_0", "0_1"], ["2_5"], [], ["1_2", "1_7", "2_0", "0_4"]]
+
+
+def test_from_strings():
+    a = OrthogroupArray.FromStrings(ogs)
+    assert len(a) == 4
+    assert list(a) == ogs
+    assert a.Sizes().tolist() == [3, 1, 0, 4]
+    assert a.Species(3).tolist() == [1, 1, 2, 0]
+    assert a.Seqs(0).tolist() == [3, 0, 1]
+    assert a.OGIndices().tolist() == [0, 0, 0, 1, 3, 3, 3, 3]
+
+
+def test_invalid_ids():
+    with pytest.raises(ValueError):
+        OrthogroupArray.FromStrings([["0_1_2"]])
+
+
+def test_subset():
+    a = OrthogroupArray.FromStrings(ogs).Subset([3, 1, 0])
+    assert list(a) == [ogs[3], ogs[1], ogs[0]]
+
+
+def test_species_counts():
+    a = OrthogroupArray.FromStrings(ogs)
+    counts = a.SpeciesCounts()
+    assert sparse.issparse(counts)
+    assert counts.toarray().tolist() == [[2, 1, 0], [0, 0, 1], [0, 0, 0], [1, 2, 1]]
+    counts = a.SpeciesCounts([2, 0, 3])
+    assert counts.toarray().tolist() == [[0, 2, 0], [1, 0, 0], [0, 0, 0], [1, 1, 0]]
+
+
+def test_names():
+    a = OrthogroupArray.FromStrings(ogs[:2])
+    idDict = {g: "gene" + g for og in ogs for g in og}
+    assert a.Names(idDict) == ["gene0_3", "gene1_0", "gene0_1", "gene2_5"]
+
+
+def test_from_clusters_file(tmp_path):
+    fn = tmp_path / "clusters.txt"
+    fn.write_text("(mclheader\nmcltype matrix\ndimensions 5x2\n)\n(mclmatrix\nbegin\n"
+                  "0 0_1 1_0 $\n1 2_3\n 0_0 $\n)\n")
+    assert list(OrthogroupArray.FromClustersFile(str(fn))) == [["0_1", "1_0"], ["2_3", "0_0"]]
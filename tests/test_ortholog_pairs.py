@@ -0,0 +1,78 @@
+import os
+import csv
+
+import numpy as np
+
+from orthofinder.utils import ortholog_pairs
+
+speciesToUse = [0, 3, 4]
+speciesDict = {"0": "Apple", "3": "Bean", "4": "Corn"}
+# (iog, i0, i1, genes0, genes1), written in two batches
+batches = [
+    [(5, 0, 1, ["2", "7"], ["1"]), (5, 2, 0, ["3"], ["2"])],
+    [],
+    [(9, 1, 2, ["4"], ["0", "6"]), (12, 0, 1, ["0"], ["5"])],
+]
+
+
+def SequenceDict():
+    prefixes = {"0": "a", "3": "b", "4": "c"}
+    return {"%s_%d" % (sp, i): "%s%d" % (prefixes[sp], i) for sp in prefixes for i in range(8)}
+
+
+def ExpectedRows(i, j):
+    accessions = SequenceDict()
+    rows = []
+    for batch in batches:
+        for iog, i0, i1, genes0, genes1 in batch:
+            if (i0, i1) == (j, i):
+                i0, i1, genes0, genes1 = i1, i0, genes1, genes0
+            if (i0, i1) == (i, j):
+                rows.append(["OG%07d" % iog,
+                             ", ".join(accessions["%d_%s" % (speciesToUse[i], g)] for g in genes0),
+                             ", ".join(accessions["%d_%s" % (speciesToUse[j], g)] for g in genes1)])
+    return rows
+
+
+def WritePairs(d):
+    writer = ortholog_pairs.OrthologPairsWriter(d, speciesToUse)
+    for batch in batches:
+        writer.Write(ortholog_pairs.GetPairsArray(batch, len(speciesToUse)))
+    writer.Finalise(speciesDict, SequenceDict())
+    return d + ortholog_pairs.dir_name
+
+
+def test_pairs(tmp_path):
+    d_pairs = WritePairs(str(tmp_path) + os.sep)
+    assert not os.path.exists(d_pairs + "pairs.tmp")
+    pairs = ortholog_pairs.OrthologPairs(d_pairs)
+    assert pairs.species == ["Apple", "Bean", "Corn"]
+    og, row, genes_i, genes_j = pairs.Pairs(1, 0)
+    assert og.tolist() == [5, 5, 12]
+    assert genes_i.tolist() == [1, 1, 5]
+    assert genes_j.tolist() == [2, 7, 0]
+    assert len(np.unique(row)) == 2
+    assert pairs.Accessions()[2][6] == "c6"
+
+
+def test_export_round_trip(tmp_path):
+    d_pairs = WritePairs(str(tmp_path) + os.sep)
+    d_out = str(tmp_path / "Orthologues") + os.sep
+    ortholog_pairs.export_ortholog_files(d_pairs, d_out)
+    names = [speciesDict[str(sp)] for sp in speciesToUse]
+    for i, sp0 in enumerate(names):
+        for j, sp1 in enumerate(names):
+            if i == j:
+                continue
+            fn = d_out + "Orthologues_%s/%s__v__%s.tsv" % (sp0, sp0, sp1)
+            with open(fn) as infile:
+                rows = list(csv.reader(infile, delimiter="\t"))
+            assert rows[0] == ["Orthogroup", sp0, sp1]
+            assert rows[1:] == ExpectedRows(i, j)
+
+
+def test_no_pairs(tmp_path):
+    writer = ortholog_pairs.OrthologPairsWriter(str(tmp_path) + os.sep, speciesToUse)
+    writer.Finalise(speciesDict, SequenceDict())
+    pairs = ortholog_pairs.OrthologPairs(str(tmp_path / "Ortholog_Pairs"))
+    assert len(pairs.Pairs(0, 2)[0]) == 0
@@ -0,0 +1,47 @@
+import numpy as np
+
+from orthofinder.tools import phylip
+
+
+def Expected(m, names, max_og=None, q_zero_diagonal=False, q_sliver_all=False):
+    lines = ["%d" % len(names)]
+    for i, name in enumerate(names):
+        values = []
+        for j, v in enumerate(m[i]):
+            if q_zero_diagonal and i == j:
+                v = 0.
+            if max_og is not None and not v > -9e99:
+                v = max_og
+            v += 0.
+            if v < phylip.sliver and (q_sliver_all or v > 0):
+                v = phylip.sliver
+            values.append("%.6f" % v)
+        lines.append(name + " " + " ".join(values))
+    return "\n".join(lines) + "\n"
+
+
+def Matrix(n, seed):
+    rng = np.random.default_rng(seed)
+    m = rng.random((n, n)) * 3
+    m[0, 1:4] = [1e-8, 0.0000025, 2.5e-7]       # slivers and a rounding tie
+    m[1, :3] = [-0.5, -0., 12345678.9]
+    m[2, 0] = -np.inf
+    return m
+
+
+def test_write_distance_matrix(tmp_path):
+    m = Matrix(7, 0)
+    names = ["s%d" % i for i in range(len(m))]
+    fn = tmp_path / "m.phy"
+    phylip.WriteDistanceMatrix(m, names, str(fn), max_og=9.)
+    assert fn.read_text() == Expected(m, names, max_og=9.)
+
+
+def test_options_and_row_iterator(tmp_path, monkeypatch):
+    monkeypatch.setattr(phylip, "nRowsPerChunk", 3)
+    m = Matrix(8, 1)
+    m[2, 0] = 0.
+    names = ["species_%d" % i for i in range(len(m))]
+    fn = tmp_path / "m.phy"
+    phylip.WriteDistanceMatrix(iter(m.tolist()), names, str(fn), q_zero_diagonal=True, q_sliver_all=True)
+    assert fn.read_text() == Expected(m, names, q_zero_diagonal=True, q_sliver_all=True)
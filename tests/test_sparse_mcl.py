@@ -0,0 +1,124 @@
+import os
+import functools
+import subprocess
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from orthofinder import __location__
+from orthofinder.tools import sparse_mcl
+
+mcl_exe = os.path.join(__location__, "bin", "mcl")
+
+
+def MakeGraph(seed):
+    """
+    Dense groups of nodes joined by a few weak edges, plus small components, symmetric
+    """
+    rng = np.random.default_rng(seed)
+    sizes = [40, 25, 25, 12, 6, 3, 2, 1, 1]
+    rows, cols, values = [], [], []
+    groups = []
+    start = 0
+    for size in sizes:
+        nodes = np.arange(start, start + size)
+        groups.append(nodes)
+        for i in nodes:
+            for j in nodes:
+                if i < j and rng.random() < 0.6:
+                    rows.append(i)
+                    cols.append(j)
+                    values.append(rng.uniform(0.2, 1.))
+        start += size
+    for _ in range(6):
+        i = rng.choice(groups[rng.integers(0, 3)])
+        j = rng.choice(groups[rng.integers(0, 3)])
+        if i != j:
+            rows.append(i)
+            cols.append(j)
+            values.append(rng.uniform(0.01, 0.05))
+    W = sparse.csr_matrix((np.round(values, 3), (rows, cols)), shape=(start, start))
+    return (W + W.T).tocsr()
+
+
+def WriteGraph(W, fn):
+    n = W.shape[0]
+    with open(fn, "w") as outfile:
+        outfile.write("(mclheader\nmcltype matrix\ndimensions %dx%d\n)\n\n(mclmatrix\nbegin\n\n" % (n, n))
+        for i in range(n):
+            a, b = W.indptr[i], W.indptr[i + 1]
+            edges = "".join("%d:%.3f " % e for e in zip(W.indices[a:b].tolist(), W.data[a:b].tolist()))
+            outfile.write("%d    %s$\n" % (i, edges))
+        outfile.write(")\n")
+
+
+def ReadClusters(fn):
+    with open(fn) as infile:
+        body = infile.read().split("begin", 1)[1].rsplit(")", 1)[0]
+    return [frozenset(map(int, c.split()[1:])) for c in body.split("$") if c.split()]
+
+
+@pytest.mark.skipif(not os.access(mcl_exe, os.X_OK), reason="mcl binary not available")
+@pytest.mark.parametrize("seed", [0, 2, 3])
+@pytest.mark.parametrize("inflation", [1.2, 1.5])
+def test_clusters_equal_mcl_binary(tmp_path, seed, inflation):
+    W = MakeGraph(seed)
+    graphFN = str(tmp_path / "graph.txt")
+    clustersFN = str(tmp_path / "clusters.txt")
+    WriteGraph(W, graphFN)
+    subprocess.check_call([mcl_exe, graphFN, "-I", str(inflation), "-o", clustersFN, "-V", "all"])
+    expected = ReadClusters(clustersFN)
+    clusters = [frozenset(c.tolist()) for c in sparse_mcl.RunMCL(W, inflation)]
+    assert set(clusters) == set(expected)
+
+
+def test_small_components():
+    # a triangle, a pair and two isolated nodes
+    W = sparse.csr_matrix(([1., 1., 1., 1.], ([0, 1, 0, 3], [1, 2, 2, 4])), shape=(6, 6))
+    W = (W + W.T).tocsr()
+    clusters = [c.tolist() for c in sparse_mcl.RunMCL(W, 1.5)]
+    assert clusters == [[0, 1, 2], [3, 4], [5]]
+
+
+def test_batches_match_single_batch(monkeypatch):
+    W = MakeGraph(1)
+    single = [c.tolist() for c in sparse_mcl.RunMCL(W, 1.5)]
+    monkeypatch.setattr(sparse_mcl, "nNodesPerBatch", 4)
+    batched = [c.tolist() for c in sparse_mcl.RunMCL(W, 1.5)]
+    assert batched == single
+
+
+def GetRows(W, args):
+    seqsInfo, iSpec, d_pickle = args
+    starts = seqsInfo.seqStartingIndices + [seqsInfo.nSeqs]
+    return W[starts[iSpec]:starts[iSpec + 1]]
+
+
+@pytest.mark.skipif(not os.access(mcl_exe, os.X_OK), reason="mcl binary not available")
+def test_binary_batches_equal_mcl_binary(tmp_path, monkeypatch):
+    from orthofinder.orthogroups import gathering
+    from orthofinder.utils import parallel_task_manager, util
+    W = MakeGraph(2)
+    graphFN = str(tmp_path / "graph.txt")
+    clustersFN = str(tmp_path / "clusters.txt")
+    WriteGraph(W, graphFN)
+    subprocess.check_call([mcl_exe, graphFN, "-I", "1.5", "-o", clustersFN, "-V", "all"])
+    expected = ReadClusters(clustersFN)
+    monkeypatch.setattr(sparse_mcl, "nNodesPerBatch", 4)
+    seqStartingIndices = [0, 30, 70]
+    nSeqsPerSpecies = np.diff(seqStartingIndices + [W.shape[0]]).tolist()
+    seqsInfo = util.SequencesInfo(W.shape[0], 3, [0, 1, 2], seqStartingIndices, nSeqsPerSpecies)
+    d_pickle = str(tmp_path / "pickle") + os.sep
+    os.mkdir(d_pickle)
+    ptm = parallel_task_manager.ParallelTaskManager_singleton()
+    try:
+        clusters = gathering.RunMCLBatches(
+            functools.partial(GetRows, W), seqsInfo, str(tmp_path / "batches.txt"), d_pickle, 2, 1.5
+        )
+    finally:
+        ptm.Stop()
+        parallel_task_manager.ParallelTaskManager_singleton.instance = None
+    assert set(frozenset(c.tolist()) for c in clusters) == set(expected)
+    assert sorted(os.listdir(str(tmp_path))) == ["clusters.txt", "graph.txt", "pickle"]
+    assert os.listdir(d_pickle) == []
@@ -0,0 +1,46 @@
+import itertools
+
+import pytest
+
+from orthofinder.tools import tree
+from orthofinder.tools.tree_lca import TreeLCA
+
+newick = "((A,B)N2,(C,(D,E)N4,F)N3)N1;"
+
+
+@pytest.fixture
+def t():
+    return tree.Tree(newick, format=1)
+
+
+def test_mrca_matches_tree(t):
+    lca = TreeLCA(t)
+    names = [n.name for n in t.traverse()]
+    for k in (1, 2, 3):
+        for subset in itertools.combinations(names, k):
+            expected = t.get_common_ancestor(*subset) if k > 1 else t & subset[0]
+            assert lca.MRCA(subset) is expected
+
+
+def test_ancestors_and_descendants(t):
+    lca = TreeLCA(t)
+    assert lca.Ancestors("D") == ["N4", "N3", "N1"]
+    assert lca.Ancestors("N1") == []
+    assert lca.Descendants("N3") == ["C", "N4", "D", "E", "F"]
+    assert lca.Descendants("A") == []
+    assert lca.IsAncestor("N3", "E")
+    assert not lca.IsAncestor("E", "E")
+    assert not lca.IsAncestor("N2", "C")
+    assert lca.Node("N4") is t & "N4"
+
+
+def test_comparable_nodes(t):
+    higher, lower, comparable = TreeLCA(t).ComparableNodes()["N3"]
+    assert higher == {"N1"}
+    assert lower == {"C", "N4", "D", "E", "F"}
+    assert comparable == higher | lower | {"N3"}
+
+
+def test_unknown_name(t):
+    with pytest.raises(ValueError):
+        TreeLCA(t).MRCA(["A", "X"])
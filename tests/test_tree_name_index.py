@@ -0,0 +1,70 @@
+import pytest
+
+from orthofinder.tools import tree
+
+newick = "((A,B)N2,(C,(D,E)N4,F)N3)N1;"
+
+
+def IndexedTree():
+    t = tree.Tree(newick, format=1)
+    t.enable_name_index()
+    assert (t & "D").name == "D"
+    return t
+
+
+def test_other_trees_keep_their_index():
+    t = IndexedTree()
+    name2nodes = t._name_index[1]
+    other = tree.Tree(newick, format=1)
+    (other & "N4").detach()
+    other.set_outgroup(other & "A")
+    assert t._name_index == (True, name2nodes)
+    assert (t & "E") is name2nodes["E"][0]
+
+
+def test_edits_rebuild_the_index():
+    t = IndexedTree()
+    n4 = t & "N4"
+    n4.detach()
+    assert not t._name_index[0]
+    with pytest.raises(ValueError):
+        t & "D"
+    assert t.get_common_ancestor("A", "C") is t
+    (t & "N2").add_child(n4)
+    assert t.get_common_ancestor("A", "D").name == "N2"
+    (t & "N3").swap_children()
+    assert [n.name for n in (t & "N3").children] == ["F", "C"]
+
+
+def test_subtree_index_after_detach():
+    t = IndexedTree()
+    n3 = t & "N3"
+    n3.enable_name_index()
+    assert (n3 & "E").name == "E"
+    n3.detach()
+    (t & "N2").add_child(n3)
+    n4 = n3 & "N4"
+    n4.detach()
+    n3.detach()
+    assert not n3._name_index[0]
+    assert [n.name for n in n3.traverse()] == ["N3", "C", "F"]
+    with pytest.raises(ValueError):
+        n3 & "D"
+    assert (t & "A").up.name == "N2"
+
+
+def test_unindexed_edits_dont_walk_up(monkeypatch):
+    def Walk(self):
+        raise AssertionError("walked up an unindexed tree")
+    monkeypatch.setattr(tree.TreeNode, "_invalidate_name_index", Walk)
+    t = tree.Tree(newick, format=1)
+    n = t & "N4"
+    for i in range(5):
+        n.add_child(name="X%d" % i)
+        n = n.add_child()
+    t.set_outgroup(n)
+    (t & "N3").swap_children()
+    (t & "N2").detach()
+    assert (t & "X4").name == "X4"
+    with pytest.raises(ValueError):
+        t & "A"
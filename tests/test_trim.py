@@ -0,0 +1,38 @@
+import pytest
+
+from orthofinder.tools import trim
+
+alignment = ">a\nAC-D*E\n>b desc\nA--\nDFE\n>c\n-C--FE\n"
+
+
+def test_msa(tmp_path):
+    fn = tmp_path / "in.fa"
+    fn.write_text(alignment)
+    msa = trim.MSA(str(fn))
+    assert msa.names == ["a", "b desc", "c"]
+    assert (msa.n, msa.length) == (3, 6)
+    assert msa.aa_counts.tolist() == [2, 2, 0, 2, 2, 3]
+    assert msa.n_non_gaps == 11
+
+
+def test_trim(tmp_path):
+    infn = tmp_path / "in.fa"
+    outfn = tmp_path / "out.fa"
+    infn.write_text(alignment)
+    trim.run_in_process(str(infn), str(outfn), 0.5, 2, 0.)
+    assert outfn.read_text() == ">a\nACD-E\n>b desc\nA-DFE\n>c\n-C-FE\n"
+
+
+def test_short_alignment_copied(tmp_path):
+    infn = tmp_path / "in.fa"
+    outfn = tmp_path / "out.fa"
+    infn.write_text(alignment)
+    trim.run_in_process(str(infn), str(outfn), 0.5, 6, 0.)
+    assert outfn.read_text() == alignment
+
+
+def test_unequal_lengths(tmp_path):
+    fn = tmp_path / "in.fa"
+    fn.write_text(">a\nACD\n>b\nAC\n")
+    with pytest.raises(ValueError):
+        trim.MSA(str(fn))
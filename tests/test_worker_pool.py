@@ -0,0 +1,43 @@
+import time
+
+import pytest
+
+from orthofinder.utils import parallel_task_manager
+
+
+def Interval(i):
+    start = time.time()
+    time.sleep(0.05)
+    return i, start, time.time()
+
+
+@pytest.fixture
+def pool():
+    pool = parallel_task_manager.WorkerPool(3)
+    yield pool
+    pool.Stop()
+
+
+def test_map_keeps_order(pool):
+    results = pool.Map(Interval, [(i,) for i in range(7)])
+    assert [r[0] for r in results] == list(range(7))
+
+
+def test_map_caps_tasks_in_flight(pool):
+    results = pool.Map(Interval, [(i,) for i in range(4)], nParallel=1)
+    for (_, _, end), (_, start, _) in zip(results, results[1:]):
+        assert end <= start
+
+
+def test_pool_is_not_reforked():
+    ptm = parallel_task_manager.ParallelTaskManager_singleton()
+    try:
+        pool = ptm.GetWorkerPool(2)
+        pids = [proc.pid for proc in pool.processes]
+        assert ptm.GetWorkerPool(4) is pool
+        assert ptm.GetWorkerPool(1) is pool
+        assert [proc.pid for proc in pool.processes] == pids
+        assert all(proc.is_alive() for proc in pool.processes)
+    finally:
+        ptm.Stop()
+        parallel_task_manager.ParallelTaskManager_singleton.instance = None